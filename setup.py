@@ -7,6 +7,11 @@ setup(
     packages = find_packages(),
     scripts = ['tools/buildbsp.py'],
 
+    # geometry, export, portals and optimize's lightmap passes need NumPy
+    extras_require = {
+        'numpy': ['numpy'],
+    },
+
     entry_points = {
         'console_scripts': [
             'buildbsp = buildbsp:main'
@@ -41,6 +46,7 @@ use in the Source Engine and its many games.
 Also included is a script (buildbsp) to help automate the process of compiling
 and installing VMF maps into ready-to-use BSP files.
 
-This package requires Python 3 or later.
+This package requires Python 3 or later. Some modules also need NumPy,
+which is installed along with vmflib by `pip install vmflib[numpy]`.
 """
 )
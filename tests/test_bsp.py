@@ -0,0 +1,265 @@
+"""
+
+Tests for the bsp module.
+
+"""
+
+import io
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import zipfile
+
+from vmflib import brush, bsp, vmf
+
+PLANES = 1
+
+
+def _bsp(lumps):
+    """Returns a BSP holding the given (index, contents) lumps, in order."""
+    header = bytearray(bsp.HEADER_SIZE)
+    bsp.HEADER.pack_into(header, 0, b'VBSP', 20)
+    body = b''
+    for index, content in lumps:
+        bsp.LUMP.pack_into(header, bsp.HEADER.size + index * bsp.LUMP.size,
+            bsp.HEADER_SIZE + len(body), len(content), 0, b'\0\0\0\0')
+        body += content + b'\0' * (-len(content) % 4)
+    return bytes(header) + body
+
+
+def _entities(*classnames):
+    return bsp.format_entities([[('classname', name)]
+        for name in ('worldspawn',) + classnames])
+
+
+class CountTest(unittest.TestCase):
+
+    def test_count_items(self):
+        data = _bsp([(bsp.ENTITIES, _entities('info_target', 'light')),
+            (PLANES, b'\1' * 60)])
+        counts = bsp.count_items(data)
+        self.assertEqual(counts['entities'], 3)
+        self.assertEqual(counts['planes'], 3)
+        self.assertEqual(counts['clusters'], 0)
+        self.assertEqual(counts, bsp.count_items(memoryview(data)))
+
+
+class BspFileTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.bsp')
+        self.planes = b'\1' * 200
+        with open(self.filename, 'wb') as f:
+            f.write(_bsp([(bsp.ENTITIES, _entities('info_target')),
+                (PLANES, self.planes)]))
+
+    def test_read(self):
+        with bsp.BspFile(self.filename) as bsp_file:
+            self.assertEqual((bsp_file.version, bsp_file.revision), (20, 0))
+            self.assertEqual(bytes(bsp_file.lump('planes')), self.planes)
+            self.assertEqual(bytes(bsp_file.lump(PLANES)), self.planes)
+            self.assertEqual(bsp_file.lump_sizes()['planes'], 200)
+            self.assertEqual(bsp_file.lump_sizes()['faces'], 0)
+            self.assertEqual([entity.get('classname')
+                for entity in bsp_file.entities()],
+                ['worldspawn', 'info_target'])
+            self.assertEqual(bsp_file.counts()['planes'], 10)
+            # Lumps may outlive the file
+            planes = bsp_file.lump(PLANES)
+        self.assertEqual(bytes(planes), self.planes)
+
+    def test_stats(self):
+        limits = {'planes': 40, 'entities_bytes': 1000}
+        with bsp.BspFile(self.filename) as bsp_file:
+            stats = bsp_file.stats(limits)
+            self.assertEqual(stats['planes'], {'count': 10, 'limit': 40,
+                'percent': 25.0})
+            self.assertEqual(stats['entities_bytes']['count'],
+                bsp_file.lump_sizes()['entities'])
+            self.assertEqual(set(bsp_file.stats()), set(bsp.BSP_LIMITS))
+
+    def test_not_a_bsp(self):
+        for data in (b'', b'VBSP', b'IBSP' + bytes(bsp.HEADER_SIZE)):
+            with open(self.filename, 'wb') as f:
+                f.write(data)
+            with self.assertRaises(bsp.BspError):
+                bsp.BspFile(self.filename)
+
+    def test_truncated(self):
+        with open(self.filename, 'r+b') as f:
+            f.truncate(bsp.HEADER_SIZE + 100)
+        with bsp.BspFile(self.filename) as bsp_file:
+            with self.assertRaises(bsp.BspError):
+                bsp_file.lump(PLANES)
+
+    def test_audit(self):
+        missing = self.filename + '.missing'
+        results = dict(bsp.audit([self.filename, missing], threshold=20,
+            limits={'planes': 40, 'models': 10}))
+        self.assertEqual(results[self.filename],
+            ['planes: 10 of 40 (25%)'])
+        self.assertEqual(len(results[missing]), 1)
+        self.assertEqual(dict(bsp.audit([self.filename]))[self.filename], [])
+
+
+class PatchEntitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'map.bsp')
+        self.planes = bytes(range(40))
+        with open(self.filename, 'wb') as f:
+            f.write(_bsp([(bsp.ENTITIES, _entities(*['info_target'] * 10)),
+                (PLANES, self.planes)]))
+        os.chmod(self.filename, 0o644)
+
+    def _read(self, filename=None):
+        with bsp.BspFile(filename or self.filename) as bsp_file:
+            classnames = [entity.get('classname')
+                for entity in bsp_file.entities()]
+            return classnames, bytes(bsp_file.lump(PLANES))
+
+    def test_fits_in_place(self):
+        size = os.path.getsize(self.filename)
+        vmf.Entity('info_target')
+        bsp.patch_entities(self.filename, self.map)
+        self.assertEqual(self._read(), (['worldspawn', 'info_target'],
+            self.planes))
+        self.assertEqual(os.path.getsize(self.filename), size)
+
+    def test_moves_lumps(self):
+        for i in range(20):
+            vmf.Entity('info_target')
+        bsp.patch_entities(self.filename, self.map)
+        self.assertEqual(self._read(), (['worldspawn'] + ['info_target'] * 20,
+            self.planes))
+        # The new file replaced the old, leaving nothing else behind
+        self.assertEqual(os.listdir(self.directory), ['map.bsp'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o644)
+
+    def test_output(self):
+        with open(self.filename, 'rb') as f:
+            original = f.read()
+        for count in (1, 20):
+            for i in range(count):
+                vmf.Entity('light')
+            output = os.path.join(self.directory, 'out%d.bsp' % count)
+            bsp.patch_entities(self.filename, self.map, output)
+            classnames, planes = self._read(output)
+            self.assertEqual(classnames.count('light'), count)
+            self.assertEqual(planes, self.planes)
+            self.map = vmf.ValveMap()
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_brush_entity_changed(self):
+        entity = vmf.Entity('func_door')
+        entity.children.append(brush.Solid())
+        with open(self.filename, 'rb') as f:
+            original = f.read()
+        with self.assertRaises(bsp.BspError):
+            bsp.patch_entities(self.filename, self.map)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'map.bsp')
+        self.planes = bytes(range(40))
+        with open(self.filename, 'wb') as f:
+            f.write(_bsp([(bsp.ENTITIES, _entities('info_target')),
+                (PLANES, self.planes)]))
+        self.content = os.path.join(self.directory, 'content')
+        self._add('materials/custom/wall.vmt', 'LightmappedGeneric {}')
+        self._add('sound/custom/hum.wav', 'RIFF')
+
+    def _add(self, name, text):
+        path = os.path.join(self.content, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _read(self, filename=None):
+        """Returns the files in a BSP's pakfile, and its planes."""
+        with bsp.BspFile(filename or self.filename) as bsp_file:
+            planes = bytes(bsp_file.lump(PLANES))
+            archive = io.BytesIO(bytes(bsp_file.lump(bsp.PAKFILE)))
+        with zipfile.ZipFile(archive) as pakfile:
+            files = dict((name, pakfile.read(name).decode('utf-8'))
+                for name in pakfile.namelist())
+        return files, planes
+
+    def test_list_files(self):
+        self.assertEqual([name for name, path in
+            bsp.list_files(self.content)],
+            ['materials/custom/wall.vmt', 'sound/custom/hum.wav'])
+
+    def test_read_file_list(self):
+        filename = os.path.join(self.directory, 'files.txt')
+        with open(filename, 'w') as f:
+            f.write('materials\\a.vmt\n/tmp/a.vmt\n\nsound/b.wav\n'
+                '/tmp/b.wav\n')
+        self.assertEqual(bsp.read_file_list(filename),
+            [('materials/a.vmt', '/tmp/a.vmt'), ('sound/b.wav', '/tmp/b.wav')])
+        with open(filename, 'a') as f:
+            f.write('sound/c.wav\n')
+        with self.assertRaises(ValueError):
+            bsp.read_file_list(filename)
+
+    def test_pack(self):
+        bsp.pack_files(self.filename, self.content)
+        self.assertEqual(self._read(), ({
+            'materials/custom/wall.vmt': 'LightmappedGeneric {}',
+            'sound/custom/hum.wav': 'RIFF'}, self.planes))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            ['content', 'map.bsp'])
+
+    def test_pack_again(self):
+        bsp.pack_files(self.filename, self.content)
+        path = self._add('materials/other.vmt', 'VertexLitGeneric {}')
+        bsp.pack_files(self.filename, [('MATERIALS/custom/wall.vmt', path),
+            ('materials/other.vmt', path)])
+        files, planes = self._read()
+        # The old wall.vmt was replaced, whatever the case of its name
+        self.assertEqual(files, {
+            'MATERIALS/custom/wall.vmt': 'VertexLitGeneric {}',
+            'materials/other.vmt': 'VertexLitGeneric {}',
+            'sound/custom/hum.wav': 'RIFF'})
+        self.assertEqual(planes, self.planes)
+
+    def test_output(self):
+        with open(self.filename, 'rb') as f:
+            original = f.read()
+        output = os.path.join(self.directory, 'packed.bsp')
+        bsp.pack_files(self.filename, self.content, output)
+        self.assertEqual(len(self._read(output)[0]), 2)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_pack_maps(self):
+        broken = os.path.join(self.directory, 'broken.bsp')
+        with open(broken, 'wb') as f:
+            f.write(b'VBSP')
+        results = list(bsp.pack_maps([self.filename, broken], self.content,
+            jobs=2))
+        self.assertEqual([filename for filename, error in results],
+            [self.filename, broken])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], bsp.BspError)
+        self.assertEqual(len(self._read()[0]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,574 @@
+"""
+
+Tests for the buildbsp tool.
+
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from vmflib import bsp
+
+TOOLS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tools')
+spec = importlib.util.spec_from_file_location('buildbsp',
+    os.path.join(TOOLS, 'buildbsp.py'))
+buildbsp = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(buildbsp)
+
+VMF = """world
+{
+	"id" "1"
+	"classname" "worldspawn"
+}
+entity
+{
+	"id" "2"
+	"classname" "light"
+	"_light" "%s"
+}
+"""
+
+
+def _bsp(entities):
+    """Returns a BSP with nothing in it but the given entities."""
+    data = bsp.HEADER.pack(b'VBSP', 20).ljust(bsp.HEADER_SIZE, b'\0')
+    return bsp.replace_lump(data, bsp.ENTITIES,
+        bsp.format_entities(entities))
+
+
+def _compilers(toolsdir, vrad_status=0, failing=()):
+    """Writes stand-ins for the compilers, which note each map they build
+    in toolsdir/runs. VRAD exits with the given status (or is killed by
+    the signal, when it's negative), and VBSP fails the maps named in
+    failing."""
+    os.mkdir(toolsdir)
+    script = ("import os, sys\n"
+        "name = os.path.basename(sys.argv[-1])\n"
+        "with open(%r, 'a') as f:\n"
+        "    f.write('%%s %%s\\n' %% (name, os.path.basename(sys.argv[0])))\n"
+        "open(sys.argv[-1] + '.bsp', 'ab').close()\n" %
+        os.path.join(toolsdir, 'runs'))
+    for stage in buildbsp.STAGES:
+        status = vrad_status if stage == 'vrad' else 0
+        filename = os.path.join(toolsdir, stage + '.exe')
+        with open(filename, 'w') as f:
+            f.write('#! %s\n' % sys.executable + script)
+            if stage == 'vbsp':
+                f.write('if name in %r:\n    sys.exit(1)\n' % (failing,))
+            if status < 0:
+                f.write('os.kill(os.getpid(), %d)\n' % -status)
+            f.write('sys.exit(%d)\n' % status)
+        os.chmod(filename, 0o755)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = buildbsp.BuildCache(
+            os.path.join(self.directory, 'cache'), 1 << 30)
+        self.toolchain = buildbsp.Toolchain('tf2', 'tf', self.directory,
+            os.path.join(self.directory, 'bin'))
+        self.args = argparse.Namespace(fast=False, hdr=False, final=False)
+        self.vmf_file = os.path.join(self.directory, 'test.vmf')
+
+    def _build(self, brightness='255 255 255 200'):
+        with open(self.vmf_file, 'w') as f:
+            f.write(VMF % brightness)
+        build = buildbsp.MapBuild(self.vmf_file)
+        self.cache.set_keys(build, self.toolchain, self.args)
+        return build
+
+    def _store(self, build, stages):
+        for stage in stages:
+            with open(build.bsp_file, 'w') as f:
+                f.write(stage)
+            self.cache.store(build, stage)
+        os.remove(build.bsp_file)
+
+    def test_latest_stage_restored(self):
+        self._store(self._build(), ['vbsp', 'vvis'])
+        build = self._build()
+        self.assertTrue(self.cache.restore(build))
+        self.assertEqual((build.stage, build.cached), (2, ['vbsp', 'vvis']))
+        with open(build.bsp_file) as f:
+            self.assertEqual(f.read(), 'vvis')
+
+    def test_keys(self):
+        first = self._build()
+        self.assertEqual(first.keys, self._build().keys)
+        self.assertNotEqual(first.keys['vbsp'],
+            self._build('255 0 0 200').keys['vbsp'])
+        self.args.fast = True
+        faster = self._build()
+        self.assertEqual(first.keys['vbsp'], faster.keys['vbsp'])
+        self.assertNotEqual(first.keys['vvis'], faster.keys['vvis'])
+        self.assertNotEqual(first.keys['vrad'], faster.keys['vrad'])
+
+    def test_not_cached(self):
+        self._store(self._build(), ['vbsp'])
+        build = self._build('255 0 0 200')
+        self.assertFalse(self.cache.restore(build))
+        self.assertEqual((build.stage, build.cached), (0, []))
+
+    def test_evict(self):
+        self.cache.max_size = 10
+        build = self._build()
+        for i, stage in enumerate(buildbsp.STAGES):
+            self._store(build, [stage])
+            entry = self.cache._entry(build.keys[stage])
+            os.utime(entry, (1000 + i, 1000 + i))
+        # Each entry is four or five bytes, so only the newest two fit
+        self.cache.evict()
+        self.assertEqual([os.path.isdir(self.cache._entry(build.keys[stage]))
+            for stage in buildbsp.STAGES], [False, True, True])
+
+    def test_rebuild_unchanged(self):
+        _compilers(self.toolchain.toolsdir)
+        scheduler = buildbsp.Scheduler(self.toolchain, self.args,
+            cache=self.cache, log=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.run([self._build()])
+            build = self._build()
+            scheduler.run([build])
+        self.assertTrue(build.ok)
+        self.assertEqual(build.cached, buildbsp.STAGES)
+        with open(os.path.join(self.toolchain.toolsdir, 'runs')) as f:
+            self.assertEqual(len(f.readlines()), len(buildbsp.STAGES))
+
+
+class RelightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = buildbsp.BuildCache(
+            os.path.join(self.directory, 'cache'), 1 << 30)
+        self.toolchain = buildbsp.Toolchain('tf2', 'tf', self.directory,
+            os.path.join(self.directory, 'bin'))
+        self.vmf_file = os.path.join(self.directory, 'test.vmf')
+
+    def _build(self, brightness, fast=False):
+        """Returns a MapBuild of the map, with the cache keys worked out."""
+        with open(self.vmf_file, 'w') as f:
+            f.write(VMF % brightness)
+        build = buildbsp.MapBuild(self.vmf_file)
+        args = argparse.Namespace(fast=fast, hdr=False, final=False)
+        self.cache.set_keys(build, self.toolchain, args)
+        return build
+
+    def _built(self, build):
+        """Caches a map's VVIS output and records it as the last build."""
+        with open(build.bsp_file, 'wb') as f:
+            f.write(_bsp([[('classname', 'worldspawn')]]))
+        for stage in ('vbsp', 'vvis'):
+            self.cache.store(build, stage)
+        self.cache.remember(build)
+
+    def test_only_lights_changed(self):
+        self._built(self._build('255 255 255 200'))
+        build = self._build('255 0 0 200')
+        self.assertTrue(self.cache.relight(build))
+        self.assertEqual(build.cached, ['vbsp', 'vvis'])
+        with open(build.bsp_file, 'rb') as f:
+            entities = bsp.read_entities(f.read())
+        self.assertEqual([entity.get('_light') for entity in entities],
+            [None, '255 0 0 200'])
+
+    def test_vvis_options_changed(self):
+        self._built(self._build('255 255 255 200', fast=True))
+        build = self._build('255 0 0 200')
+        self.assertFalse(self.cache.relight(build))
+        self.assertEqual(build.cached, [])
+
+    def test_vrad_options_changed(self):
+        self._built(self._build('255 255 255 200'))
+        with open(self.vmf_file, 'w') as f:
+            f.write(VMF % '255 0 0 200')
+        build = buildbsp.MapBuild(self.vmf_file)
+        args = argparse.Namespace(fast=False, hdr=True, final=True)
+        self.cache.set_keys(build, self.toolchain, args)
+        self.assertTrue(self.cache.relight(build))
+
+    def test_compiler_changed(self):
+        os.mkdir(self.toolchain.toolsdir)
+        with open(os.path.join(self.toolchain.toolsdir, 'vbsp.exe'), 'w') as f:
+            f.write('old')
+        self._built(self._build('255 255 255 200'))
+        with open(os.path.join(self.toolchain.toolsdir, 'vbsp.exe'), 'w') as f:
+            f.write('newer')
+        self.assertFalse(self.cache.relight(self._build('255 0 0 200')))
+
+
+class OutputMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out = io.StringIO()
+        self.progress = []
+        self.monitor = buildbsp.OutputMonitor(self.out, 'test',
+            lambda phase, percent: self.progress.append((phase, percent)))
+
+    def test_progress(self):
+        for chunk in ('Loading\nPortalFlow:  0...1', '...2...3', '...4...5...',
+                '6...7...8...9...10 (3)\n', 'BuildVisLeafs:  0...1...2'):
+            self.monitor.feed(chunk.encode('utf-8'))
+        self.monitor.close()
+        # A step counts once its dots are out
+        self.assertEqual(self.progress, [('PortalFlow', 0),
+            ('PortalFlow', 20), ('PortalFlow', 50), ('PortalFlow', 100),
+            ('BuildVisLeafs', 10)])
+        self.assertIsNone(self.monitor.fatal)
+
+    def test_passed_through(self):
+        text = 'Entit\u00e9 ok\n'.encode('utf-8')
+        # A character split between reads still comes out whole
+        self.monitor.feed(text[:5])
+        self.monitor.feed(text[5:])
+        self.monitor.close()
+        self.assertEqual(self.out.getvalue(), 'Entit\u00e9 ok\n')
+        self.assertEqual(self.monitor.text(), self.out.getvalue())
+
+    def test_fatal(self):
+        self.monitor.feed(b'Material not found!: DEV/MISSING\n')
+        self.monitor.feed(b'**** leaked ****\n')
+        # Only the first problem is reported
+        self.assertEqual(self.monitor.fatal,
+            "Material not found: DEV/MISSING")
+        monitor = buildbsp.OutputMonitor(io.StringIO(), 'test')
+        monitor.feed(b'Error: MAX_MAP_BRUSHES')
+        monitor.close()
+        self.assertEqual(monitor.fatal,
+            "The map is over the engine's MAX_MAP_BRUSHES limit.")
+        monitor = buildbsp.OutputMonitor(io.StringIO(), 'test', fatal=[])
+        monitor.feed(b'**** leaked ****\n')
+        self.assertIsNone(monitor.fatal)
+
+
+@unittest.skipUnless(hasattr(os, 'wait4'), "needs wait4")
+class CallTest(unittest.TestCase):
+
+    def test_usage(self):
+        code, usage = buildbsp._call([sys.executable, '-c', 'pass'])
+        self.assertEqual(code, 0)
+        self.assertIsNotNone(usage)
+
+    def test_reaped_elsewhere(self):
+        code, usage = buildbsp._call([sys.executable, '-c', 'exit(3)'],
+            started=lambda process: process.wait())
+        self.assertEqual((code, usage), (3, None))
+
+    def test_kill_after_exit(self):
+        # Killing a compiler that has just exited mustn't reap it
+        process = subprocess.Popen([sys.executable, '-c', 'pass'],
+            start_new_session=True)
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        buildbsp._kill(process)
+        pid, status, usage = os.wait4(process.pid, 0)
+        self.assertEqual(pid, process.pid)
+
+    def test_stopped_on_fatal_output(self):
+        script = 'import time; print("**** leaked ****", flush=True); ' \
+            'time.sleep(60)'
+        monitor = buildbsp.OutputMonitor(io.StringIO(), 'test')
+        code, usage = buildbsp._call([sys.executable, '-c', script], monitor)
+        self.assertIn('leaked', monitor.fatal)
+        self.assertEqual(code, -signal.SIGKILL)
+        self.assertIsNotNone(usage)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.toolchain = buildbsp.Toolchain('tf2', 'tf', self.directory,
+            os.path.join(self.directory, 'bin'))
+        self.args = argparse.Namespace(fast=False, hdr=False, final=False)
+        self.build = self._map('test')
+
+    def _map(self, name):
+        vmf_file = os.path.join(self.directory, name + '.vmf')
+        with open(vmf_file, 'w') as f:
+            f.write(VMF % '255 255 255 200')
+        return buildbsp.MapBuild(vmf_file)
+
+    def _run(self, builds=None, **kwargs):
+        scheduler = buildbsp.Scheduler(self.toolchain, self.args, log=True,
+            **kwargs)
+        done = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.run(builds or [self.build], done.append)
+        return done
+
+    def _runs(self):
+        """Returns the (map, compiler) of each compiler run, in order."""
+        with open(os.path.join(self.toolchain.toolsdir, 'runs')) as f:
+            return [tuple(line.split()) for line in f]
+
+    def test_no_reports(self):
+        _compilers(self.toolchain.toolsdir)
+        self._run()
+        self.assertTrue(self.build.ok)
+        self.assertFalse(os.path.exists(self.build.report_file))
+
+    def test_reports(self):
+        _compilers(self.toolchain.toolsdir)
+        self._run(reports=True)
+        with open(self.build.report_file) as f:
+            report = json.load(f)
+        self.assertTrue(report['ok'])
+        self.assertEqual(list(report['stages']), buildbsp.STAGES)
+
+    def test_failed(self):
+        _compilers(self.toolchain.toolsdir, vrad_status=-signal.SIGSEGV)
+        self._run()
+        self.assertFalse(self.build.ok)
+        self.assertEqual(self.build.stats['vrad']['exit_code'],
+            -signal.SIGSEGV)
+
+    def test_maps_further_along_first(self):
+        _compilers(self.toolchain.toolsdir)
+        other = self._map('other')
+        done = self._run([self.build, other])
+        self.assertEqual(done, [self.build, other])
+        self.assertEqual(self._runs(),
+            [('test', stage + '.exe') for stage in buildbsp.STAGES] +
+            [('other', stage + '.exe') for stage in buildbsp.STAGES])
+
+    def test_several_at_once(self):
+        _compilers(self.toolchain.toolsdir, failing=('broken',))
+        builds = [self._map(name) for name in ('a', 'broken', 'b', 'c')]
+        done = self._run(builds, jobs=2)
+        self.assertEqual(sorted(build.mapname for build in done),
+            ['a', 'b', 'broken', 'c'])
+        self.assertEqual([build.ok for build in builds],
+            [True, False, True, True])
+        self.assertEqual(list(builds[1].stats), ['vbsp'])
+        self.assertEqual(builds[1].error,
+            self.toolchain.explain('vbsp', 1))
+        # Each map's stages ran in order
+        for build in builds:
+            stages = [stage for name, stage in self._runs()
+                if name == build.mapname]
+            self.assertEqual(stages, [stage + '.exe'
+                for stage in buildbsp.STAGES][:len(build.stats)])
+
+
+VVIS_OUTPUT = """\
+portalclusters: 120
+numportals: 310
+BasePortalVis:       0...1...2...3...4...5...6...7...8...9...10 (0)
+PortalFlow:          0...1...2...3...4...5...6...7...8...9...10 (3)
+Average clusters visible: 40
+Total clusters visible: 4800
+1 minute, 5 seconds elapsed
+"""
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_parse_metrics(self):
+        self.assertEqual(buildbsp.parse_metrics('vvis', VVIS_OUTPUT), {
+            'portalclusters': 120, 'portals': 310,
+            'average_clusters_visible': 40, 'total_clusters_visible': 4800,
+            'reported_time': 65})
+        self.assertEqual(buildbsp.parse_metrics('vbsp',
+            '**** leaked ****\n2 hours, 1 second elapsed\n'),
+            {'leaked': True, 'reported_time': 7201})
+        text = '7 direct lights\nBounce #1\nBounce #2\n12 seconds elapsed'
+        self.assertEqual(buildbsp.parse_metrics('vrad', text),
+            {'direct_lights': 7, 'bounces': 2, 'reported_time': 12})
+
+    def _build(self, name, stats, error=None):
+        build = buildbsp.MapBuild(os.path.join(self.directory, name + '.vmf'))
+        for stage, (code, wall_time) in zip(buildbsp.STAGES, stats):
+            build.stats[stage] = {'exit_code': code, 'wall_time': wall_time,
+                'threads': None, 'user_time': wall_time / 2,
+                'max_rss_kb': 1000}
+            build.stage += 1
+        build.error = error
+        return build
+
+    def test_write_report(self):
+        builds = [self._build('fast', [(0, 1), (0, 2), (0, 3)]),
+            self._build('slow', [(0, 5), (0, 5), (0, 5)]),
+            self._build('broken', [(1, 1)], "VBSP crashed.")]
+        builds[0].cached = ['vbsp']
+        filename = os.path.join(self.directory, 'report.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            buildbsp.write_report(filename, builds, 20.0, {'jobs': 2})
+        with open(filename) as f:
+            report = json.load(f)
+        self.assertEqual((report['maps'], report['ok'], report['failed']),
+            (3, 2, ['broken']))
+        self.assertEqual(report['settings'], {'jobs': 2})
+        self.assertEqual(report['slowest'][0], ['slow', 15])
+        self.assertEqual(report['stages']['vbsp'], {'runs': 3, 'cached': 1,
+            'failed': 1, 'wall_time': 7, 'user_time': 3.5, 'system_time': 0,
+            'max_rss_kb': 1000})
+        self.assertEqual(report['stages']['vrad']['runs'], 2)
+        self.assertEqual([build['ok'] for build in report['builds']],
+            [True, True, False])
+
+
+GENERATOR = """\
+import os
+from vmflib import vmf
+valve_map = vmf.ValveMap()
+vmf.Entity(%r)
+valve_map.write_vmf(os.path.join(os.path.dirname(__file__), 'generated.vmf'))
+"""
+
+
+class _Scheduler:
+    """Stands in for a Scheduler, noting the maps it's asked to build."""
+
+    def __init__(self, runs):
+        self.runs = runs
+
+    def run(self, builds, on_done=None):
+        self.runs.append([build.mapname for build in builds])
+
+    def cancel(self):
+        pass
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.script = os.path.join(self.directory, 'generate.py')
+        self.vmf_file = os.path.join(self.directory, 'generated.vmf')
+
+    def _write(self, text):
+        with open(self.script, 'w') as f:
+            f.write(text)
+
+    def _generate(self):
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            return buildbsp.run_generator(self.script)
+
+    def test_run_generator(self):
+        self._write(GENERATOR % 'info_target')
+        self.assertEqual(self._generate(), [self.vmf_file])
+        with open(self.vmf_file) as f:
+            first = f.read()
+        # Ids start again from the beginning each time
+        self.assertEqual(self._generate(), [self.vmf_file])
+        with open(self.vmf_file) as f:
+            self.assertEqual(f.read(), first)
+
+    def test_generator_failed(self):
+        self._write('import sys\nsys.exit(2)\n')
+        self.assertIsNone(self._generate())
+        self._write('raise ValueError("no")\n')
+        self.assertIsNone(self._generate())
+        self._write('import sys\nsys.exit(0)\n')
+        self.assertEqual(self._generate(), [])
+
+    def test_watch(self):
+        self._write(GENERATOR % 'info_target')
+        runs = []
+        calls = []
+
+        def sleep(seconds):
+            calls.append(seconds)
+            if len(calls) == 2:
+                # Changed after the first build
+                self._write(GENERATOR % 'info_player_teamspawn')
+            elif len(calls) == 4:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(buildbsp.time, 'sleep', sleep), \
+                contextlib.redirect_stdout(io.StringIO()):
+            buildbsp.watch([self.script], lambda count: _Scheduler(runs),
+                None)
+        self.assertEqual(runs, [['generated'], ['generated']])
+        with open(self.vmf_file) as f:
+            self.assertIn('info_player_teamspawn', f.read())
+
+
+class WinePathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.prefix = os.path.join(self.directory, 'prefix')
+        self.dosdevices = os.path.join(self.prefix, 'dosdevices')
+        os.makedirs(os.path.join(self.prefix, 'drive_c'))
+        os.mkdir(self.dosdevices)
+        self.env = {'WINEPREFIX': self.prefix}
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+    def _winepath(self, args, env, universal_newlines):
+        self.asked.append(args[2:])
+        return ''.join('Y:\\%s\n' % os.path.basename(path)
+            for path in args[2:])
+
+    def _paths(self, **kwargs):
+        self.asked = []
+        with mock.patch.object(buildbsp.subprocess, 'check_output',
+                self._winepath):
+            return buildbsp.WinePaths(self.env, **kwargs)
+
+    def test_drives(self):
+        os.symlink('../drive_c', os.path.join(self.dosdevices, 'c:'))
+        os.symlink('/', os.path.join(self.dosdevices, 'z:'))
+        os.symlink('/', os.path.join(self.dosdevices, 'com1'))
+        paths = self._paths()
+        drive_c = os.path.join(self.prefix, 'drive_c')
+        self.assertEqual(paths.convert([drive_c,
+            os.path.join(drive_c, 'Steam', 'steam.exe'), '/tmp/map.vmf']),
+            ['C:\\', 'C:\\Steam\\steam.exe', 'Z:\\tmp\\map.vmf'])
+        self.assertEqual(self.asked, [])
+
+    def test_winepath(self):
+        paths = self._paths(cache_dir=self.cache_dir)
+        with mock.patch.object(buildbsp.subprocess, 'check_output',
+                self._winepath):
+            self.assertEqual(paths.convert(['/a/one', '/a/two', '/a/one']),
+                ['Y:\\one', 'Y:\\two', 'Y:\\one'])
+            self.assertEqual(paths('/a/two'), 'Y:\\two')
+        # Run once, for all the paths it was asked about
+        self.assertEqual(self.asked, [['/a/one', '/a/two']])
+
+        # The answers are kept for next time...
+        paths = self._paths(cache_dir=self.cache_dir)
+        self.assertEqual(paths('/a/one'), 'Y:\\one')
+        # ...until the prefix's drives change
+        os.utime(self.dosdevices, (0, 0))
+        paths = self._paths(cache_dir=self.cache_dir)
+        self.assertEqual(paths.known, {})
+
+
+class ExitStatusTest(unittest.TestCase):
+
+    def test_exit_status(self):
+        self.assertEqual(buildbsp._exit_status(3), 3)
+        self.assertEqual(buildbsp._exit_status(-signal.SIGKILL), 137)
+        # A failure must never come out as success
+        for code in (None, 0, 256, 512):
+            self.assertEqual(buildbsp._exit_status(code), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+
+Tests for the csg module.
+
+"""
+
+import unittest
+
+from vmflib import brush, csg, vmf
+from vmflib.tools import Block
+from vmflib.types import Vertex
+
+
+def _volume(solid):
+    """Returns the volume of a convex Solid, from its face polygons."""
+    total = 0
+    for face in csg.Polyhedron.from_solid(solid).faces:
+        points = face.points
+        area = 0
+        for a, b in zip(points[1:-1], points[2:]):
+            edges = [[b[k] - points[0][k] for k in range(3)],
+                [a[k] - points[0][k] for k in range(3)]]
+            area += csg._dot(csg._cross(edges[1], edges[0]), face.normal) / 2
+        total += area * face.dist / 3
+    return total
+
+
+def _block(origin, size, material='brick/brickwall001a'):
+    return Block(Vertex(*origin), size, material).brush
+
+
+class SubtractTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.solid = _block((0, 0, 0), (128, 128, 128))
+
+    def test_tunnel(self):
+        bar = _block((0, 0, 0), (256, 64, 64), 'dev/dev_measuregeneric01')
+        pieces = self.solid.subtract(bar)
+        # Only the four planes around the tunnel cut the block
+        self.assertEqual(len(pieces), 4)
+        self.assertAlmostEqual(sum(_volume(p) for p in pieces),
+            128 ** 3 - 128 * 64 * 64)
+        materials = set(side.material for piece in pieces
+            for side in piece.children)
+        self.assertEqual(materials, {'brick/brickwall001a',
+            'dev/dev_measuregeneric01'})
+        pieces = csg.subtract(self.solid, bar, 'tools/toolsnodraw')
+        self.assertIn('tools/toolsnodraw', [side.material
+            for side in pieces[0].children])
+
+    def test_apart(self):
+        other = _block((256, 0, 0), (64, 64, 64))
+        self.assertEqual(self.solid.subtract(other), [self.solid])
+        # Touching faces don't overlap either
+        other = _block((96, 0, 0), (64, 64, 64))
+        self.assertEqual(self.solid.subtract(other), [self.solid])
+
+    def test_inside(self):
+        self.assertEqual(self.solid.subtract(_block((0, 0, 0), (256,) * 3)),
+            [])
+
+    def test_corner(self):
+        pieces = self.solid.subtract(_block((64, 64, 64), (64, 64, 64)))
+        self.assertEqual(len(pieces), 3)
+        self.assertAlmostEqual(sum(_volume(p) for p in pieces),
+            128 ** 3 - 32 ** 3)
+
+
+class IntersectTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.solid = _block((0, 0, 0), (128, 128, 128))
+
+    def test_intersect(self):
+        shared = self.solid.intersect(_block((64, 0, 0), (128, 64, 64)))
+        self.assertIsInstance(shared, brush.Solid)
+        self.assertAlmostEqual(_volume(shared), 64 * 64 * 64)
+        self.assertEqual(shared.bounds(), ((0, -32, -32), (64, 32, 32)))
+
+    def test_apart(self):
+        self.assertIsNone(self.solid.intersect(
+            _block((256, 0, 0), (64, 64, 64))))
+
+
+class HollowTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.solid = _block((0, 0, 0), (128, 128, 128))
+
+    def test_hollow(self):
+        walls = self.solid.hollow(16)
+        self.assertEqual(len(walls), 6)
+        self.assertAlmostEqual(sum(_volume(w) for w in walls),
+            128 ** 3 - 96 ** 3)
+
+    def test_too_thin(self):
+        with self.assertRaises(ValueError):
+            self.solid.hollow(64)
+
+
+class CarveTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.blocks = [Block(Vertex(x, 0, 0), (128, 128, 128))
+            for x in (0, 512, 1024)]
+        self.map.world.children.extend(self.blocks)
+
+    def test_carve(self):
+        cutters = [Block(Vertex(512, 0, 64), (64, 64, 64)),
+            Block(Vertex(2048, 0, 0), (64, 64, 64))]
+        self.assertEqual(csg.carve(self.map.world, cutters), 1)
+        children = self.map.world.children
+        # The carved block's pieces take its place
+        self.assertIs(children[0], self.blocks[0])
+        self.assertIs(children[-1], self.blocks[2])
+        pieces = children[1:-1]
+        self.assertEqual(len(pieces), 5)
+        self.assertAlmostEqual(sum(_volume(p) for p in pieces),
+            128 ** 3 - 64 * 64 * 32)
+        self.assertEqual(self.map.count('brushes'), 7)
+
+    def test_nothing_carved(self):
+        cutter = Block(Vertex(0, 1024, 0), (64, 64, 64))
+        self.assertEqual(csg.carve(self.map.world, [cutter]), 0)
+        self.assertEqual(list(self.map.world.children), self.blocks)
+
+    def test_cutters_overlapping_pieces(self):
+        # The second cutter carves the pieces left by the first
+        cutters = [Block(Vertex(0, 0, 0), (256, 32, 32)),
+            Block(Vertex(0, 0, 0), (32, 256, 32))]
+        self.assertEqual(csg.carve(self.map.world, cutters, cell_size=64), 1)
+        pieces = self.map.world.children[:-2]
+        self.assertAlmostEqual(sum(_volume(p) for p in pieces),
+            128 ** 3 - 128 * 32 * 32 - 96 * 32 * 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
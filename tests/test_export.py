@@ -0,0 +1,173 @@
+"""
+
+Tests for the export module.
+
+"""
+
+import importlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from vmflib import export, vmf
+from vmflib.tools import Block
+from vmflib.types import Vertex
+
+
+def _read_glb(filename):
+    """Returns the JSON document and binary chunk (or None) of a .glb file."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, total = struct.unpack_from('<4sII', data, 0)
+    assert (magic, version, total) == (b'glTF', 2, len(data))
+    length, kind = struct.unpack_from('<I4s', data, 12)
+    assert kind == b'JSON'
+    document = json.loads(data[20:20 + length].decode('utf-8'))
+    binary = None
+    if 20 + length < len(data):
+        size, kind = struct.unpack_from('<I4s', data, 20 + length)
+        assert kind == b'BIN\0'
+        binary = data[28 + length:28 + length + size]
+    return document, binary
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_without_numpy(self):
+        with mock.patch.dict(sys.modules):
+            sys.modules.pop('vmflib.export', None)
+            sys.modules['numpy'] = None
+            with self.assertRaisesRegex(ImportError, r'vmflib\[numpy\]'):
+                importlib.import_module('vmflib.export')
+
+
+def _read_obj(filename):
+    """Returns the vertices, normals and (group, material, face) lines of
+    an OBJ file."""
+    vertices, normals, faces = [], [], []
+    group = material = None
+    with open(filename) as f:
+        for line in f:
+            kind, *values = line.split()
+            if kind == 'v':
+                vertices.append(tuple(float(value) for value in values))
+            elif kind == 'vn':
+                normals.append(tuple(float(value) for value in values))
+            elif kind == 'g':
+                group = values[0]
+            elif kind == 'usemtl':
+                material = values[0]
+            elif kind == 'f':
+                faces.append((group, material, values))
+    return vertices, normals, faces
+
+
+class ObjTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.obj')
+        self.block = Block(Vertex(0, 0, 0), (64, 64, 64),
+            'brick/brickwall001a')
+        self.map.world.children.append(self.block)
+
+    def _write(self, **options):
+        with mock.patch('sys.stdout'):
+            export.write_obj(self.map, self.filename, **options)
+        return _read_obj(self.filename)
+
+    def test_brush(self):
+        vertices, normals, faces = self._write()
+        # Corners and normals shared by several faces are written once
+        self.assertEqual(len(vertices), 8)
+        self.assertEqual(len(normals), 6)
+        self.assertEqual(len(faces), 12)
+        corner = 32 * export.UNIT_SCALE
+        self.assertIn((corner, corner, corner), vertices)
+        for group, material, corners in faces:
+            self.assertEqual(material, 'brick/brickwall001a')
+            for corner in corners:
+                vertex, normal = corner.split('//')
+                self.assertTrue(1 <= int(vertex) <= len(vertices))
+                self.assertTrue(1 <= int(normal) <= len(normals))
+        with open(os.path.join(os.path.dirname(self.filename),
+                'map.mtl')) as f:
+            materials = [line.split()[1] for line in f
+                if line.startswith('newmtl')]
+        self.assertEqual(materials, ['brick/brickwall001a', 'entity'])
+
+    def test_tools_skipped(self):
+        self.block.brush.children[0].material = 'tools/toolsnodraw'
+        self.assertEqual(len(self._write()[2]), 10)
+        vertices, normals, faces = self._write(skip_tools=False)
+        self.assertEqual(len(faces), 12)
+        self.assertEqual(sorted(set(material for g, material, c in faces)),
+            ['brick/brickwall001a', 'tools/toolsnodraw'])
+
+    def test_point_entities(self):
+        entity = vmf.Entity('info_target')
+        entity.origin = '0 0 128'
+        entity.targetname = 'spot'
+        vmf.EntityTable('light', [(0, 256, 0)])
+        door = vmf.Entity('func_door')
+        door.origin = '0 0 0'
+        door.children.append(Block(Vertex(0, 0, 256)).brush)
+        vertices, normals, faces = self._write(scale=1)
+        markers = [face for face in faces if face[1] == 'entity']
+        self.assertEqual(sorted(set(group for group, m, c in markers)),
+            ['info_target_spot', 'light'])
+        self.assertEqual(len(markers), 16)
+        # Source's z is the file's y, and its y the file's -z
+        self.assertIn((0, 128 + export.MARKER_SIZE / 2, 0), vertices)
+        self.assertIn((0, export.MARKER_SIZE / 2, -256), vertices)
+
+
+class GltfTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'map.glb')
+
+    def _write(self):
+        with mock.patch('sys.stdout'):
+            export.write_gltf(self.map, self.filename)
+        return _read_glb(self.filename)
+
+    def test_empty(self):
+        document, binary = self._write()
+        self.assertIsNone(binary)
+        for key in ('buffers', 'bufferViews', 'accessors', 'meshes', 'nodes'):
+            self.assertNotIn(key, document)
+        self.assertEqual(document['scenes'], [{}])
+
+    def test_brushes_and_entities(self):
+        self.map.world.children.append(
+            Block(Vertex(0, 0, 0), (64, 64, 64), 'brick/brickwall001a'))
+        entity = vmf.Entity('info_target')
+        entity.origin = '0 0 128'
+        entity.targetname = 'spot'
+        document, binary = self._write()
+        self.assertEqual(document['buffers'], [{'byteLength': len(binary)}])
+        self.assertEqual([node['name'] for node in document['nodes']],
+            ['brushes', 'info_target spot'])
+        brushes = document['meshes'][0]['primitives']
+        self.assertEqual(len(brushes), 1)
+        position = document['accessors'][brushes[0]['attributes']['POSITION']]
+        for low, high in zip(position['min'], position['max']):
+            self.assertAlmostEqual(low, -32 * export.UNIT_SCALE, places=6)
+            self.assertAlmostEqual(high, 32 * export.UNIT_SCALE, places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+
+Tests for the fgd module.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from vmflib import fgd, vmf
+from vmflib.types import Output
+
+FGD = '''
+@PointClass = item_thing : "A thing"
+[
+	TeamNum(choices) : "Team" : 0 =
+	[
+		0 : "Any"
+		2 : "Red"
+	]
+	count(integer) : "Count" : 1
+]
+'''
+
+
+class FgdEntityTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        fd, filename = tempfile.mkstemp(suffix='.fgd')
+        with os.fdopen(fd, 'w') as f:
+            f.write(FGD)
+        self.addCleanup(os.remove, filename)
+        self.thing = fgd.Fgd(filename).entity_class('item_thing')
+
+    def entity_count(self):
+        return self.map.stats()['entities']['count']
+
+    def test_bad_keyvalues_leave_no_entity_behind(self):
+        before = self.entity_count()
+        next_id = vmf.Entity.entitycount
+        with self.assertRaises(ValueError):
+            self.thing(TeamNum=5)
+        with self.assertRaises(AttributeError):
+            self.thing(bogus=1)
+        self.assertEqual(self.entity_count(), before)
+        self.assertEqual(len(self.map.query(classname='item_thing')), 0)
+        self.assertEqual(vmf.Entity.entitycount, next_id)
+
+    def test_good_keyvalues(self):
+        entity = self.thing(TeamNum=2)
+        self.assertEqual(entity.TeamNum, 2)
+        self.assertEqual(entity.count, '1')
+        self.assertEqual(self.map.query(classname='item_thing'), [entity])
+        with self.assertRaises(ValueError):
+            entity.count = 'many'
+        self.assertEqual(entity.count, '1')
+
+
+BASE_FGD = '''
+@mapsize(-16384, 16384)
+
+@BaseClass = Targetname
+[
+	targetname(target_source) : "Name" : : "The name " +
+		"other entities use"
+	input Kill(void) : "Removes this entity"
+	output OnUser1(void) : "Fired by FireUser1"
+]
+
+@BaseClass = Toggle
+[
+	spawnflags(flags) =
+	[
+		1 : "Start off" : 0
+	]
+]
+'''
+
+GAME_FGD = '''
+@include "base.fgd"
+
+@SolidClass = worldspawn : "The world"
+[
+	skyname(string) : "Sky" : "sky_day01_01"
+]
+
+// Lights and triggers
+@PointClass base(Targetname, Toggle) iconsprite("editor/light.vmt") =
+	light : "A light"
+[
+	_light(color255) : "Brightness" : "255 255 255 200"
+	spawnflags(flags) =
+	[
+		2 : "Fast" : 1
+	]
+	style(choices) : "Style" : 0 =
+	[
+		0 : "Normal"
+		10 : "Fluorescent"
+	]
+	_distance(integer) readonly : "Distance" : 0
+	input TurnOn(void) : "Turns it on"
+	output OnTurnedOn(void) : "Fired when it turns on"
+]
+'''
+
+
+class FgdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name, text in (('base.fgd', BASE_FGD), ('game.fgd', GAME_FGD)):
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(text)
+        self.filename = os.path.join(self.directory, 'game.fgd')
+        self.cache_file = os.path.join(self.directory, 'fgd.cache')
+
+    def test_classes(self):
+        game = fgd.Fgd(self.filename)
+        self.assertEqual(sorted(game.schemas), ['light', 'worldspawn'])
+        self.assertIn('LIGHT', game)
+        self.assertNotIn('Targetname', game)
+        light = game['light']
+        self.assertEqual((light.kind, light.description, light.bases),
+            ('PointClass', 'A light', ['Targetname', 'Toggle']))
+        self.assertEqual(list(light.keys), ['targetname', 'spawnflags',
+            '_light', 'style', '_distance'])
+        self.assertEqual(light.key('TargetName').description,
+            'The name other entities use')
+        self.assertEqual(light.key('_light').default, '255 255 255 200')
+        # Flags from the base classes are kept
+        self.assertEqual(light.key('spawnflags').choices,
+            {'1': 'Start off', '2': 'Fast'})
+        self.assertEqual(light.key('spawnflags').default, '2')
+        self.assertEqual(list(light.key('style').choices), ['0', '10'])
+        self.assertEqual(light.inputs, {'kill': 'Kill', 'turnon': 'TurnOn'})
+        self.assertEqual(sorted(light.outputs), ['onturnedon', 'onuser1'])
+
+    def test_bad_files(self):
+        for text in ('@PointClass = thing [', '@Nonsense = thing []',
+                '@PointClass base(Missing) = thing []',
+                '@BaseClass base(A) = B []\n@BaseClass base(B) = A []\n'
+                '@PointClass base(A) = thing []'):
+            with open(self.filename, 'w') as f:
+                f.write(text)
+            with self.assertRaises(fgd.FgdError):
+                fgd.Fgd(self.filename)
+
+    def test_cache(self):
+        fgd.Fgd(self.filename, self.cache_file)
+        with mock.patch.object(fgd, 'parse') as parse:
+            game = fgd.Fgd(self.filename, self.cache_file)
+        parse.assert_not_called()
+        self.assertIn('light', game)
+
+        # Changing an included file makes it read them again
+        with open(os.path.join(self.directory, 'base.fgd'), 'a') as f:
+            f.write('@PointClass = info_target []\n')
+        os.utime(os.path.join(self.directory, 'base.fgd'), (0, 0))
+        self.assertIn('info_target', fgd.Fgd(self.filename, self.cache_file))
+
+    def test_validate(self):
+        vmf.reset_ids()
+        valve_map = vmf.ValveMap()
+        game = fgd.Fgd(self.filename)
+        good = vmf.Entity('light')
+        good.properties['_light'] = '255 0 0 100'
+        bad = vmf.Entity('light')
+        bad.properties.update(_light='300 0 0', style=3, brightness=1)
+        bad.spawnflags = 4
+        connections = vmf.Connections()
+        bad.children.append(connections)
+        connections.children.append(Output('OnTurnedOn', 'x', 'Kill'))
+        connections.children.append(Output('OnFire', 'x', 'Kill'))
+        unknown = vmf.Entity('light_fancy')
+        vmf.EntityTable('light', [(0, 0, 0), (64, 0, 0)],
+            properties={'style': [0, 12]})
+        bad_id = bad.properties['id']
+        self.assertCountEqual(game.validate(valve_map), [
+            (bad_id, 'light', "Bad color255 value for _light: '300 0 0'"),
+            (bad_id, 'light', "Bad choices value for style: '3'"),
+            (bad_id, 'light', "Bad flags value for spawnflags: '4'"),
+            (bad_id, 'light', "Unknown key brightness"),
+            (bad_id, 'light', "Unknown output OnFire"),
+            (unknown.properties['id'], 'light_fancy',
+                "Unknown entity class"),
+            (unknown.properties['id'] + 2, 'light',
+                "Bad choices value for style: '12'")])
+        self.assertNotIn(good.properties['id'],
+            [problem[0] for problem in game.validate(valve_map)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+
+Tests for the geometry module.
+
+"""
+
+import importlib
+import sys
+import unittest
+from unittest import mock
+
+import numpy
+
+from vmflib import brush, geometry, vmf
+from vmflib.tools import Block
+from vmflib.types import Plane, Vertex
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_without_numpy(self):
+        with mock.patch.dict(sys.modules):
+            sys.modules.pop('vmflib.geometry', None)
+            sys.modules['numpy'] = None
+            with self.assertRaisesRegex(ImportError, r'vmflib\[numpy\]'):
+                importlib.import_module('vmflib.geometry')
+
+
+def _shifted(plane, dx):
+    """Returns a copy of plane moved dx units along the x axis."""
+    return Plane(*[Vertex(v.x + dx, v.y, v.z)
+        for v in (plane.v0, plane.v1, plane.v2)])
+
+
+class WindingsTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.block = Block(Vertex(0, 0, 0), (64, 64, 64))
+        self.map.world.children.append(self.block)
+
+    def test_block(self):
+        windings = geometry.compute_windings([self.block.brush])
+        self.assertEqual(list(windings.counts), [4] * 6)
+        self.assertEqual(list(windings.areas), [64 * 64] * 6)
+        self.assertEqual(windings.mins.tolist(), [[-32, -32, -32]])
+        self.assertEqual(windings.maxs.tolist(), [[32, 32, 32]])
+        for i in range(len(windings)):
+            face = windings.face(i)
+            normal = windings.normals[i]
+            # Each face lies on its plane, facing out of the brush...
+            self.assertTrue(numpy.allclose(face.dot(normal),
+                windings.dists[i]))
+            self.assertEqual(windings.dists[i], 32)
+            # ...and is wound counter-clockwise, seen from outside
+            edges = numpy.roll(face, -1, axis=0) - face
+            turns = numpy.cross(edges, numpy.roll(edges, -1, axis=0))
+            self.assertTrue(numpy.all(turns.dot(normal) > 0))
+
+    def test_planes_missing_the_brush(self):
+        sides = self.block.brush.children
+        sides.append(brush.Side(_shifted(sides[3].plane, 68)))
+        sides.append(brush.Side(Plane()))
+        windings = geometry.compute_windings([self.block.brush])
+        self.assertEqual(list(windings.counts), [4] * 6 + [0, 0])
+        self.assertTrue(numpy.all(numpy.isnan(windings.face_mins[6:])))
+        self.assertEqual(windings.maxs.tolist(), [[32, 32, 32]])
+
+    def test_bevelled_edge(self):
+        # Cut the edge between the top and the +x side off at 45 degrees
+        self.block.brush.children.append(brush.Side(Plane(Vertex(32, 32, 0),
+            Vertex(32, 0, 0), Vertex(0, 0, 32))))
+        windings = geometry.compute_windings([self.block.brush])
+        self.assertEqual(sorted(windings.counts), [4] * 5 + [5] * 2)
+        self.assertAlmostEqual(windings.areas[6], 64 * numpy.hypot(32, 32))
+        self.assertAlmostEqual(windings.areas.sum(), 2 * 4096 +
+            2 * 2048 + 2 * (4096 - 512) + windings.areas[6])
+
+    def test_chunks(self):
+        blocks = [Block(Vertex(i * 128, 0, 0), (64, 64, 64))
+            for i in range(5)]
+        whole = geometry.compute_windings([b.brush for b in blocks])
+        for b in blocks:
+            b.brush._winding = None
+        with mock.patch.object(geometry, 'CHUNK_ELEMENTS', 1):
+            chunked = geometry.compute_windings([b.brush for b in blocks])
+        self.assertTrue(numpy.array_equal(whole.points, chunked.points))
+        self.assertTrue(numpy.array_equal(whole.offsets, chunked.offsets))
+        self.assertEqual(chunked.mins[4].tolist(), [480, -32, -32])
+
+    def test_cached(self):
+        other = Block(Vertex(0, 0, 256), (64, 64, 64))
+        solids = [self.block.brush, other.brush]
+        first = geometry.compute_windings(solids)
+        with mock.patch.object(geometry, '_brush_polygons') as polygons:
+            again = geometry.compute_windings(solids)
+        polygons.assert_not_called()
+        self.assertTrue(numpy.array_equal(first.points, again.points))
+
+        # Only the brush that moved is worked out again
+        other.origin = Vertex(0, 0, 512)
+        other.update_sides()
+        with mock.patch.object(geometry, '_brush_polygons',
+                wraps=geometry._brush_polygons) as polygons:
+            moved = geometry.compute_windings(solids)
+        self.assertEqual(polygons.call_count, 1)
+        self.assertEqual(moved.mins[1].tolist(), [-32, -32, 480])
+        self.assertEqual(moved.mins[0].tolist(), [-32, -32, -32])
+
+    def test_map_solids(self):
+        door = vmf.Entity('func_door')
+        door.children.append(Block().brush)
+        solids = geometry.map_solids(self.map)
+        self.assertEqual(solids, [self.block.brush, door.children[0]])
+        self.assertEqual(len(geometry.compute_windings([])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+
+Tests for the optimize module.
+
+"""
+
+import unittest
+
+from vmflib import optimize, vmf
+from vmflib.tools import Block
+from vmflib.types import Vertex
+
+
+def _room(valve_map):
+    """Walls a 1024 unit room in, with a crate and a pillar inside it."""
+    walls = [((0, 0, -544), (1152, 1152, 64)), ((0, 0, 544), (1152, 1152, 64)),
+        ((-544, 0, 0), (64, 1152, 1024)), ((544, 0, 0), (64, 1152, 1024)),
+        ((0, -544, 0), (1024, 64, 1024)), ((0, 544, 0), (1024, 64, 1024))]
+    for origin, size in walls:
+        valve_map.world.children.append(
+            Block(Vertex(*origin), size, 'brick/brickwall001a'))
+    crate = Block(Vertex(0, 0, -480), (64, 64, 64), 'wood/woodcrate001a')
+    pillar = Block(Vertex(256, 256, 0), (64, 64, 1024), 'brick/brickwall001a')
+    valve_map.world.children.extend([crate, pillar])
+    return crate, pillar
+
+
+class ClassifyDetailTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.crate, self.pillar = _room(self.map)
+
+    def test_small_brushes_become_detail(self):
+        report = optimize.classify_detail(self.map)
+        self.assertEqual(report.detail, [self.crate])
+        self.assertEqual(len(report.structural), 7)
+        self.assertNotIn(self.crate, self.map.world.children)
+        self.assertIn(report.entity, self.map.children)
+        self.assertEqual(report.entity.classname, 'func_detail')
+        self.assertEqual(list(report.entity.children), [self.crate])
+
+    def test_not_applied(self):
+        report = optimize.classify_detail(self.map, apply=False)
+        self.assertEqual(report.detail, [self.crate])
+        self.assertIsNone(report.entity)
+        self.assertIn(self.crate, self.map.world.children)
+
+    def test_structural_material(self):
+        self.crate.brush.children[0].material = 'tools/toolshint'
+        self.assertEqual(optimize.classify_detail(self.map).detail, [])
+
+    def test_older_map(self):
+        # The entity goes into the map being classified, not the newest one
+        other = vmf.ValveMap()
+        report = optimize.classify_detail(self.map)
+        self.assertIn(report.entity, self.map.children)
+        self.assertNotIn(report.entity, other.children)
+        self.assertEqual(self.map.count('entities'), 2)
+        self.assertEqual(other.count('entities'), 1)
+
+
+class LightmapTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.block = Block(Vertex(0, 0, 0), (64, 64, 64))
+        self.map.world.children.append(self.block)
+
+    def scales(self, block):
+        return [side.lightmapscale for side in block.brush.children]
+
+    def test_estimate(self):
+        # Each 64 unit face at a scale of 16 has 5 by 5 luxels
+        luxels, seconds = optimize.estimate_vrad_cost(self.map)
+        self.assertEqual(luxels, 6 * 25)
+        self.assertAlmostEqual(seconds,
+            luxels * optimize.VRAD_SECONDS_PER_LUXEL)
+
+    def test_unlit_faces(self):
+        side = self.block.brush.children[0]
+        side.material = 'tools/toolsnodraw'
+        self.assertEqual(optimize.estimate_vrad_cost(self.map)[0], 5 * 25)
+        report = optimize.optimize_lightmaps(self.map)
+        self.assertEqual(report.changed, [side])
+        self.assertEqual(side.lightmapscale, 128)
+        self.assertEqual(report.luxels_before, report.luxels_after)
+
+    def test_large_faces(self):
+        floor = Block(Vertex(0, 0, 512), (1024, 1024, 16))
+        self.map.world.children.append(floor)
+        report = optimize.optimize_lightmaps(self.map, apply=False)
+        self.assertEqual(len(report.changed), 2)
+        self.assertLess(report.luxels_after, report.luxels_before)
+        self.assertEqual(self.scales(floor), [16] * 6)
+        optimize.optimize_lightmaps(self.map)
+        self.assertEqual(sorted(self.scales(floor)), [16] * 4 + [32] * 2)
+        self.assertEqual(self.scales(self.block), [16] * 6)
+
+    def test_far_from_spawns(self):
+        far = Block(Vertex(8192, 0, 0), (64, 64, 64))
+        self.map.world.children.append(far)
+        optimize.optimize_lightmaps(self.map)
+        # Without spawns, distance isn't taken into account
+        self.assertEqual(self.scales(far), [16] * 6)
+        spawn = vmf.Entity('info_player_teamspawn')
+        spawn.origin = '0 0 0'
+        optimize.optimize_lightmaps(self.map)
+        self.assertEqual(self.scales(far), [64] * 6)
+        self.assertEqual(self.scales(self.block), [16] * 6)
+
+    def test_budget(self):
+        self.map.world.children.append(
+            Block(Vertex(0, 0, 512), (1024, 1024, 16)))
+        report = optimize.optimize_lightmaps(self.map, luxel_budget=1000)
+        self.assertLessEqual(report.luxels_after, 1000)
+        self.assertEqual(optimize.estimate_vrad_cost(self.map)[0],
+            report.luxels_after)
+        for side in report.changed:
+            self.assertLessEqual(side.lightmapscale, 128)
+
+    def test_budget_out_of_reach(self):
+        report = optimize.optimize_lightmaps(self.map, luxel_budget=1,
+            max_scale=32)
+        self.assertGreater(report.luxels_after, 1)
+        self.assertEqual(self.scales(self.block), [32] * 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
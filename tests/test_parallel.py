@@ -0,0 +1,101 @@
+"""
+
+Tests for the parallel module.
+
+"""
+
+import pickle
+import unittest
+
+from vmflib import brush, parallel, vmf
+from vmflib.tools import Block
+from vmflib.types import Output, Vertex
+
+
+def _towers(valve_map, region):
+    """Puts a random number of towers in a region, with a light on each."""
+    x, y = region.mins[0], region.mins[1]
+    for i in range(region.random.randint(1, 4)):
+        height = region.random.choice((64, 128, 256))
+        valve_map.world.children.append(Block(
+            Vertex(x + i * 128, y, height / 2), (64, 64, height)))
+        light = vmf.Entity('light')
+        light.origin = '%d %d %d' % (x + i * 128, y, height + 16)
+        light.targetname = 'light_%d_%d' % region.index
+    relay = vmf.Entity('logic_relay')
+    connections = vmf.Connections()
+    relay.children.append(connections)
+    connections.children.append(Output('OnTrigger',
+        'light_%d_%d' % region.index, 'TurnOff'))
+
+
+class RegionsTest(unittest.TestCase):
+
+    def test_grid(self):
+        grid = parallel.regions((0, 0, -64), (100, 50, 64), 40, seed=3)
+        self.assertEqual([region.index for region in grid],
+            [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)])
+        self.assertEqual((grid[2].mins, grid[2].maxs),
+            ((80, 0, -64), (100, 40, 64)))
+        self.assertEqual((grid[5].mins, grid[5].maxs),
+            ((80, 40, -64), (100, 50, 64)))
+        again = parallel.regions((0, 0, -64), (100, 50, 64), 40, seed=3)
+        self.assertEqual([region.seed for region in grid],
+            [region.seed for region in again])
+        self.assertEqual(len(set(region.seed for region in grid)), 6)
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            parallel.regions((0, 0, 0), (64, 64, 64), (64, 0))
+
+
+class GenerateTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+
+    def _generate(self, jobs):
+        vmf.reset_ids()
+        return parallel.generate(_towers, (0, 0, 0), (1024, 1024, 512), 256,
+            seed=7, jobs=jobs)
+
+    def test_same_whatever_the_processes(self):
+        self.assertEqual(str(self._generate(1)), str(self._generate(2)))
+
+    def test_ids_follow_on(self):
+        valve_map = vmf.ValveMap()
+        first = vmf.Entity('info_target').properties['id']
+        parallel.generate(_towers, (0, 0, 0), (1024, 1024, 512), 256,
+            valve_map, seed=7, jobs=1)
+        brush_ids = sorted(solid.properties['id']
+            for solid in valve_map.query_brushes())
+        side_ids = [side.properties['id']
+            for solid in valve_map.query_brushes() for side in solid.children]
+        ids = sorted(brush_ids + side_ids)
+        self.assertEqual(ids, list(range(len(ids))))
+        self.assertEqual(brush.Solid.solid_count, len(ids))
+
+        entity_ids = sorted(entity.properties['id']
+            for entity in valve_map.query())
+        self.assertEqual(entity_ids,
+            list(range(first, first + len(entity_ids))))
+        self.assertEqual(vmf.Entity.entitycount, first + len(entity_ids))
+        self.assertEqual(valve_map.missing_targets(), [])
+
+
+class PickleTest(unittest.TestCase):
+
+    def test_sides(self):
+        # Sides are pickled compactly when sent back from the processes
+        block = Block(Vertex(0, 0, 32), (64, 64, 64), 'dev/dev_blendmeasure')
+        block.brush.children[0].lightmapscale = 32
+        block.brush.children[1].properties['smoothing'] = 'yes'
+        copy = pickle.loads(pickle.dumps(block))
+        self.assertEqual(str(copy.brush), str(block.brush))
+        for side in copy.brush.children:
+            self.assertIs(side._parent, copy.brush)
+            self.assertEqual(side.plane_key, brush.plane_key(side.plane))
+
+
+if __name__ == '__main__':
+    unittest.main()
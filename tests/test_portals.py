@@ -0,0 +1,107 @@
+"""
+
+Tests for the portals module.
+
+"""
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from vmflib import portals, vmf
+from vmflib.tools import Block
+from vmflib.types import Vertex
+
+# Three clusters in a row along x, joined by two 128 unit square portals,
+# and a smaller one far away
+PRT = """PRT1
+4
+3
+4 0 1 (64 -64 -64 ) (64 64 -64 ) (64 64 64 ) (64 -64 64 )
+4 1 2 (192 -64 -64 ) (192 64 -64 ) (192 64 64 ) (192 -64 64 )
+3 2 3 (2048 0 0 ) (2048 32 0 ) (2048 0 32 )
+"""
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_without_numpy(self):
+        with mock.patch.dict(sys.modules):
+            sys.modules.pop('vmflib.portals', None)
+            sys.modules['numpy'] = None
+            with self.assertRaisesRegex(ImportError, r'vmflib\[numpy\]'):
+                importlib.import_module('vmflib.portals')
+
+
+class PortalsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'map.prt')
+        self._write(PRT)
+
+    def _write(self, text):
+        with open(self.filename, 'w') as f:
+            f.write(text)
+
+    def test_read_prt(self):
+        prt = portals.read_prt(self.filename)
+        self.assertEqual((prt.cluster_count, len(prt)), (4, 3))
+        self.assertEqual(prt.clusters.tolist(), [[0, 1], [1, 2], [2, 3]])
+        self.assertEqual(prt.counts.tolist(), [4, 4, 3])
+        self.assertEqual(prt.areas.tolist(), [128 * 128, 128 * 128, 512])
+        self.assertEqual(prt.centers[1].tolist(), [192, 0, 0])
+        self.assertEqual(prt.mins[0].tolist(), [64, -64, -64])
+        self.assertEqual(prt.maxs[2].tolist(), [2048, 32, 32])
+
+    def test_summary(self):
+        prt = portals.read_prt(self.filename)
+        self.assertEqual(prt.cluster_portals().tolist(), [1, 2, 2, 1])
+        self.assertEqual(prt.summary(), {'clusters': 4, 'portals': 3,
+            'portals_per_cluster': 1.5, 'most_portals_in_a_cluster': 2,
+            'portal_area': 2 * 128 * 128 + 512.0})
+
+    def test_empty(self):
+        self._write('PRT1\n0\n0\n')
+        prt = portals.read_prt(self.filename)
+        self.assertEqual(len(prt), 0)
+        self.assertEqual(prt.summary()['portals_per_cluster'], 0.0)
+        self.assertEqual(len(prt.density()[1]), 0)
+
+    def test_bad_files(self):
+        for text in ('PRT2\n0\n0\n', 'PRT1\nfour\n3\n',
+                PRT.rsplit('\n', 2)[0],
+                PRT.replace('4 1 2', '5 1 2')):
+            self._write(text)
+            with self.assertRaises(ValueError):
+                portals.read_prt(self.filename)
+
+    def test_density(self):
+        mins, counts = portals.read_prt(self.filename).density(256)
+        self.assertEqual(mins.tolist(), [[0, 0, 0], [2048, 0, 0]])
+        self.assertEqual(counts.tolist(), [2, 1])
+
+    def test_hotspots(self):
+        vmf.reset_ids()
+        valve_map = vmf.ValveMap()
+        near = Block(Vertex(128, 0, 0), (64, 64, 64))
+        far = Block(Vertex(1024, 1024, 0), (64, 64, 64))
+        valve_map.world.children.extend([near, far])
+        prt = portals.read_prt(self.filename)
+        spots = portals.hotspots(prt, valve_map, cell_size=256, count=1)
+        self.assertEqual(len(spots), 1)
+        spot = spots[0]
+        self.assertEqual((spot.mins, spot.maxs),
+            ((0.0, 0.0, 0.0), (256.0, 256.0, 256.0)))
+        self.assertEqual((spot.portals, spot.clusters), (2, 3))
+        self.assertEqual(spot.brushes, [near])
+        self.assertEqual(len(portals.hotspots(prt, cell_size=256)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
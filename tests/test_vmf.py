@@ -0,0 +1,520 @@
+"""
+
+Tests for the vmf module.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmflib import vmf
+from vmflib.tools import Block
+from vmflib.types import Output, Vertex
+
+
+class StrictLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap(strict=True, limits={'entities': 3})
+
+    def test_rejected_entity_gives_its_id_back(self):
+        vmf.Entity('info_target')
+        last = vmf.Entity('info_target')
+        with self.assertRaises(vmf.MapLimitError):
+            vmf.Entity('info_target')
+        with self.assertRaises(vmf.MapLimitError):
+            vmf.EntityTable('info_target', [(0, 0, 0), (64, 0, 0)])
+        self.map.children.remove(last)
+        entity = vmf.Entity('info_target')
+        self.assertEqual(entity.properties['id'], last.properties['id'] + 1)
+        self.assertEqual(self.map.stats()['entities']['count'], 3)
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap(limits={'entities': 4})
+
+    def counts(self):
+        return dict((name, stat['count'])
+            for name, stat in self.map.stats().items())
+
+    def test_empty(self):
+        self.assertEqual(self.counts(), {'brushes': 0, 'brushsides': 0,
+            'entities': 1, 'planes': 0, 'displacements': 0,
+            'connections': 0})
+
+    def test_limits(self):
+        stats = self.map.stats()
+        self.assertEqual(stats['entities'], {'count': 1, 'limit': 4,
+            'percent': 25.0})
+        self.assertEqual(stats['brushes']['limit'],
+            vmf.ENGINE_LIMITS['brushes'])
+        self.assertEqual(stats['connections'], {'count': 0, 'limit': None,
+            'percent': None})
+
+    def test_added_and_removed(self):
+        door = vmf.Entity('func_door')
+        door.children.append(Block().brush)
+        connections = vmf.Connections()
+        door.children.append(connections)
+        connections.children.append(Output('OnOpen', 'lamp', 'TurnOn'))
+        # Shares the four planes around its sides with the door's brush
+        self.map.world.children.append(Block(Vertex(0, 0, 256)))
+        self.assertEqual(self.counts(), {'brushes': 2, 'brushsides': 12,
+            'entities': 2, 'planes': 2 * 8, 'displacements': 0,
+            'connections': 1})
+        self.map.children.remove(door)
+        self.assertEqual(self.counts(), {'brushes': 1, 'brushsides': 6,
+            'entities': 1, 'planes': 2 * 6, 'displacements': 0,
+            'connections': 0})
+
+    def test_not_strict(self):
+        for i in range(4):
+            vmf.Entity('info_target')
+        self.assertEqual(self.map.stats()['entities']['percent'], 125.0)
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+
+    def count(self, name):
+        return self.map.stats()[name]['count']
+
+    def test_changes_before_indexing(self):
+        blocks = list(_blocks(3))
+        self.map.world.children.extend(blocks)
+        blocks[0].set_material('tools/toolsnodraw')
+        blocks[1].origin = Vertex(0, 0, 640)
+        blocks[1].update_sides()
+        blocks[2].brush.children.pop()
+        self.map.world.children.remove(blocks[2])
+        self.assertEqual(self.count('brushes'), 2)
+        self.assertEqual(self.count('brushsides'), 12)
+        self.assertEqual(self.count('planes'), 2 * 8)
+        self.assertEqual(self.map.query_brushes('tools/*'),
+            [blocks[0].brush])
+
+    def test_changes_after_indexing(self):
+        block = Block(Vertex(0, 0, 0), (64, 64, 64))
+        self.map.world.children.append(block)
+        self.assertEqual(self.count('planes'), 2 * 6)
+        block.origin = Vertex(0, 0, 32)
+        block.update_sides()
+        block.set_material('dev/dev_measuregeneric01')
+        self.assertEqual(self.count('planes'), 2 * 6)
+        self.assertEqual(self.map.query_brushes('dev/*'), [block.brush])
+        self.map.world.children.remove(block)
+        self.assertEqual(self.count('planes'), 0)
+        self.assertEqual(self.count('brushsides'), 0)
+
+    def test_entity_added_to_before_indexing(self):
+        entity = vmf.Entity('func_door')
+        entity.children.append(Block().brush)
+        connections = vmf.Connections()
+        entity.children.append(connections)
+        connections.children.append(Output('OnOpen', 'lamp', 'TurnOn'))
+        entity.targetname = 'door'
+        self.assertEqual(self.map.query(targetname='door'), [entity])
+        self.assertEqual(self.map.fired_into('lamp'),
+            [(entity.properties['id'], connections.children[0])])
+        self.assertEqual(self.count('connections'), 1)
+        self.assertEqual(self.count('brushes'), 1)
+
+    def test_renumbered(self):
+        block = Block()
+        entity = vmf.Entity('info_target')
+        self.map.world.children.append(block)
+        old_id = block.brush.properties['id']
+        self.assertIs(self.map.find_brush(old_id), block.brush)
+        self.map.world.children.remove(block)
+        self.map.children.remove(entity)
+        block.brush.properties['id'] = 500
+        entity.properties['id'] = 600
+        self.map.world.children.append(block)
+        self.map.children.append(entity)
+        self.assertIs(self.map.find_brush(500), block.brush)
+        self.assertIsNone(self.map.find_brush(old_id))
+        self.assertIs(self.map.find_by_id(600), entity)
+        self.assertEqual(self.map.query(classname='info_target'), [entity])
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.lights = []
+        for i in range(3):
+            light = vmf.Entity('light')
+            light.targetname = 'Hall_Light_%d' % i
+            light.properties['_light'] = '255 255 255 %d' % (100 * i)
+            self.lights.append(light)
+        self.spot = vmf.Entity('light_spot')
+        self.spot.targetname = 'hall_spot'
+        self.table = vmf.EntityTable('info_target', [(0, 0, 0), (64, 0, 0)],
+            properties={'targetname': ['mark_a', 'mark_b']})
+
+    def test_query(self):
+        self.assertEqual(self.map.query(classname='light'), self.lights)
+        self.assertEqual(self.map.query(classname='LIGHT*'),
+            self.lights + [self.spot])
+        self.assertEqual(self.map.query(targetname='hall_*'),
+            self.lights + [self.spot])
+        self.assertEqual(self.map.query(classname='light_spot',
+            targetname='hall_light_*'), [])
+        self.assertEqual(self.map.query(classname='func_door'), [])
+
+    def test_keyvalues_and_where(self):
+        self.assertEqual(self.map.query(_light='255 255 255 100'),
+            [self.lights[1]])
+        self.assertEqual(self.map.query(classname='light',
+            where=lambda entity: entity.targetname.endswith('2')),
+            [self.lights[2]])
+        self.assertEqual(len(self.map.query()), 6)
+
+    def test_tables(self):
+        rows = self.map.query(targetname='mark_b')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].properties['id'], self.table.first_id + 1)
+        self.assertEqual(rows[0].classname, 'info_target')
+        self.assertEqual(self.map.find_by_id(self.table.first_id).targetname,
+            'mark_a')
+        self.assertIsNone(self.map.find_by_id(self.table.first_id + 2))
+
+    def test_find_by_id(self):
+        for entity in self.lights + [self.spot]:
+            self.assertIs(self.map.find_by_id(entity.properties['id']),
+                entity)
+        self.map.children.remove(self.spot)
+        self.assertIsNone(self.map.find_by_id(self.spot.properties['id']))
+        self.assertEqual(self.map.query(targetname='hall_spot'), [])
+
+    def test_query_brushes(self):
+        blocks = [Block(Vertex(64 * i, 0, 0), (64, 64, 64),
+            'Tools/ToolsNodraw' if i else 'brick/wall') for i in range(3)]
+        self.map.world.children.extend(blocks)
+        door = vmf.Entity('func_door')
+        door.children.append(Block(material='tools/toolsclip').brush)
+        brushes = [block.brush for block in blocks]
+        self.assertEqual(self.map.query_brushes('tools/toolsnodraw'),
+            brushes[1:])
+        self.assertEqual(self.map.query_brushes('TOOLS/*'),
+            brushes[1:] + [door.children[0]])
+        self.assertEqual(self.map.query_brushes(where=lambda solid:
+            solid.bounds()[0][0] > 0), brushes[1:])
+        self.assertIs(self.map.find_brush(brushes[0].properties['id']),
+            brushes[0])
+        self.assertEqual(len(self.map.query_brushes()), 4)
+
+
+def _entity(classname, targetname=None, outputs=()):
+    """Makes an entity firing the given (event, target, input, delay)."""
+    entity = vmf.Entity(classname)
+    entity.targetname = targetname
+    if outputs:
+        connections = vmf.Connections()
+        entity.children.append(connections)
+        for event, target, input, delay in outputs:
+            connections.children.append(Output(event, target, input,
+                delay=delay))
+    return entity
+
+
+class EntityIOTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+
+    def ids(self, *entities):
+        return [entity.properties['id'] for entity in entities]
+
+    def test_targets(self):
+        lamps = [_entity('light', 'Lamp_%d' % i) for i in range(2)]
+        door = _entity('func_door', 'door')
+        vmf.EntityTable('info_target', [(0, 0, 0)],
+            properties={'targetname': 'lamp_table'})
+        self.assertEqual(self.map.targets('LAMP_0'), self.ids(lamps[0]))
+        self.assertEqual(self.map.targets('lamp_*'),
+            self.ids(*lamps) + [door.properties['id'] + 1])
+        # Names that match no targetname fall back to classnames
+        self.assertEqual(self.map.targets('func_door'), self.ids(door))
+        self.assertEqual(self.map.targets('!self'), [])
+        self.assertEqual(self.map.targets(''), [])
+
+    def test_fired_into(self):
+        lamp = _entity('light', 'lamp')
+        button = _entity('func_button', 'button',
+            [('OnPressed', 'lamp', 'Toggle', 0),
+             ('OnPressed', 'la*', 'TurnOn', 1),
+             ('OnPressed', 'light', 'TurnOff', 0)])
+        outputs = button.children[0].children
+        button_id = button.properties['id']
+        # Nothing is called light, so outputs to it reach the class
+        self.assertEqual(self.map.fired_into(lamp),
+            [(button_id, output) for output in outputs])
+        self.assertEqual(self.map.fired_into('lamp'),
+            [(button_id, output) for output in outputs[:2]])
+        # Once something is, they no longer do
+        _entity('info_target', 'light')
+        self.assertEqual(self.map.fired_into(lamp),
+            [(button_id, output) for output in outputs[:2]])
+
+    def test_missing_targets(self):
+        _entity('light', 'lamp')
+        relay = _entity('logic_relay', 'relay',
+            [('OnTrigger', 'lamp', 'Toggle', 0),
+             ('OnTrigger', 'lmap', 'Toggle', 0),
+             ('OnTrigger', '!activator', 'Kill', 0)])
+        self.assertEqual(self.map.missing_targets(),
+            [(relay.properties['id'], relay.children[0].children[1])])
+        _entity('light', 'lmap')
+        self.assertEqual(self.map.missing_targets(), [])
+
+    def test_zero_delay_cycles(self):
+        a = _entity('logic_relay', 'a', [('OnTrigger', 'b', 'Trigger', 0)])
+        b = _entity('logic_relay', 'b', [('OnTrigger', 'a', 'Trigger', 0)])
+        c = _entity('logic_relay', 'c', [('OnTrigger', 'd', 'Trigger', 0.1)])
+        _entity('logic_relay', 'd', [('OnTrigger', 'c', 'Trigger', 0)])
+        e = _entity('logic_relay', 'e', [('OnTrigger', 'e', 'Trigger', 0)])
+        self.assertEqual(self.map.zero_delay_cycles(),
+            [self.ids(a, b), self.ids(e)])
+        b.children[0].children[0] = Output('OnTrigger', 'a', 'Trigger',
+            delay=0.5)
+        self.assertEqual(self.map.zero_delay_cycles(), [self.ids(e)])
+
+    def test_long_chain(self):
+        # Found without recursing, so long chains are no problem
+        count = 5000
+        for i in range(count):
+            _entity('logic_relay', 'r%d' % i,
+                [('OnTrigger', 'r%d' % ((i + 1) % count), 'Trigger', 0)])
+        cycles = self.map.zero_delay_cycles()
+        self.assertEqual(len(cycles), 1)
+        self.assertEqual(len(cycles[0]), count)
+
+
+class EntityTableTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.table = vmf.EntityTable('info_target',
+            [(0, 0, 0), (64, 0, 0), (128, 0, 0)], angles=[(0, 90, 0)] * 3,
+            properties={'targetname': ['a', 'b', 'c'], 'spawnflags': 1})
+
+    def test_ids(self):
+        self.assertEqual(self.table.first_id, 1)
+        self.assertEqual(vmf.Entity('light').properties['id'], 4)
+        self.assertIn(self.table, self.map.children)
+        self.assertEqual(self.map.count('entities'), 5)
+
+    def test_rows(self):
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.row(1), [('classname', 'info_target'),
+            ('spawnflags', 1), ('origin', '64 0 0'), ('angles', '0 90 0'),
+            ('targetname', 'b')])
+        entity = self.table.entity(1)
+        self.assertEqual((entity.properties['id'], entity.targetname,
+            entity.origin), (2, 'b', '64 0 0'))
+        self.assertNotIn(entity, self.map.children)
+        entity.targetname = 'changed'
+        self.assertEqual(self.table.row(1)[-1], ('targetname', 'b'))
+
+    def test_written_as_entities(self):
+        text = repr(self.table)
+        self.assertEqual(text.count('entity\n{\n'), 3)
+        # Each row is written just as the Entity for it would be
+        self.assertEqual(text.split('}\n')[2] + '}\n',
+            repr(self.table.entity(2)))
+
+    def test_query(self):
+        self.assertEqual(self.map.find_by_id(3).targetname, 'c')
+        self.assertIsNone(self.map.find_by_id(4))
+        found = self.map.query(targetname='b')
+        self.assertEqual([e.properties['id'] for e in found], [2])
+        found = self.map.query(classname='info_target', where=lambda e:
+            e.origin != '0 0 0')
+        self.assertEqual([e.properties['id'] for e in found], [2, 3])
+
+    def test_column_lengths(self):
+        with self.assertRaises(ValueError):
+            vmf.EntityTable('info_target', [(0, 0, 0)],
+                properties={'targetname': ['a', 'b']})
+
+
+class ChildListTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.map = vmf.ValveMap(strict=True, limits={'connections': 4})
+        entity = vmf.Entity('logic_relay')
+        self.connections = vmf.Connections()
+        entity.children.append(self.connections)
+        self.connections.children.append(Output('OnTrigger', 'lamp', 'Toggle'))
+
+    def test_multiply(self):
+        outputs = self.connections.children
+        outputs *= 3
+        self.assertIs(self.connections.children, outputs)
+        self.assertEqual(len(outputs), 3)
+        self.assertEqual(self.map.count('connections'), 3)
+        self.assertEqual(len(self.map.fired_into('lamp')), 3)
+        outputs *= 0
+        self.assertEqual(self.map.count('connections'), 0)
+        self.assertEqual(self.map.fired_into('lamp'), [])
+
+    def test_multiply_past_limit(self):
+        outputs = self.connections.children
+        with self.assertRaises(vmf.MapLimitError):
+            outputs *= 5
+        self.assertEqual(len(outputs), 4)
+        self.assertEqual(self.map.count('connections'), 4)
+
+
+def _blocks(count):
+    for i in range(count):
+        yield Block(Vertex(i * 128, 0, 0), (64, 64, 64))
+
+
+class SourceTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'map.vmf')
+
+    def test_repr_leaves_sources_alone(self):
+        m = vmf.ValveMap()
+        m.world.add_source(_blocks(3))
+        self.assertNotIn('solid', repr(m))
+        m.write_vmf(self.filename)
+        with open(self.filename) as f:
+            self.assertEqual(f.read().count('solid\n'), 3)
+        self.assertEqual(m.stats()['brushes']['count'], 3)
+
+    def test_limit_error_rolls_back_and_keeps_old_file(self):
+        with open(self.filename, 'w') as f:
+            f.write('old')
+        m = vmf.ValveMap(strict=True, limits={'brushes': 2})
+        m.world.add_source(_blocks(3))
+        with self.assertRaises(vmf.MapLimitError):
+            m.write_vmf(self.filename)
+        self.assertEqual(m.stats()['brushes']['count'], 2)
+        self.assertEqual(m.stats()['planes']['count'], 2 * 8)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.directory), ['map.vmf'])
+
+    def test_made_as_written(self):
+        made = []
+
+        def source():
+            for block in _blocks(2):
+                made.append(block)
+                yield block
+
+        m = vmf.ValveMap()
+        detail = vmf.Entity('func_detail')
+        detail.children.append(Block().brush)
+        detail.add_source(source())
+        self.assertEqual(made, [])
+        self.assertEqual(m.stats()['brushes']['count'], 1)
+        m.write_vmf(self.filename)
+        self.assertEqual(len(made), 2)
+        # Made children come after the others, and aren't kept
+        self.assertEqual(len(detail.children), 1)
+        self.assertEqual(made[0].brush.properties['id'],
+            detail.children[0].properties['id'] + 7)
+        self.assertIsNone(made[0].brush._parent)
+        self.assertEqual(m.stats()['brushes']['count'], 3)
+        self.assertEqual(m.query_brushes(), [detail.children[0]])
+
+    def test_written_twice(self):
+        m = vmf.ValveMap()
+        m.world.add_source(list(_blocks(2)))
+        for i in range(2):
+            m.write_vmf(self.filename)
+            self.assertEqual(m.stats()['brushes']['count'], 2)
+            self.assertEqual(m.stats()['brushsides']['count'], 12)
+            self.assertEqual(m.stats()['planes']['count'], 2 * 8)
+        with open(self.filename) as f:
+            self.assertEqual(f.read().count('solid\n'), 2)
+
+    def test_not_merged(self):
+        m = vmf.ValveMap()
+        other = vmf.ValveMap()
+        other.world.add_source(_blocks(1))
+        with self.assertRaises(ValueError):
+            m.merge(other)
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        vmf.reset_ids()
+        self.other = vmf.ValveMap()
+        self.block = Block(Vertex(0, 0, 0), (64, 64, 64))
+        self.other.world.children.append(self.block)
+        self.other_door = vmf.Entity('func_door')
+        self.other_door.targetname = 'door'
+        button = vmf.Entity('func_button')
+        connections = vmf.Connections()
+        button.children.append(connections)
+        connections.children.append(Output('OnPressed', 'door', 'Open'))
+        connections.children.append(Output('OnPressed', '!self', 'Lock'))
+
+        # Made separately, so its ids are the same as the other map's
+        vmf.reset_ids()
+        self.map = vmf.ValveMap()
+        self.map.world.children.extend(_blocks(2))
+        self.door = vmf.Entity('func_door')
+        self.door.targetname = 'door'
+
+    def test_merge(self):
+        self.map.merge(self.other, offset=(0, 0, 256), prefix='b_')
+        ids = [node.properties['id'] for solid in self.map.query_brushes()
+            for node in [solid] + list(solid.children)]
+        self.assertEqual(len(ids), 3 * 7)
+        self.assertEqual(len(set(ids)), len(ids))
+        entity_ids = [entity.properties['id'] for entity in self.map.query()]
+        self.assertEqual(len(set(entity_ids)), 3)
+
+        self.assertEqual(self.block.brush.bounds(),
+            ((-32, -32, 224), (32, 32, 288)))
+        self.assertEqual(self.map.query(targetname='door'), [self.door])
+        self.assertEqual(self.map.query(targetname='b_door'),
+            [self.other_door])
+        targets = [output.target for entity_id, output in
+            self.map.fired_into(self.other_door)]
+        self.assertEqual(targets, ['b_door'])
+        self.assertEqual(self.map.missing_targets(), [])
+        self.assertEqual(self.map.count('brushes'), 3)
+        self.assertEqual(self.map.count('connections'), 2)
+
+    def test_other_map_is_left_empty(self):
+        empty = vmf.ValveMap().stats()
+        self.map.merge(self.other)
+        self.assertEqual(self.other.stats(), empty)
+        self.assertEqual(list(self.other.world.children), [])
+
+    def test_sources(self):
+        self.other.world.add_source(_blocks(2))
+        before = str(self.other)
+        with self.assertRaises(ValueError):
+            self.map.merge(self.other)
+        self.assertEqual(str(self.other), before)
+        self.assertEqual(self.map.count('brushes'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+
+Tests for the vpk module.
+
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from vmflib import keyvalues, vmf, vpk
+from vmflib.tools import Block
+
+GAMEINFO = """"GameInfo"
+{
+	game "Test"
+	FileSystem
+	{
+		SearchPaths
+		{
+			game+mod			|gameinfo_path|.
+			game				|gameinfo_path|test_textures.vpk
+			game				|all_source_engine_paths|hl2
+			game+mod			test/custom/*
+			platform			|all_source_engine_paths|platform
+		}
+	}
+}
+"""
+
+
+def _vpk(filename, files, version=1):
+    """Writes a VPK directory file listing the given paths."""
+    tree = {}
+    for path in files:
+        directory, name = os.path.split(path)
+        name, ext = name.rsplit('.', 1)
+        tree.setdefault(ext, {}).setdefault(directory or ' ', []).append(name)
+    data = b''
+    for ext, directories in sorted(tree.items()):
+        data += ext.encode('utf-8') + b'\0'
+        for directory, names in sorted(directories.items()):
+            data += directory.encode('utf-8') + b'\0'
+            for name in names:
+                data += name.encode('utf-8') + b'\0'
+                data += vpk.ENTRY.pack(0, 2, 0x7fff, 0, 0, 0xffff) + b'..'
+            data += b'\0'
+        data += b'\0'
+    data += b'\0'
+    header = vpk.HEADER.pack(vpk.SIGNATURE, version, len(data))
+    with open(filename, 'wb') as f:
+        f.write(header.ljust(vpk.HEADER_SIZES[version], b'\0') + data)
+
+
+class ReadDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'test_dir.vpk')
+        self.files = ['materials/brick/wall.vmt', 'materials/brick/wall.vtf',
+            'models/crate.mdl', 'readme.txt']
+
+    def test_read(self):
+        for version in (1, 2):
+            _vpk(self.filename, self.files, version)
+            self.assertEqual(sorted(vpk.read_directory(self.filename)),
+                sorted(self.files))
+            self.assertEqual(vpk.read_directory(self.filename, 'vmt'),
+                ['materials/brick/wall.vmt'])
+
+    def test_not_a_vpk(self):
+        for data in (b'', b'\x34\x12', struct.pack('<III', 1, 1, 0),
+                struct.pack('<III', vpk.SIGNATURE, 3, 0)):
+            with open(self.filename, 'wb') as f:
+                f.write(data)
+            with self.assertRaises(vpk.VpkError):
+                vpk.read_directory(self.filename)
+
+    def test_truncated(self):
+        _vpk(self.filename, self.files)
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        for size in range(vpk.HEADER.size, len(data)):
+            with open(self.filename, 'wb') as f:
+                f.write(data[:size])
+            with self.assertRaises(vpk.VpkError):
+                vpk.read_directory(self.filename)
+
+
+class MaterialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.gamedir = os.path.join(self.directory, 'test')
+        for path in ('test/custom/pack/materials/Custom',
+                'hl2/materials/dev'):
+            os.makedirs(os.path.join(self.directory, path))
+        with open(os.path.join(self.gamedir, 'gameinfo.txt'), 'w') as f:
+            f.write(GAMEINFO)
+        self.vpk_file = os.path.join(self.gamedir, 'test_textures_dir.vpk')
+        _vpk(self.vpk_file, ['materials/brick/wall.vmt',
+            'materials/brick/wall.vtf', 'sound/hum.wav'])
+        for path in ('test/custom/pack/materials/Custom/Sign.vmt',
+                'hl2/materials/dev/dev_measuregeneric01.vmt'):
+            with open(os.path.join(self.directory, path), 'w') as f:
+                f.write('LightmappedGeneric {}')
+        self.cache_file = os.path.join(self.directory, 'materials.json')
+
+    def test_search_paths(self):
+        directories, vpks = vpk.search_paths(self.gamedir)
+        self.assertEqual(directories, [self.gamedir,
+            os.path.join(self.directory, 'hl2'),
+            os.path.join(self.gamedir, 'custom', 'pack')])
+        self.assertEqual(vpks, [self.vpk_file])
+
+    def test_contains(self):
+        index = vpk.MaterialIndex(self.gamedir)
+        self.assertEqual(index.materials, {'brick/wall'})
+        for material in ('brick/wall', 'BRICK/Wall',
+                'materials/brick/wall.vmt', 'custom/sign',
+                'dev/dev_measuregeneric01'):
+            self.assertIn(material, index)
+        for material in ('brick/wall2', 'custom', 'dev/dev_measurewall01'):
+            self.assertNotIn(material, index)
+
+    def test_cache(self):
+        vpk.MaterialIndex(self.gamedir, self.cache_file)
+        with mock.patch.object(vpk, 'read_directory') as read_directory:
+            index = vpk.MaterialIndex(self.gamedir, self.cache_file)
+        read_directory.assert_not_called()
+        self.assertIn('brick/wall', index)
+
+        # A VPK that has changed is read again
+        _vpk(self.vpk_file, ['materials/brick/floor.vmt'])
+        os.utime(self.vpk_file, (0, 0))
+        index = vpk.MaterialIndex(self.gamedir, self.cache_file)
+        self.assertEqual(index.materials, {'brick/floor'})
+
+    def test_check(self):
+        vmf.reset_ids()
+        valve_map = vmf.ValveMap()
+        block = Block(material='brick/missing')
+        block.brush.children[0].material = 'brick/wall'
+        valve_map.world.children.append(block)
+        sprite = vmf.Entity('env_sprite')
+        sprite.properties['model'] = 'sprites/glow.vmt'
+        vmf.Entity('info_target').properties['model'] = 'models/crate.mdl'
+        index = vpk.MaterialIndex(self.gamedir)
+        missing = index.check(valve_map)
+        self.assertEqual(sorted(missing), ['brick/missing',
+            'sprites/glow.vmt'])
+        self.assertEqual(len(missing['brick/missing']), 5)
+        self.assertEqual(missing['sprites/glow.vmt'], ['entity %s '
+            '(env_sprite) model' % sprite.properties['id']])
+
+    def test_vmf_materials(self):
+        blocks = keyvalues.parse('world\n{\n"id" "1"\n"classname" '
+            '"worldspawn"\nsolid\n{\nside\n{\n"id" "2"\n"material" '
+            '"BRICK/WALL"\n}\n}\n}\nentity\n{\n"id" "3"\n"classname" '
+            '"env_smokestack"\n"SmokeMaterial" "particle/smoke.vmt"\n}\n')
+        uses = vpk.vmf_materials(blocks)
+        self.assertEqual(sorted(uses), [
+            ('BRICK/WALL', 'side 2'),
+            ('particle/smoke.vmt', 'entity 3 (env_smokestack) smokematerial')])
+        index = vpk.MaterialIndex(self.gamedir)
+        self.assertEqual(list(index.missing(uses)), ['particle/smoke.vmt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+"""
+
+Times building, indexing and writing a large map made of Blocks.
+The CPU time of the fastest of a few runs is shown for each step.
+
+Examples:
+
+  # Time 50000 Blocks with this checkout's vmflib
+  python benchmark.py
+
+  # The same with another checkout, to compare against
+  python benchmark.py --path ../../vmflib-old
+
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+
+
+def build(vmf, types, tools, count, strict):
+    """Makes a map holding count Blocks, in a grid."""
+    valve_map = vmf.ValveMap(strict=True) if strict else vmf.ValveMap()
+    for i in range(count):
+        origin = types.Vertex((i % 200) * 64, (i // 200) * 64, 0)
+        valve_map.world.children.append(
+            tools.Block(origin, (64, 64, 64), 'brick/brickwall001a'))
+    return valve_map
+
+
+def run(args):
+    from vmflib import tools, types, vmf
+    timings = {'build': [], 'index': [], 'write': []}
+    fd, filename = tempfile.mkstemp(suffix='.vmf')
+    os.close(fd)
+    try:
+        for i in range(args.repeat):
+            if hasattr(vmf, 'reset_ids'):
+                vmf.reset_ids()
+            start = time.process_time()
+            valve_map = build(vmf, types, tools, args.blocks, args.strict)
+            timings['build'].append(time.process_time() - start)
+
+            # Older versions don't index the map at all
+            if hasattr(valve_map, 'stats'):
+                start = time.process_time()
+                valve_map.stats()
+                timings['index'].append(time.process_time() - start)
+
+            if args.write:
+                start = time.process_time()
+                valve_map.write_vmf(filename)
+                timings['write'].append(time.process_time() - start)
+            # Let the next run start from a clean slate
+            del valve_map
+            vmf.ValveMap.instance = None
+            gc.collect()
+    finally:
+        os.remove(filename)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time building, indexing '
+        'and writing a map made of Blocks.')
+    parser.add_argument('-n', '--blocks', type=int, default=50000,
+        help='how many Blocks to put in the map (default: 50000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='how many times to time each step; the best time is shown '
+        '(default: 3)')
+    parser.add_argument('--strict', action='store_true',
+        help='build a strict ValveMap, checking limits as Blocks are added '
+        '(at most 8192 Blocks fit)')
+    parser.add_argument('--write', action='store_true',
+        help='also time writing the VMF')
+    parser.add_argument('--path',
+        help='import vmflib from this directory instead (to compare with '
+        'another version)')
+    args = parser.parse_args()
+
+    if args.path:
+        sys.path.insert(0, os.path.abspath(args.path))
+    if args.strict:
+        # Past the brush limit, a strict map refuses the next Block
+        from vmflib import vmf
+        limit = vmf.ENGINE_LIMITS['brushes']
+        if args.blocks > limit:
+            parser.error('--strict allows at most %d Blocks (the engine\'s '
+                'brush limit)' % limit)
+    timings = run(args)
+    import vmflib
+    print('vmflib from %s, %d Blocks' % (
+        os.path.dirname(os.path.dirname(os.path.realpath(vmflib.__file__))),
+        args.blocks))
+    for step, times in timings.items():
+        if times:
+            print('  %-6s %7.2fs' % (step, min(times)))
+
+
+if __name__ == '__main__':
+    main()
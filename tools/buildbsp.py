@@ -8,21 +8,45 @@ Examples:
 
   # Creates/installs/runs .bsp in same dir
   python buildbsp.py --game tf2 mymap.vmf
-  
+
   # Creates/installs .bsp but does not run
   python buildbsp.py --game css --no-run mymap.vmf
-  
+
   # Only create .bsp, and use fast config
   python buildbsp.py --game tf2 --no-run --no-install --fast mymap.vmf
 
+  # Build many maps at once, four compiler processes at a time
+  python buildbsp.py --game tf2 --no-install --jobs 4 variants/*.vmf
+
 """
 import argparse
+import codecs
+import hashlib
+import heapq
+import json
+import re
+import runpy
 import sys
 import os
+import queue
+import selectors
+import signal
 import subprocess
+import threading
+import time
 import webbrowser
+import zipfile
 import urllib.parse
 import shutil
+import tempfile
+import traceback
+
+from vmflib import bsp, keyvalues, vmf, vpk
+
+try:
+    from vmflib import portals      # Needs NumPy
+except ImportError:
+    portals = None
 
 
 class Game:
@@ -56,39 +80,202 @@ GAMES = {
     'hl2mp': Game(320, os.path.join("Half-Life 2 Deathmatch", "hl2mp"), False, False),
     'gm': Game(4000, os.path.join("GarrysMod", "garrysmod"), False, True),
 }
+STAGES = ['vbsp', 'vvis', 'vrad']   # Compile stages, in the order they run
+PROGRESS_INTERVAL = 5               # Seconds between progress messages
+WATCH_INTERVAL = 0.5                # Seconds between checks for changes
+WATCH_DEBOUNCE = 0.5                # Seconds a change must settle for
 
-def _make_arg_parser():
-    parser = argparse.ArgumentParser(description='Build, install, and test a VMF map.')
-    parser.add_argument('map')
-    parser.add_argument('-g', '--game', default='tf2', choices=GAMES.keys(),
-        help="selects which game to use")
-    parser.add_argument('--no-run', action="store_true",
-        help="don't run the game after building/installing")
-    parser.add_argument('--no-install', action="store_true",
-        help="don't install (or run) the map after building")
-    parser.add_argument('-f', '--fast', action="store_true",
-        help="enable fast compile options")
-    parser.add_argument('--hdr', action="store_true",
-        help="enable full HDR compile")
-    parser.add_argument('--final', action="store_true",
-        help="use with --hdr for slow high-quality HDR compile")
-    parser.add_argument('--steam-windows-path',
-        help="path to your (Windows) Steam folder (for games not dependent on SDK)")
-    parser.add_argument('--username',
-        help="your Steam username (needed for some games)")
+# Figures picked out of each compiler's log: name -> pattern whose first
+# group is the (integer) value. Where a pattern matches more than once, the
+# last match counts.
+METRICS = {
+    'vbsp': {
+        'leaked': re.compile(r'\*+ ?(leaked) ?\*+'),
+    },
+    'vvis': {
+        'portalclusters': re.compile(r'portalclusters:\s*(\d+)'),
+        'portals': re.compile(r'numportals:\s*(\d+)'),
+        'average_clusters_visible': re.compile(r'Average clusters visible:\s*(\d+)'),
+        'total_clusters_visible': re.compile(r'Total clusters visible:\s*(\d+)'),
+    },
+    'vrad': {
+        'direct_lights': re.compile(r'(\d+) direct lights'),
+        'bounces': re.compile(r'Bounce #(\d+)'),
+    },
+}
+# Compiler output that means the build is going to fail (or be useless), so
+# it's stopped straight away: (pattern, message made with the match groups)
+FATAL = [
+    (re.compile(r'\*+ ?leaked ?\*+', re.I),
+        "The map leaked; load %(map)s.lin in Hammer to find the hole."),
+    (re.compile(r'Material not found!?:?\s*(\S+)', re.I),
+        "Material not found: %(1)s"),
+    (re.compile(r'(MAX_MAP_\w+)'),
+        "The map is over the engine's %(1)s limit."),
+]
+PROGRESS = re.compile(r'(10|\d)\.\.\.|\.\.\.(10)\b')     # 0...1...2... bars
+ELAPSED = re.compile(r'(?:(\d+) hours?,\s*)?(?:(\d+) minutes?,\s*)?(\d+) seconds? elapsed')
 
-    return parser
+# Entities that only VRAD cares about; changing them doesn't need VBSP or VVIS
+LIGHT_CLASSES = ('light', 'light_spot', 'light_environment')
 
-def main():
-    parser = _make_arg_parser()
-    args = parser.parse_args()
+
+class Toolchain:
+    """Where the compilers and the game live, and how to run the compilers"""
+    def __init__(self, game, gamedir, mapsdir, toolsdir, env=None, cwd=None,
+            wine=False, to_native=None, steambin=None, local_gamedir=None):
+        self.game = game
+        self.gamedir = gamedir      # Game directory, as the compilers see it
+        self.local_gamedir = local_gamedir or gamedir   # ...and as we see it
+        self.mapsdir = mapsdir      # Where built maps are installed
+        self.toolsdir = toolsdir
+        self.env = env              # Environment for the compilers (or None)
+        self.cwd = cwd              # Working directory for the compilers
+        self.wine = wine            # Run the compilers through wine
+        self.to_native = to_native or (lambda path: path)
+        self.steambin = steambin    # Steam executable, for error hints
+
+    def command(self, stage, mappath, args, threads=None):
+        """Returns the command line for running one compile stage"""
+        opts = [os.path.join(self.toolsdir, stage + ".exe")]
+        if self.wine:
+            opts.insert(0, 'wine')
+        if threads:
+            opts.extend(['-threads', str(threads)])
+        if stage == 'vvis' and args.fast:
+            opts.append('-fast')
+        if stage == 'vrad':
+            if args.fast:
+                opts.extend(['-bounce', '2', '-noextra'])
+            if args.hdr:
+                opts.append('-both')
+            if args.hdr and args.final:
+                opts.append('-final')
+        opts.extend(['-game', self.gamedir, mappath])
+        return opts
+
+    def prepare(self, paths):
+        """Converts a batch of paths to native ones ahead of time"""
+        convert = getattr(self.to_native, 'convert', None)
+        if convert:
+            convert(paths)
+
+    def explain(self, stage, code):
+        """Returns a hint about why a stage exited with the given status"""
+        if stage == 'vbsp' and code == 1:
+            if self.wine:
+                return ("Looks like VBSP crashed, possibly due to invalid geometry in the map. Check the output above.\n" +
+                    "It could also be related to SteamService isn't working. Try re(launching) wine's Steam:\n" +
+                    '\nWINEPREFIX="%s" wine "%s" -no-dwrite' % (self.env['WINEPREFIX'], self.steambin))
+            return "Looks like SteamService isn't working. Try reopening Steam."
+        elif stage == 'vbsp' and code == -11:
+            return ("Looks like you might have gotten the 'material not found' " +
+                "error messages. Try signing into Steam, or restarting it " +
+                "and signing in.")
+        return "Looks like %s crashed, but I'm not sure why." % stage.upper()
+
+
+class WinePaths:
+    """Converts Unix paths to the Windows paths that programs in wine see.
+
+    Where the wine prefix's drive mappings (the links in its dosdevices
+    directory) can be read, paths are converted here, the way winepath
+    would. Otherwise winepath is run, once for all the paths given to
+    convert(), and its answers are saved in a file in cache_dir for next
+    time. That file belongs to the prefix, and is ignored once the prefix's
+    drives change.
+
+    """
+    def __init__(self, env, cache_dir=None):
+        self.env = env
+        self.prefix = os.path.abspath(env['WINEPREFIX'])
+        self.lock = threading.Lock()
+        self.drives = self._read_drives()
+        self.known = {}
+        self.cache_file = None
+        if cache_dir:
+            name = hashlib.sha256(self.prefix.encode('utf-8')).hexdigest()[:16]
+            self.cache_file = os.path.join(cache_dir, 'winepath-%s.json' % name)
+            try:
+                with open(self.cache_file) as f:
+                    saved = json.load(f)
+                if saved.get('drives') == self._stamp():
+                    self.known = saved['paths']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def _stamp(self):
+        """Returns something that changes whenever the drive mappings do"""
+        try:
+            return os.stat(os.path.join(self.prefix, 'dosdevices')).st_mtime
+        except OSError:
+            return None
+
+    def _read_drives(self):
+        """Returns (Unix directory, drive letter) for each drive, deepest first"""
+        dosdevices = os.path.join(self.prefix, 'dosdevices')
+        drives = []
+        try:
+            names = os.listdir(dosdevices)
+        except OSError:
+            return drives
+        for name in names:
+            target = os.path.realpath(os.path.join(dosdevices, name))
+            if re.match(r'^[a-z]:$', name) and os.path.isdir(target):
+                drives.append((target, name.upper()))
+        drives.sort(key=lambda drive: (-len(drive[0]), drive[1]))
+        return drives
+
+    def _from_drives(self, path):
+        path = os.path.realpath(path)
+        for target, letter in self.drives:
+            relative = os.path.relpath(path, target)
+            if relative == os.curdir:
+                return letter + '\\'
+            if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+                return letter + '\\' + relative.replace(os.sep, '\\')
+        return None
+
+    def convert(self, paths):
+        """Returns the Windows version of each of a list of Unix paths"""
+        paths = [os.path.abspath(path) for path in paths]
+        with self.lock:
+            missing = []
+            for path in paths:
+                if path not in self.known:
+                    converted = self._from_drives(path)
+                    if converted:
+                        self.known[path] = converted
+                    elif path not in missing:
+                        missing.append(path)
+            if missing:
+                output = subprocess.check_output(["winepath", '-w'] + missing,
+                    env=self.env, universal_newlines=True)
+                self.known.update(zip(missing, output.splitlines()))
+                self._save()
+            return [self.known[path] for path in paths]
+
+    def __call__(self, path):
+        return self.convert([path])[0]
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        temp = self.cache_file + '.%d.tmp' % os.getpid()
+        try:
+            # This can run before main() has made the cache directory
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(temp, 'w') as f:
+                json.dump({'drives': self._stamp(), 'paths': self.known}, f)
+            os.replace(temp, self.cache_file)
+        except OSError:
+            pass
+
+
+def find_toolchain(args):
+    """Works out where Steam, the game and its compilers are installed"""
     game = GAMES[args.game]
     username = args.username  # May be None
-    vmf_file = os.path.abspath(args.map)
-    path, filename = os.path.split(vmf_file)
-    mapname = filename[:-4]
-    mappath = os.path.join(path, mapname)
-    bsp_file = os.path.join(path, mapname + ".bsp")
     sourcesdk = None
     winsteam = args.steam_windows_path
     if not winsteam:
@@ -107,8 +294,6 @@ def main():
     elif WIN32 or CYGWIN:
         sourcesdk = os.getenv('sourcesdk')
         if CYGWIN:
-            def cygwin2dos(path):
-                return subprocess.check_output(["cygpath", '-w', '%s' % path], universal_newlines=True).strip()
             sourcesdk = subprocess.check_output(["cygpath", sourcesdk], universal_newlines=True).strip()
         sourcesdk = os.path.abspath(sourcesdk)
         steamapps = os.path.dirname(os.path.dirname(sourcesdk))
@@ -133,168 +318,988 @@ def main():
         toolsdir = os.path.join(sourcesdk, "bin", "orangebox", "bin")
     else:
         toolsdir = os.path.abspath(os.path.join(gamedir, "..", "bin"))
-    
+
     # Make sure gamedir path seems legit
     if not os.path.isfile(os.path.join(gamedir, "gameinfo.txt")):
         raise Exception("Game directory does not contain a gameinfo.txt: %s" % gamedir)
+    local_gamedir = gamedir
 
     if WIN32 or CYGWIN:
         # Convert some paths if using Cygwin
         if CYGWIN:
-            gamedir = cygwin2dos(gamedir)
-            mappath = cygwin2dos(mappath)
-
-        # Change working directory first because VBSP is dumb
-        os.chdir(os.path.join(sourcesdk, 'bin', 'orangebox'))
-
-        # Run the SDK tools
-        vbsp_exe = os.path.join(toolsdir, "vbsp.exe")
-        code = subprocess.call([vbsp_exe, '-game', gamedir, mappath])
-        print("VBSP finished with status %s." % code)
-
-        if code == 1:
-            print("Looks like SteamService isn't working. Try reopening Steam.")
-            exit(code)
-        elif code == -11:
-            print("Looks like you might have gotten the 'material not found' " +
-                "error messages. Try signing into Steam, or restarting it " +
-                "and signing in.")
-            exit(code)
-        elif code != 0:
-            print("Looks like VBSP crashed, but I'm not sure why.")
-            exit(code)
-
-        vvis_exe = os.path.join(toolsdir, "vvis.exe")
-        opts = [vvis_exe]
-        if args.fast:
-            opts.append('-fast')
-        opts.extend(['-game', gamedir, mappath])
-        subprocess.call(opts)
-
-        vrad_exe = os.path.join(toolsdir, "vrad.exe")
-        opts = [vrad_exe]
-        if args.fast:
-            opts.extend(['-bounce', '2', '-noextra'])
-        if args.hdr:
-            opts.append('-both')
-        if args.hdr and args.final:
-            opts.append('-final')
-        opts.extend(['-game', gamedir, mappath])
-        subprocess.call(opts)
-
-        # Install the map to the game's map directory (unless --no-install)
-        if not args.no_install:
-            print("Copying map %s to %s" % (mapname, mapsdir))
-            shutil.copy(bsp_file, mapsdir)
+            def to_native(path):
+                return subprocess.check_output(["cygpath", '-w', '%s' % path], universal_newlines=True).strip()
+            gamedir = to_native(gamedir)
         else:
-            print("Not installing map")
+            to_native = None
 
-        # Launch the game (unless --no-run or --no-install)
-        if not args.no_run and not args.no_install:
-            params = urllib.parse.quote("-dev -console -allowdebug +map %s" % mapname)
-            run_url = "steam://run/%d//%s" % (game['id'], params)
-            print(run_url)
-            webbrowser.open(run_url)
-            if cygwin:
-                print("\nYou're running cygwin, so I can't launch the game for you.")
-                print("Double-click the URL above, right-click, and click 'Open'.")
-                print("Or paste the URL above into the Windows 'Run...' dialog.")
-                print("Or, just run 'map %s' in the in-game console." % mapname)
-        else:
-            print("Not launching game")
+        # Run the tools from here, because VBSP is dumb
+        cwd = None
+        if sourcesdk:
+            cwd = os.path.join(sourcesdk, 'bin', 'orangebox')
+
+        return Toolchain(game, gamedir, mapsdir, toolsdir, cwd=cwd,
+            to_native=to_native, local_gamedir=local_gamedir)
     elif LINUX:
         # Environment to use with wine calls
         env = os.environ.copy()
         env['WINEPREFIX'] = os.path.expanduser("~/.winesteam")
-        
+
         # Define path-converting helper function
-        def unix2wine(path):
-            return subprocess.check_output(["winepath", '-w', '%s' % path], env=env).strip()
-        
+        cache_dir = None
+        if not args.no_cache:
+            cache_dir = os.path.expanduser(args.cache_dir)
+        unix2wine = WinePaths(env, cache_dir)
+
         # Wine-ify some of our paths
         gamedir = unix2wine(gamedir)
-        mappath = unix2wine(mappath)
 
         # Tell wine to look for DLLs here
         #env['WINEDLLPATH'] = os.path.join(sourcesdk, "bin")
-        
+
         #print("WINEDLLPATH is as follows: ", env['WINEDLLPATH'])
 
         # Use native maps directory instead of the Wine installation's
         mapsdir = os.path.join('~', '.steam', 'steam', 'SteamApps', game.get_game_dir(username), "maps")
         mapsdir = os.path.expanduser(mapsdir)
 
-        # Change working directory first because VBSP is dumb
-        #os.chdir(os.path.join(sourcesdk, 'bin', 'orangebox'))
-        
         print("Using -game dir: %s" % gamedir)
-        
+
         # We now need to set the VPROJECT env variable
         env['VPROJECT'] = gamedir
 
-        # Run the SDK tools
-        vbsp_exe = os.path.join(toolsdir, "vbsp.exe")
-        code = subprocess.call(['wine', vbsp_exe, '-game', gamedir, mappath], env=env)
-        print("VBSP finished with status %s." % code)
-
-        # Handle various exit status codes VBPS may have returned
-        if code == 1:
-            print("\nLooks like VBSP crashed, possibly due to invalid geometry in the map. Check the output above.")
-            print("\It could also be related to SteamService isn't working. Try re(launching) wine's Steam:")
-            steambin = os.path.join(os.path.dirname(steamapps), 'steam.exe')
-            print('\nWINEPREFIX="%s" wine "%s" -no-dwrite' % (env['WINEPREFIX'], steambin))
-            exit(code)
-        elif code == -11:
-            print("\nLooks like you might have gotten the 'material not found' " +
-                "error messages. Try signing into Steam, or restarting it " +
-                "and signing in.")
-            exit(code)
-        elif code != 0:
-            print("\nLooks like VBSP crashed, but I'm not sure why.")
-            exit(code)
-
-        vvis_exe = os.path.join(toolsdir, "vvis.exe")
-        opts = ['wine', vvis_exe]
-        if args.fast:
-            opts.append('-fast')
-        opts.extend(['-game', gamedir, mappath])
-        code = subprocess.call(opts, env=env)
-
-        if code != 0:
-            print("\nLooks like VVIS crashed, but I'm not sure why.")
-            exit(code)
-
-        vrad_exe = os.path.join(toolsdir, "vrad.exe")
-        opts = ['wine', vrad_exe]
-        if args.fast:
-            opts.extend(['-bounce', '2', '-noextra'])
-        if args.hdr:
-            opts.append('-both')
-        if args.hdr and args.final:
-            opts.append('-final')
-        opts.extend(['-game', gamedir, mappath])
-        code = subprocess.call(opts, env=env)
-        
-        if code != 0:
-            print("\nLooks like VRAD crashed, but I'm not sure why.")
-            exit(code)
-
-        # Install the map to the game's map directory (unless --no-install)
-        if not args.no_install:
-            shutil.copy(bsp_file, mapsdir)
+        steambin = os.path.join(os.path.dirname(steamapps), 'steam.exe')
+        return Toolchain(game, gamedir, mapsdir, toolsdir, env=env,
+            wine=True, to_native=unix2wine, steambin=steambin,
+            local_gamedir=local_gamedir)
+    else:
+        raise OSError('Your OS is not supported yet!')
+
+
+class MapBuild:
+    """The state of one map as it moves through the compile stages"""
+    def __init__(self, vmf_file):
+        self.vmf_file = os.path.abspath(vmf_file)
+        path, filename = os.path.split(self.vmf_file)
+        self.mapname = filename[:-4]
+        self.mappath = os.path.join(path, self.mapname)
+        self.bsp_file = self.mappath + ".bsp"
+        self.log_file = self.mappath + ".buildbsp.log"
+        self.stage = 0          # Index into STAGES of the next stage to run
+        self.report_file = self.mappath + ".buildbsp.json"
+        self.stats = {}         # Status, timings etc. of each stage that has run
+        self.error = None       # Hint about why the build failed, if it did
+        self.keys = {}          # Cache key of each stage's output
+        self.cached = []        # Stages whose output came from the cache
+        self.relit_from = None  # Key of the VVIS output patched with new lights
+        self.settings = None    # Hash of what besides the VMF shapes VVIS output
+        self.missing_materials = {}     # Material -> where the VMF uses it
+
+    @property
+    def done(self):
+        return self.error is not None or self.stage == len(STAGES)
+
+    @property
+    def ok(self):
+        return self.error is None and self.stage == len(STAGES)
+
+    def report(self):
+        """Returns everything known about the build, for a JSON report"""
+        report = {
+            'map': self.mapname,
+            'vmf': self.vmf_file,
+            'bsp': self.bsp_file,
+            'ok': self.ok,
+            'error': self.error,
+            'cached': self.cached,
+            'lights_patched': self.relit_from is not None,
+            'missing_materials': self.missing_materials,
+            'stages': self.stats,
+            'wall_time': sum(s['wall_time'] for s in self.stats.values()),
+        }
+        if self.ok:
+            try:
+                with bsp.BspFile(self.bsp_file) as bsp_file:
+                    report['bsp_size'] = len(bsp_file.data)
+                    report['bsp_counts'] = bsp_file.counts()
+                    report['bsp_limits'] = bsp_file.stats()
+            except (OSError, bsp.BspError):
+                pass
+        if self.ok and portals and os.path.isfile(self.mappath + '.prt'):
+            try:
+                prt = portals.read_prt(self.mappath + '.prt')
+            except (OSError, ValueError):
+                prt = None
+            if prt:
+                report['portals'] = prt.summary()
+                report['portals']['hotspots'] = [{
+                    'mins': hotspot.mins,
+                    'maxs': hotspot.maxs,
+                    'portals': hotspot.portals,
+                    'clusters': hotspot.clusters,
+                } for hotspot in portals.hotspots(prt, count=5)]
+        return report
+
+
+class BuildCache:
+    """Compiled maps, stored by a hash of everything that went into them.
+
+    The key of each stage's output is a hash of the key of the stage before
+    it (or of the VMF itself, for VBSP), the stage's command line options
+    and game directory, and the compiler's binary. So when a map is rebuilt
+    without any of those changing, the latest stage whose output is cached
+    is restored and only the stages after it have to run. Once the cache
+    is bigger than max_size bytes, the entries used least recently are
+    deleted.
+
+    """
+    OUTPUTS = ['.bsp', '.prt']      # Files stored after each stage
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.tool_hashes = {}
+
+    def _tool_hash(self, path):
+        """Returns a hash of a compiler binary, reusing it until it changes"""
+        try:
+            info = os.stat(path)
+        except OSError:
+            return path
+        stamp = (path, info.st_size, info.st_mtime)
+        if stamp not in self.tool_hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self.tool_hashes[stamp] = digest.hexdigest()
+        return self.tool_hashes[stamp]
+
+    def set_keys(self, build, toolchain, args):
+        """Works out the cache key of each of a map's stages"""
+        digest = hashlib.sha256()
+        with open(build.vmf_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        key = digest.hexdigest()
+        # The same, leaving out the VMF, for the stages up to VVIS
+        settings = hashlib.sha256()
+        for stage in STAGES:
+            # The map's own path and -threads don't change the output
+            opts = "\0".join(toolchain.command(stage, '', args))
+            tool = self._tool_hash(os.path.join(toolchain.toolsdir,
+                stage + ".exe"))
+            digest = hashlib.sha256(key.encode('utf-8'))
+            digest.update(opts.encode('utf-8'))
+            digest.update(tool.encode('utf-8'))
+            key = build.keys[stage] = digest.hexdigest()
+            if STAGES.index(stage) <= STAGES.index('vvis'):
+                settings.update(opts.encode('utf-8') + b"\0")
+                settings.update(tool.encode('utf-8') + b"\0")
+        build.settings = settings.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _record(self, build):
+        """Returns the directory remembering a map's last good build"""
+        name = hashlib.sha256(build.vmf_file.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'last', name)
+
+    def remember(self, build):
+        """Records the VMF and VVIS output of a map that built successfully"""
+        base = build.relit_from or build.keys['vvis']
+        if not os.path.isdir(self._entry(base)):
+            return
+        record = self._record(build)
+        os.makedirs(record, exist_ok=True)
+        shutil.copy(build.vmf_file, os.path.join(record, 'map.vmf'))
+        with open(os.path.join(record, 'vvis.key'), 'w') as f:
+            f.write(base)
+        with open(os.path.join(record, 'settings.key'), 'w') as f:
+            f.write(build.settings)
+
+    def relight(self, build):
+        """Reuses a map's last VVIS output if only its lights have changed.
+
+        The new VMF is compared with the one last built; if the only
+        differences are in light entities, those are swapped into the entity
+        lump of the old post-VVIS BSP, leaving just VRAD to run. The options,
+        game and compilers used up to VVIS have to be the same as last time
+        too, or the map is built from scratch.
+
+        """
+        record = self._record(build)
+        try:
+            with open(os.path.join(record, 'settings.key')) as f:
+                if f.read().strip() != build.settings:
+                    return False
+            with open(os.path.join(record, 'vvis.key')) as f:
+                base = f.read().strip()
+            with open(os.path.join(record, 'map.vmf')) as f:
+                old_lights, old_rest = _split_lights(f.read())
+            with open(build.vmf_file) as f:
+                new_lights, new_rest = _split_lights(f.read())
+        except (OSError, ValueError):
+            return False
+        if old_rest != new_rest:
+            return False
+
+        entry = self._entry(base)
+        try:
+            with open(os.path.join(entry, 'map.bsp'), 'rb') as f:
+                data = f.read()
+            entities = [entity for entity in bsp.read_entities(data)
+                if entity.get('classname') not in LIGHT_CLASSES]
+            entities.extend(_light_keyvalues(light) for light in new_lights)
+            data = bsp.replace_lump(data, bsp.ENTITIES,
+                bsp.format_entities(entities))
+            with open(build.bsp_file, 'wb') as f:
+                f.write(data)
+            if os.path.isfile(os.path.join(entry, 'map.prt')):
+                shutil.copy(os.path.join(entry, 'map.prt'),
+                    build.mappath + '.prt')
+            os.utime(entry)
+        except (OSError, ValueError, bsp.BspError):
+            return False
+        build.stage = STAGES.index('vrad')
+        build.cached = STAGES[:build.stage]
+        build.relit_from = base
+        return True
+
+    def restore(self, build):
+        """Copies the output of a map's latest cached stage into place"""
+        for i in reversed(range(len(STAGES))):
+            entry = self._entry(build.keys[STAGES[i]])
+            try:
+                for ext in self.OUTPUTS:
+                    if os.path.isfile(os.path.join(entry, 'map' + ext)):
+                        shutil.copy(os.path.join(entry, 'map' + ext),
+                            build.mappath + ext)
+                os.utime(entry)     # Mark it as recently used
+            except OSError:
+                continue            # Not cached (or evicted meanwhile)
+            build.stage = i + 1
+            build.cached = STAGES[:i + 1]
+            return True
+        return False
+
+    def store(self, build, stage):
+        """Saves the output of a stage that has just finished"""
+        entry = self._entry(build.keys[stage])
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            for ext in self.OUTPUTS:
+                if os.path.isfile(build.mappath + ext):
+                    shutil.copy(build.mappath + ext,
+                        os.path.join(temp, 'map' + ext))
+            os.rename(temp, entry)
+        except OSError:
+            shutil.rmtree(temp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits"""
+        with self.lock:
+            entries = []
+            for prefix in os.scandir(self.directory):
+                if not prefix.is_dir():
+                    continue
+                for entry in os.scandir(prefix.path):
+                    try:
+                        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                        entries.append((entry.stat().st_mtime, size, entry.path))
+                    except OSError:
+                        pass
+            total = sum(size for used, size, path in entries)
+            for used, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+class OutputMonitor:
+    """Watches a compiler's output as it arrives.
+
+    Everything is passed through to out. Lines matching one of the FATAL
+    patterns set fatal to a message saying what went wrong, and progress
+    bars (the compilers print 0...1...2... up to 10 for each phase) are
+    reported to on_progress(phase, percent) as they grow.
+
+    """
+    def __init__(self, out, mapname, on_progress=None, fatal=FATAL):
+        self.out = out
+        self.mapname = mapname
+        self.on_progress = on_progress
+        self.patterns = fatal
+        self.fatal = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.chunks = []
+        self.line = ''          # The line being written, so far
+        self.percent = None
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        self.out.write(text)
+        self.out.flush()
+        self.chunks.append(text)
+        lines = (self.line + text).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            self._check(line)
+            if self.percent is not None or PROGRESS.search(line):
+                self._progress(line, 100)
+            self.percent = None
+        bars = PROGRESS.findall(self.line)
+        if bars:
+            self._progress(self.line, int(bars[-1][0] or bars[-1][1]) * 10)
+
+    def close(self):
+        self.feed(self.decoder.decode(b'', final=True).encode('utf-8'))
+        self._check(self.line)
+
+    def text(self):
+        return ''.join(self.chunks)
+
+    def _check(self, line):
+        if self.fatal:
+            return
+        for pattern, message in self.patterns:
+            match = pattern.search(line)
+            if match:
+                groups = dict((str(i + 1), g) for i, g in enumerate(match.groups()))
+                groups['map'] = self.mapname
+                self.fatal = message % groups
+                return
+
+    def _progress(self, line, percent):
+        if percent != self.percent:
+            self.percent = percent
+            if self.on_progress:
+                phase = line.split('0...')[0].strip(' .:\r') or 'Working'
+                self.on_progress(phase, percent)
+
+
+def _kill(process):
+    """Kills a compiler, along with anything it has started"""
+    # Only _call() reaps the compiler, so it gets the resource usage; that
+    # means not calling poll() (or send_signal(), which polls) here.
+    if process.returncode is not None:
+        return
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass                # Everything in the session has exited
+    else:
+        process.kill()
+
+
+def _read_output(process, monitor):
+    """Feeds a process's output to a monitor, killing it on a fatal error"""
+    fd = process.stdout.fileno()
+    selector = None
+    if os.name == 'posix':
+        # Read whatever has arrived, without waiting for lines to finish
+        os.set_blocking(fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+    while True:
+        if selector:
+            selector.select()
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
         else:
+            data = os.read(fd, 65536)
+        if not data:
+            break
+        monitor.feed(data)
+        if monitor.fatal:
+            _kill(process)
+            break
+    monitor.close()
+    if selector:
+        selector.close()
+    process.stdout.close()
+
+
+def _call(opts, monitor=None, started=None, **kwargs):
+    """Runs a command, returning its exit status and resource usage.
+
+    If a monitor is given, the command's output goes through it, and
+    started(process) is called once the command is running. The usage
+    (from wait4) is a resource.struct_rusage, or None on systems without
+    wait4.
+
+    """
+    if monitor:
+        kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if os.name == 'posix':
+        kwargs['start_new_session'] = True     # So _kill() gets its children
+    process = subprocess.Popen(opts, **kwargs)
+    if started:
+        started(process)
+    if monitor:
+        _read_output(process, monitor)
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Something else reaped it; Popen knows the status, but not the usage
+        return process.wait(), None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage
+
+
+def parse_metrics(stage, text):
+    """Picks the figures in METRICS out of a compiler's output"""
+    metrics = {}
+    for name, pattern in METRICS[stage].items():
+        values = pattern.findall(text)
+        if values:
+            value = values[-1]
+            metrics[name] = int(value) if value.isdigit() else True
+    match = None
+    for match in ELAPSED.finditer(text):
+        pass
+    if match:
+        hours, minutes, seconds = [int(g or 0) for g in match.groups()]
+        metrics['reported_time'] = hours * 3600 + minutes * 60 + seconds
+    return metrics
+
+
+def _split_lights(text):
+    """Splits the blocks of a VMF into (light entities, everything else)"""
+    lights = []
+    rest = []
+    for block in keyvalues.parse(text):
+        if block.name == 'entity' and block.get('classname') in LIGHT_CLASSES:
+            lights.append(block)
+        else:
+            rest.append(block)
+    return lights, rest
+
+
+def _light_keyvalues(entity):
+    """Returns the entity lump keyvalues VBSP would write for a VMF entity"""
+    pairs = [(key, value) for key, value in entity.pairs if key != 'id']
+    if entity.get('id') is not None:
+        pairs.append(('hammerid', entity.get('id')))
+    for child in entity.children:
+        if child.name == 'connections':
+            pairs.extend(child.pairs)
+    return pairs
+
+
+class Scheduler:
+    """Runs the compile stages of many maps, several processes at a time.
+
+    Each map's stages run in order, but stages of different maps overlap,
+    so one map's VBSP runs while another's VRAD does. Stages of maps that
+    are further along are started first, so finished maps come out steadily
+    instead of all at the end.
+
+    """
+    def __init__(self, toolchain, args, jobs=1, threads=None, log=False,
+            cache=None, abort=True, materials=None, reports=False):
+        self.toolchain = toolchain
+        self.args = args
+        self.jobs = jobs            # Most compiler processes to run at once
+        self.threads = threads      # -threads passed to each compiler
+        self.log = log              # Send output to each map's log file
+        self.cache = cache          # BuildCache to reuse outputs from
+        self.abort = abort          # Stop a map's build on fatal output
+        self.materials = materials  # vpk.MaterialIndex to check VMFs with
+        self.reports = reports      # Write each map's <mapname>.buildbsp.json
+        self.finished = queue.Queue()
+        self.processes = set()      # Compilers running right now
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def run(self, builds, on_done=None):
+        """Builds every map, calling on_done(build) as each one finishes"""
+        self.toolchain.prepare([build.mappath for build in builds])
+        ready = []
+        for order, build in enumerate(builds):
+            if self.materials:
+                self._check_materials(build)
+            if self.cache and not build.done:
+                self.cache.set_keys(build, self.toolchain, self.args)
+                if self.cache.restore(build):
+                    print("%s: Reusing cached %s output." % (build.mapname,
+                        build.cached[-1].upper()))
+                elif self.cache.relight(build):
+                    print("%s: Only lights have changed; reusing VVIS output." %
+                        build.mapname)
+            if build.done:
+                self._finish(build, on_done)
+            else:
+                ready.append((-build.stage, order, build))
+        heapq.heapify(ready)
+        try:
+            self._schedule(ready, on_done)
+        except KeyboardInterrupt:
+            # The compilers run in their own sessions, so don't get the ^C
+            self.cancel()
+            raise
+        return builds
+
+    def cancel(self):
+        """Stops every build, killing the compilers that are running"""
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                _kill(process)
+
+    def _check_materials(self, build):
+        """Fails a build before VBSP runs if the game lacks its materials"""
+        try:
+            with open(build.vmf_file) as f:
+                uses = vpk.vmf_materials(keyvalues.parse(f.read()))
+        except (OSError, ValueError):
+            return              # Leave it to VBSP to complain
+        build.missing_materials = self.materials.missing(uses)
+        if build.missing_materials:
+            names = sorted(build.missing_materials)
+            build.error = "Materials not found: %s" % ", ".join(names[:5])
+            if len(names) > 5:
+                build.error += " and %d more" % (len(names) - 5)
+
+    def _schedule(self, ready, on_done):
+        running = 0
+        while ready or running:
+            if self.cancelled:
+                for priority, order, build in ready:
+                    build.error = "Cancelled."
+                    self._finish(build, on_done)
+                ready = []
+            while ready and running < self.jobs:
+                priority, order, build = heapq.heappop(ready)
+                thread = threading.Thread(target=self._run_stage,
+                    args=(build, order))
+                thread.daemon = True
+                thread.start()
+                running += 1
+
+            build, order = self.finished.get()
+            running -= 1
+            if build.done:
+                self._finish(build, on_done)
+            else:
+                heapq.heappush(ready, (-build.stage, order, build))
+
+    def _started(self, process):
+        with self.lock:
+            self.processes.add(process)
+            if self.cancelled:
+                _kill(process)
+
+    def _finish(self, build, on_done):
+        if build.ok and self.cache:
+            self.cache.remember(build)
+        if self.reports:
+            with open(build.report_file, 'w') as f:
+                json.dump(build.report(), f, indent=2)
+        if on_done:
+            on_done(build)
+
+    def _run_stage(self, build, order):
+        stage = STAGES[build.stage]
+        opts = self.toolchain.command(stage, self.toolchain.to_native(build.mappath),
+            self.args, self.threads)
+        def on_progress(phase, percent):
+            now = time.time()
+            if percent == 100 or now - last_progress[0] >= PROGRESS_INTERVAL:
+                last_progress[0] = now
+                print("%s: %s %s %d%%" % (build.mapname, stage.upper(),
+                    phase, percent))
+        last_progress = [0]
+
+        start = time.time()
+        usage = None
+        monitor = None
+        out = None
+        try:
+            if self.log:
+                out = open(build.log_file, 'a' if build.stats else 'w')
+                out.write("\n==> %s\n" % " ".join(opts))
+            else:
+                out = sys.stdout
+            # Progress is shown anyway when the output goes to the console
+            monitor = OutputMonitor(out, build.mapname,
+                on_progress if self.log else None,
+                FATAL if self.abort else [])
+            code, usage = _call(opts, monitor, self._started,
+                env=self.toolchain.env, cwd=self.toolchain.cwd)
+        except OSError as e:
+            code = None
+            build.error = "Couldn't run %s: %s" % (stage.upper(), e)
+        finally:
+            if self.log and out:
+                out.close()
+            with self.lock:
+                self.processes = set(p for p in self.processes
+                    if p.returncode is None)
+
+        stats = build.stats[stage] = {
+            'exit_code': code,
+            'wall_time': time.time() - start,
+            'threads': self.threads,
+        }
+        if usage:
+            stats['user_time'] = usage.ru_utime
+            stats['system_time'] = usage.ru_stime
+            stats['max_rss_kb'] = usage.ru_maxrss
+        if monitor:
+            stats['metrics'] = parse_metrics(stage, monitor.text())
+            if monitor.fatal:
+                stats['aborted'] = monitor.fatal
+                build.error = "Stopped %s early. %s" % (stage.upper(),
+                    monitor.fatal)
+        if self.cancelled:
+            build.error = "Cancelled."
+
+        print("%s: %s finished with status %s." % (build.mapname, stage.upper(), code))
+        if code != 0 and build.error is None:
+            build.error = self.toolchain.explain(stage, code)
+        elif code == 0 and self.cache and build.error is None:
+            self.cache.store(build, stage)
+        build.stage += 1
+        self.finished.put((build, order))
+
+
+def install_map(toolchain, build):
+    print("Copying map %s to %s" % (build.mapname, toolchain.mapsdir))
+    shutil.copy(build.bsp_file, toolchain.mapsdir)
+
+
+def launch_game(toolchain, mapname):
+    params = urllib.parse.quote("-dev -console -allowdebug +map %s" % mapname)
+    run_url = "steam://run/%d//%s" % (toolchain.game.id, params)
+    print(run_url)
+    webbrowser.open(run_url)
+    if CYGWIN:
+        print("\nYou're running cygwin, so I can't launch the game for you.")
+        print("Double-click the URL above, right-click, and click 'Open'.")
+        print("Or paste the URL above into the Windows 'Run...' dialog.")
+        print("Or, just run 'map %s' in the in-game console." % mapname)
+
+
+def _exit_status(code):
+    """Returns the status to exit with when a stage failed with code"""
+    if code is not None and code < 0:
+        return 128 - code       # Killed by a signal; report it as shells do
+    if not code or code > 255:
+        return 1                # Wouldn't survive being cut to 8 bits
+    return code
+
+
+def print_summary(builds, elapsed):
+    print("\nBuilt %d of %d maps in %.1fs:" % (
+        sum(build.ok for build in builds), len(builds), elapsed))
+    for build in builds:
+        stages = " ".join("%s cached" % stage for stage in build.cached)
+        if build.relit_from:
+            stages = "lights patched"
+
+        stages = " ".join([stages] + ["%s %.1fs" % (stage,
+            build.stats[stage]['wall_time'])
+            for stage in STAGES if stage in build.stats]).strip()
+        if build.ok:
+            print("  ok      %s (%s)" % (build.mapname, stages))
+        else:
+            print("  FAILED  %s (%s)" % (build.mapname, stages))
+            print("          %s" % build.error.replace("\n", "\n          "))
+            if os.path.isfile(build.log_file):
+                print("          See %s" % build.log_file)
+
+
+def write_report(filename, builds, elapsed, settings):
+    """Writes a JSON report on a whole batch of builds"""
+    reports = [build.report() for build in builds]
+    totals = {}
+    for stage in STAGES:
+        runs = [r['stages'][stage] for r in reports if stage in r['stages']]
+        totals[stage] = {
+            'runs': len(runs),
+            'cached': sum(stage in r['cached'] for r in reports),
+            'failed': sum(run['exit_code'] != 0 for run in runs),
+        }
+        for key in ['wall_time', 'user_time', 'system_time']:
+            totals[stage][key] = sum(run.get(key, 0) for run in runs)
+        totals[stage]['max_rss_kb'] = max([run.get('max_rss_kb', 0)
+            for run in runs] or [0])
+    slowest = sorted(reports, key=lambda r: -r['wall_time'])[:10]
+    report = {
+        'settings': settings,
+        'elapsed': elapsed,
+        'maps': len(reports),
+        'ok': sum(r['ok'] for r in reports),
+        'failed': [r['map'] for r in reports if not r['ok']],
+        'stages': totals,
+        'slowest': [(r['map'], r['wall_time']) for r in slowest],
+        'builds': reports,
+    }
+    print("Writing report to: %s" % filename)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def run_generator(script):
+    """Runs a map generator script in this process.
+
+    Returns the VMF files it wrote, or None if it failed. Ids are reset
+    first, so an unchanged script writes an unchanged VMF.
+
+    """
+    written = []
+    write_vmf = vmf.ValveMap.write_vmf
+
+    def recording_write_vmf(self, filename):
+        write_vmf(self, filename)
+        written.append(os.path.abspath(filename))
+
+    vmf.reset_ids()
+    vmf.ValveMap.write_vmf = recording_write_vmf
+    argv = sys.argv
+    sys.argv = [script]
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code:
+            print("%s exited with status %s." % (script, e.code))
+            return None
+    except Exception:
+        traceback.print_exc()
+        return None
+    finally:
+        vmf.ValveMap.write_vmf = write_vmf
+        sys.argv = argv
+    return sorted(set(written))
+
+
+def _stamp(path):
+    try:
+        info = os.stat(path)
+        return info.st_mtime_ns, info.st_size
+    except OSError:
+        return None
+
+
+def watch(scripts, make_scheduler, on_done):
+    """Reruns generator scripts when they change, and rebuilds their maps.
+
+    The scripts run in this process, so vmflib stays imported between runs.
+    Each changed script's running build (if any) is cancelled before it is
+    run again, since its output is about to be replaced. What the new build
+    has to do is up to the cache: an unchanged VMF is restored from it, a
+    change to lights only reruns VRAD, and anything else is built in full.
+
+    """
+    scripts = [os.path.abspath(script) for script in scripts]
+    stamps = dict((script, None) for script in scripts)
+    running = {}        # Script -> (Scheduler, Thread) of its latest build
+    print("Watching %s for changes. Press Ctrl+C to stop." % ", ".join(scripts))
+    try:
+        while True:
+            changed = [s for s in scripts if _stamp(s) != stamps[s]]
+            if not changed:
+                time.sleep(WATCH_INTERVAL)
+                continue
+
+            # Editors often write a file in several steps; wait for it to settle
+            latest = None
+            while latest != [_stamp(s) for s in changed]:
+                latest = [_stamp(s) for s in changed]
+                time.sleep(WATCH_DEBOUNCE)
+            stamps.update(zip(changed, latest))
+
+            for script in changed:
+                if script in running:
+                    scheduler, thread = running.pop(script)
+                    if thread.is_alive():
+                        print("Cancelling the build of %s." %
+                            os.path.basename(script))
+                        scheduler.cancel()
+                        thread.join()
+
+                print("Running %s" % script)
+                vmf_files = run_generator(script)
+                if not vmf_files:
+                    print("No maps to build; waiting for %s to change." %
+                        os.path.basename(script))
+                    continue
+                scheduler = make_scheduler(len(vmf_files))
+                builds = [MapBuild(vmf_file) for vmf_file in vmf_files]
+                thread = threading.Thread(target=scheduler.run,
+                    args=(builds, on_done))
+                thread.daemon = True
+                thread.start()
+                running[script] = (scheduler, thread)
+    except KeyboardInterrupt:
+        for scheduler, thread in running.values():
+            scheduler.cancel()
+            thread.join()
+
+
+def _make_arg_parser():
+    parser = argparse.ArgumentParser(description='Build, install, and test a VMF map.')
+    parser.add_argument('maps', nargs='+', metavar='map',
+        help="VMF files to build (or generator scripts, with --watch)")
+    parser.add_argument('-g', '--game', default='tf2', choices=GAMES.keys(),
+        help="selects which game to use")
+    parser.add_argument('--no-run', action="store_true",
+        help="don't run the game after building/installing")
+    parser.add_argument('--no-install', action="store_true",
+        help="don't install (or run) the map after building")
+    parser.add_argument('-f', '--fast', action="store_true",
+        help="enable fast compile options")
+    parser.add_argument('--hdr', action="store_true",
+        help="enable full HDR compile")
+    parser.add_argument('--final', action="store_true",
+        help="use with --hdr for slow high-quality HDR compile")
+    parser.add_argument('-j', '--jobs', type=int,
+        help="how many compiler processes to run at once when building "
+        "several maps (default: one per CPU core, up to one per map)")
+    parser.add_argument('--threads', type=int,
+        help="threads for each compiler to use (default: CPU cores divided "
+        "by --jobs)")
+    parser.add_argument('-w', '--watch', action="store_true",
+        help="treat the maps as Python scripts that generate VMFs; run them "
+        "and build their maps whenever they change")
+    parser.add_argument('--no-abort', action="store_true",
+        help="keep compiling after a leak, missing material or limit error")
+    parser.add_argument('--report', metavar='FILE',
+        help="write a JSON report on all the maps built to FILE, and one on "
+        "each map to <mapname>.buildbsp.json")
+    parser.add_argument('--cache-dir',
+        default=os.getenv('BUILDBSP_CACHE', os.path.join('~', '.cache', 'buildbsp')),
+        help="where to keep the outputs of earlier builds (default: %(default)s)")
+    parser.add_argument('--cache-size', type=int, default=4096,
+        help="most megabytes of outputs to keep in the cache (default: %(default)s)")
+    parser.add_argument('--no-cache', action="store_true",
+        help="always run every stage, and don't cache the outputs")
+    parser.add_argument('--no-material-check', action="store_true",
+        help="don't check that the game has every material a map uses "
+        "before compiling it")
+    parser.add_argument('--pack', metavar='PATH',
+        help="embed files in each map's pakfile after building it: PATH is a "
+        "directory holding materials/, models/ and so on, or a file list in "
+        "bspzip's -addlist format")
+    parser.add_argument('--steam-windows-path',
+        help="path to your (Windows) Steam folder (for games not dependent on SDK)")
+    parser.add_argument('--username',
+        help="your Steam username (needed for some games)")
+
+    return parser
+
+
+def main():
+    parser = _make_arg_parser()
+    args = parser.parse_args()
+    toolchain = find_toolchain(args)
+    cores = os.cpu_count() or 1
+
+    def make_scheduler(count, log):
+        # Share the CPU cores between the processes running at once
+        jobs = args.jobs or min(cores, count)
+        threads = args.threads or max(1, cores // jobs)
+        return Scheduler(toolchain, args, jobs, threads, log=log,
+            cache=cache, abort=not args.no_abort, materials=materials,
+            reports=bool(args.report))
+
+    def on_done(build):
+        if build.ok and pack is not None:
+            try:
+                bsp.pack_files(build.bsp_file, pack)
+            except (OSError, bsp.BspError, zipfile.BadZipFile) as e:
+                build.error = "Couldn't pack files into the map: %s" % e
+        if not build.ok:
+            print("%s: %s" % (build.mapname, build.error))
+        elif not args.no_install:
+            install_map(toolchain, build)
+
+    pack = None
+    if args.pack:
+        try:
+            if os.path.isdir(args.pack):
+                pack = bsp.list_files(args.pack)
+            else:
+                pack = bsp.read_file_list(args.pack)
+        except (OSError, ValueError) as e:
+            parser.error("can't read --pack list: %s" % e)
+
+    cache = None
+    if not args.no_cache:
+        cache_dir = os.path.expanduser(args.cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        cache = BuildCache(cache_dir, args.cache_size * 1024 * 1024)
+        cache.evict()
+
+    materials = None
+    if not args.no_material_check:
+        cache_file = None
+        if cache:
+            name = hashlib.sha256(toolchain.local_gamedir.encode('utf-8')).hexdigest()[:16]
+            cache_file = os.path.join(cache_dir, 'materials-%s.json' % name)
+        try:
+            materials = vpk.MaterialIndex(toolchain.local_gamedir, cache_file)
+        except (OSError, ValueError, vpk.VpkError) as e:
+            print("Not checking materials: %s" % e)
+
+    if args.watch:
+        def on_built(build):
+            on_done(build)
+            if build.ok:
+                print("%s: Ready. Run 'map %s' in the game's console to "
+                    "reload it." % (build.mapname, build.mapname))
+        watch(args.maps, lambda count: make_scheduler(count, True), on_built)
+        return
+
+    builds = [MapBuild(vmf_file) for vmf_file in args.maps]
+    batch = len(builds) > 1
+    start = time.time()
+    scheduler = make_scheduler(len(builds), batch)
+    scheduler.run(builds, on_done)
+
+    elapsed = time.time() - start
+    if args.report:
+        write_report(args.report, builds, elapsed, {
+            'game': args.game,
+            'fast': args.fast,
+            'hdr': args.hdr,
+            'final': args.final,
+            'jobs': scheduler.jobs,
+            'threads': scheduler.threads,
+            'cores': cores,
+        })
+    if batch:
+        print_summary(builds, elapsed)
+    elif builds[0].ok:
+        if args.no_install:
             print("Not installing map")
 
         # Launch the game (unless --no-run or --no-install)
         if not args.no_run and not args.no_install:
-            params = urllib.parse.quote("-dev -console -allowdebug +map %s" % mapname)
-            run_url = "steam://run/%d//%s" % (game.id, params)
-            print(run_url)
-            webbrowser.open(run_url)
+            launch_game(toolchain, builds[0].mapname)
         else:
             print("Not launching game")
-    else:
-        raise OSError('Your OS is not supported yet!')
+
+    failed = [build for build in builds if not build.ok]
+    if failed:
+        stats = list(failed[0].stats.values())
+        exit(_exit_status(stats[-1]['exit_code'] if stats else None))
 
 if __name__ == '__main__':
     main()
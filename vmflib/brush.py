@@ -4,9 +4,40 @@ Classes for dealing with brushes.
 
 """
 
+import math
+
 from vmflib import types, vmf
 
 
+def plane_key(plane):
+    """Returns a hashable key identifying the infinite plane of a Plane.
+
+    Planes which coincide (regardless of which way they face) share a key.
+    Returns None for degenerate planes, whose three points are collinear.
+
+    """
+    v0, v1, v2 = plane.v0, plane.v1, plane.v2
+    ax, ay, az = v1.x - v0.x, v1.y - v0.y, v1.z - v0.z
+    bx, by, bz = v2.x - v0.x, v2.y - v0.y, v2.z - v0.z
+    nx, ny, nz = ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx
+    # Most planes face along an axis; skip the arithmetic for those
+    if not ny and not nz and nx:
+        return (1.0, 0.0, 0.0, round(float(v0.x), 2))
+    if not nx and not nz and ny:
+        return (0.0, 1.0, 0.0, round(float(v0.y), 2))
+    if not nx and not ny and nz:
+        return (0.0, 0.0, 1.0, round(float(v0.z), 2))
+    length = math.sqrt(nx * nx + ny * ny + nz * nz)
+    if length == 0:
+        return None
+    nx, ny, nz = nx / length, ny / length, nz / length
+    # Face the normal in a consistent direction so opposite sides match
+    if (nx, ny, nz) < (0, 0, 0):
+        nx, ny, nz = -nx, -ny, -nz
+    dist = nx * v0.x + ny * v0.y + nz * v0.z
+    return (round(nx, 4), round(ny, 4), round(nz, 4), round(dist, 2))
+
+
 class Solid(vmf.VmfClass):
 
     """A class representing a single brush in a map.
@@ -18,8 +49,11 @@ class Solid(vmf.VmfClass):
     """
 
     vmf_class_name = 'solid'
+    own_stats = {'brushes': 1}
     solid_count = 0
 
+    _winding = None     # Face polygons cached by geometry.compute_windings()
+
     def __init__(self):
         vmf.VmfClass.__init__(self)
         self.auto_properties = []
@@ -27,31 +61,191 @@ class Solid(vmf.VmfClass):
         self.properties['id'] = Solid.solid_count
         Solid.solid_count += 1
 
+    def bounds(self):
+        """Returns the (mins, maxs) corners of the brush's bounding box.
+
+        The box is taken from the points defining each Side's plane, which
+        is exact for brushes laid out the way Hammer (or tools.Block) does
+        it, with every plane point on a corner of the brush.
+
+        """
+        xs, ys, zs = [], [], []
+        for side in self.children:
+            for v in (side.plane.v0, side.plane.v1, side.plane.v2):
+                xs.append(v.x)
+                ys.append(v.y)
+                zs.append(v.z)
+        return (min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs))
+
+    def subtract(self, other, material=None):
+        """Returns a list of new Solids making up this brush minus other.
+
+        See csg.subtract() for details.
+
+        """
+        from vmflib import csg
+        return csg.subtract(self, other, material)
+
+    def intersect(self, other, material=None):
+        """Returns a new Solid filling the space shared with other, or None.
+
+        See csg.intersect() for details.
+
+        """
+        from vmflib import csg
+        return csg.intersect(self, other, material)
+
+    def hollow(self, thickness, material=None):
+        """Returns a list of new Solids forming the walls of this brush.
+
+        See csg.hollow() for details.
+
+        """
+        from vmflib import csg
+        return csg.hollow(self, thickness, material)
+
+    def _child_added(self, child):
+        self._winding = None
+        vmf.VmfClass._child_added(self, child)
+
+    def _child_removed(self, child):
+        self._winding = None
+        vmf.VmfClass._child_removed(self, child)
+
+
+def _side(values, parent):
+    """Makes a Side from what Side.__reduce_ex__() saved."""
+    side = Side.__new__(Side)
+    vmf.VmfClass.__init__(side)
+    (side.properties['id'], x0, y0, z0, x1, y1, z1, x2, y2, z2,
+        side._material, ux, uy, uz, ut, us, vx, vy, vz, vt, vs, side.rotation,
+        side.lightmapscale, side.smoothing_groups, plane_key) = values
+    side._plane = types.Plane(types.Vertex(x0, y0, z0),
+        types.Vertex(x1, y1, z1), types.Vertex(x2, y2, z2))
+    side.uaxis = types.Axis(ux, uy, uz, ut, us)
+    side.vaxis = types.Axis(vx, vy, vz, vt, vs)
+    side.auto_properties = list(Side._AUTO_PROPERTIES)
+    if plane_key is not None:
+        side._plane_key = plane_key
+    if parent is not None:
+        side._parent = parent
+    return side
+
 
 class Side(vmf.VmfClass):
 
     """A class representing a single side of a brush."""
 
     vmf_class_name = 'side'
+    own_stats = {'brushsides': 1}
     side_count = 0
 
+    _plane = None
+    _plane_key = None       # None until worked out; False if degenerate
+    _material = None
+
+    _AUTO_PROPERTIES = ('plane', 'material', 'uaxis', 'vaxis', 'rotation',
+        'lightmapscale', 'smoothing_groups')
+    # All that a Side may have to be pickled as a tuple by __reduce_ex__()
+    _PLAIN = frozenset(('properties', 'auto_properties', '_stats',
+        '_children', '_parent', '_plane', '_plane_key', '_material',
+        'rotation', 'lightmapscale', 'smoothing_groups', 'uaxis', 'vaxis'))
+
     def __init__(self, plane=types.Plane(), material='BRICK/BRICKFLOOR001A'):
         vmf.VmfClass.__init__(self)
-        self.plane = plane
-        self.material = material
+        self._plane = plane         # Not in a map yet, so nothing to index
+        self._material = material
         self.rotation = 0
         self.lightmapscale = 16
         self.smoothing_groups = 0
         self.uaxis = types.Axis()
         self.vaxis = types.Axis()
 
-        self.auto_properties = ['plane', 'material', 'uaxis', 'vaxis',
-            'rotation', 'lightmapscale', 'smoothing_groups']
+        self.auto_properties = list(Side._AUTO_PROPERTIES)
 
         p = self.properties
         p['id'] = Solid.solid_count
         Solid.solid_count += 1
 
+    def __reduce_ex__(self, protocol):
+        # Maps have far more Sides than anything else, so pickling them (to
+        # send between processes, say) is much quicker and smaller if the
+        # usual ones are saved as plain values
+        state = self.__dict__
+        plane, u, v = self._plane, self.uaxis, self.vaxis
+        if (type(self) is not Side or not self._PLAIN.issuperset(state) or
+                list(self.properties) != ['id'] or self._children or
+                tuple(self.auto_properties) != Side._AUTO_PROPERTIES or
+                type(plane) is not types.Plane or
+                type(u) is not types.Axis or type(v) is not types.Axis or
+                not all(type(vertex) is types.Vertex
+                    for vertex in (plane.v0, plane.v1, plane.v2))):
+            return vmf.VmfClass.__reduce_ex__(self, protocol)
+        v0, v1, v2 = plane.v0, plane.v1, plane.v2
+        return _side, ((self.properties['id'], v0.x, v0.y, v0.z,
+            v1.x, v1.y, v1.z, v2.x, v2.y, v2.z, self._material,
+            u.x, u.y, u.z, u.translate, u.scale,
+            v.x, v.y, v.z, v.translate, v.scale,
+            self.rotation, self.lightmapscale, self.smoothing_groups,
+            state.get('_plane_key')), self._parent)
+
+    @property
+    def plane(self):
+        return self._plane
+
+    @plane.setter
+    def plane(self, plane):
+        parent = self._parent
+        root = None
+        if parent is not None:
+            parent._winding = None
+            if parent._parent is not None:
+                root = vmf._root(parent)
+        if not isinstance(root, vmf.ValveMap) or not root._tracks(self):
+            # Its key is worked out when the map next needs it
+            self._plane = plane
+            self._plane_key = None
+            return
+
+        # Keep the map's count of unique planes current
+        old_plane, old_key = self._plane, self.plane_key
+        self._plane = plane
+        self._plane_key = None
+        if old_key != self.plane_key:
+            if old_key is not None:
+                root._add_plane(old_key, -1)
+            if self.plane_key is not None:
+                root._add_plane(self.plane_key, 1)
+            try:
+                root._check_limits(self)
+            except vmf.MapLimitError:
+                self.plane = old_plane
+                raise
+
+    @property
+    def material(self):
+        return self._material
+
+    @material.setter
+    def material(self, material):
+        # Keep the map's index of brushes by material current
+        parent = self._parent
+        root = None
+        if parent is not None and parent._parent is not None:
+            root = vmf._root(parent)
+        if isinstance(root, vmf.ValveMap) and root._tracks(self):
+            brush_id = self._parent.properties['id']
+            root._index_name('material', self._material, brush_id, -1)
+            root._index_name('material', material, brush_id, 1)
+        self._material = material
+
+    @property
+    def plane_key(self):
+        """The plane_key() of this side's plane (worked out when needed)."""
+        if self._plane_key is None:
+            self._plane_key = plane_key(self._plane) or False
+        return self._plane_key or None
+
 
 class Group(vmf.VmfClass):
 
@@ -73,6 +267,7 @@ class DispInfo(vmf.VmfClass):
     """A class for holding displacement map info in a Side."""
 
     vmf_class_name = 'dispinfo'
+    own_stats = {'displacements': 1}
 
     def __init__(self, power, normals, distances):
         vmf.VmfClass.__init__(self)
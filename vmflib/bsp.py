@@ -0,0 +1,654 @@
+"""
+
+Reading and patching compiled BSP files.
+
+A BSP file starts with a header giving the offset and length of each of its
+64 lumps, the blocks of data that hold the map's planes, faces, lighting
+and so on. The entity lump is plain KeyValues text, which is why entities
+can be changed without compiling the map again.
+
+BspFile memory-maps a file, so looking at its header or a single lump
+doesn't mean reading (or copying) the rest of it.
+
+"""
+
+import concurrent.futures
+import io
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zipfile
+
+from vmflib import brush, keyvalues, vmf
+
+HEADER = struct.Struct('<4si')              # Ident, version
+LUMP = struct.Struct('<iii4s')              # Offset, length, version, fourCC
+LUMP_COUNT = 64
+HEADER_SIZE = HEADER.size + LUMP_COUNT * LUMP.size + 4  # Map revision last
+_ENTITY_START = re.compile(br'(?:\A|\n)\{\n')      # How each entity begins
+
+# Lumps with special handling
+ENTITIES = 0
+GAME_LUMP = 35
+PAKFILE = 40
+
+GAME_LUMP_ENTRY = struct.Struct('<iHHii')   # Id, flags, version, offset, length
+
+# Lumps made of fixed-size items: name -> (lump index, bytes per item)
+ITEM_LUMPS = {
+    'planes': (1, 20),
+    'vertexes': (3, 12),
+    'nodes': (5, 32),
+    'texinfo': (6, 72),
+    'faces': (7, 56),
+    'luxels': (8, 4),           # LDR lighting samples
+    'leafs': (10, 32),          # 56 bytes in version 19 files
+    'models': (14, 48),
+    'brushes': (18, 12),
+    'brushsides': (19, 8),
+    'areas': (20, 8),
+    'areaportals': (21, 12),
+    'displacements': (26, 176),
+    'luxels_hdr': (53, 4),      # HDR lighting samples
+}
+LEAFS = 10
+VISIBILITY = 4
+
+# Names of the lumps, by index (as in the SDK's bspfile.h, in lower case)
+LUMP_NAMES = ['entities', 'planes', 'texdata', 'vertexes', 'visibility',
+    'nodes', 'texinfo', 'faces', 'lighting', 'occlusion', 'leafs', 'faceids',
+    'edges', 'surfedges', 'models', 'worldlights', 'leaffaces', 'leafbrushes',
+    'brushes', 'brushsides', 'areas', 'areaportals', 'propcollision',
+    'prophulls', 'prophullverts', 'proptris', 'dispinfo', 'originalfaces',
+    'physdisp', 'physcollide', 'vertnormals', 'vertnormalindices',
+    'disp_lightmap_alphas', 'disp_verts', 'disp_lightmap_sample_positions',
+    'game_lump', 'leafwaterdata', 'primitives', 'primverts', 'primindices',
+    'pakfile', 'clipportalverts', 'cubemaps', 'texdata_string_data',
+    'texdata_string_table', 'overlays', 'leafmindisttowater',
+    'face_macro_texture_info', 'disp_tris', 'physcollidesurface',
+    'wateroverlays', 'leaf_ambient_index_hdr', 'leaf_ambient_index',
+    'lighting_hdr', 'worldlights_hdr', 'leaf_ambient_lighting_hdr',
+    'leaf_ambient_lighting', 'xzippakfile', 'faces_hdr', 'map_flags',
+    'overlay_fades', 'overlay_system_levels', 'physlevel', 'disp_multiblend']
+
+# Limits of the Source engine (MAX_MAP_* in bspfile.h), on the counts from
+# count_items() and on the size in bytes of some lumps
+BSP_LIMITS = {
+    'planes': 65536,
+    'vertexes': 65536,
+    'nodes': 65536,
+    'texinfo': 12288,
+    'faces': 65536,
+    'luxels': 0x1000000 // 4,
+    'luxels_hdr': 0x1000000 // 4,
+    'leafs': 65536,
+    'models': 1024,
+    'brushes': 8192,
+    'brushsides': 65536,
+    'areas': 256,
+    'areaportals': 1024,
+    'displacements': 2048,
+    'entities': 8192,
+    'entities_bytes': 384 * 1024,       # MAX_MAP_ENTSTRING
+    'visibility_bytes': 0x1000000,      # MAX_MAP_VISIBILITY
+}
+
+
+# Entities that VBSP compiles into other lumps (or merges into the world),
+# so that they never appear in the entity lump
+COMPILED_CLASSES = ('func_detail', 'func_instance', 'func_instance_parms',
+    'func_viscluster', 'prop_static', 'info_overlay',
+    'info_overlay_transition', 'env_cubemap', 'info_no_dynamic_shadow')
+
+# Keys that VBSP writes into brush entities itself
+COMPILER_KEYS = ('model', 'hammerid', 'origin', 'portalnumber')
+
+
+class BspError(Exception):
+
+    """Raised when a file isn't a BSP that vmflib can work with."""
+
+
+def read_lumps(data):
+    """Returns the (offset, length, version, fourcc) of each lump of a BSP.
+
+    data is the whole file, as bytes or any other buffer.
+
+    """
+    if len(data) < HEADER_SIZE:
+        raise BspError("File is too short to be a BSP")
+    ident, version = HEADER.unpack_from(data, 0)
+    if ident != b'VBSP':
+        raise BspError("Not a Source engine BSP file")
+    return [LUMP.unpack_from(data, HEADER.size + i * LUMP.size)
+        for i in range(LUMP_COUNT)]
+
+
+def count_items(data):
+    """Returns how many of each kind of item (planes, leafs...) a BSP holds.
+
+    Besides the fixed-size lumps in ITEM_LUMPS, this includes the number of
+    visibility clusters (0 before VVIS has run) and of entities.
+
+    """
+    lumps = read_lumps(data)
+    version = HEADER.unpack_from(data, 0)[1]
+    counts = {}
+    for name, (index, size) in ITEM_LUMPS.items():
+        if index == LEAFS and version < 20:
+            size = 56
+        counts[name] = lumps[index][1] // size
+    offset, length = lumps[VISIBILITY][:2]
+    counts['clusters'] = struct.unpack_from('<i', data, offset)[0] \
+        if length >= 4 else 0
+    offset, length = lumps[ENTITIES][:2]
+    with memoryview(data) as view:
+        counts['entities'] = _count_entities(view[offset:offset + length])
+    return counts
+
+
+def _count_entities(lump):
+    """Counts the entities in an entity lump, without parsing or copying it."""
+    # VBSP puts each entity's braces on lines of their own
+    return sum(1 for match in _ENTITY_START.finditer(lump))
+
+
+class BspFile:
+
+    """A compiled BSP file, memory-mapped for reading.
+
+    Use it as a context manager, or call close() when done with it. data
+    is a memoryview of the whole file, and lump() returns a memoryview of
+    one lump, so neither copies anything until it is used.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except ValueError:          # Empty files can't be mapped
+            self._file.close()
+            raise BspError("File is too short to be a BSP")
+        self.data = memoryview(self._map)
+        try:
+            self.lumps = read_lumps(self.data)
+        except BspError:
+            self.close()
+            raise
+        self.version = HEADER.unpack_from(self.data, 0)[1]
+        self.revision, = struct.unpack_from('<i', self.data, HEADER_SIZE - 4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.data.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass        # Lumps are still in use; it's closed when they go
+        self._file.close()
+
+    def lump(self, index):
+        """Returns the contents of a lump (by index or name) as a memoryview."""
+        if not isinstance(index, int):
+            index = LUMP_NAMES.index(index)
+        offset, length = self.lumps[index][:2]
+        if offset < 0 or offset + length > len(self.data):
+            raise BspError("Lump %s runs past the end of the file" %
+                LUMP_NAMES[index])
+        return self.data[offset:offset + length]
+
+    def lump_sizes(self):
+        """Returns the size in bytes of every lump, by name."""
+        return dict((LUMP_NAMES[i], self.lumps[i][1])
+            for i in range(LUMP_COUNT))
+
+    def entities(self):
+        """Returns the map's entities, as keyvalues Blocks."""
+        return read_entities(self.data)
+
+    def counts(self):
+        """Returns the item counts of the map (see count_items())."""
+        return count_items(self.data)
+
+    def stats(self, limits=None):
+        """Returns how close the map is to each of the engine's limits.
+
+        Like ValveMap.stats(), this is a dict from each name in BSP_LIMITS
+        (or in limits, if given) to a dict with 'count', 'limit' and
+        'percent'. Names ending in _bytes give the size of a lump.
+
+        """
+        limits = limits or BSP_LIMITS
+        counts = self.counts()
+        sizes = self.lump_sizes()
+        result = {}
+        for name, limit in limits.items():
+            if name.endswith('_bytes'):
+                count = sizes[name[:-len('_bytes')]]
+            else:
+                count = counts[name]
+            result[name] = {'count': count, 'limit': limit,
+                'percent': 100.0 * count / limit}
+        return result
+
+
+def audit(filenames, threshold=90, limits=None):
+    """Checks many BSP files against the engine's limits.
+
+    Yields (filename, problems) for each file, where problems lists a
+    message for each limit the file is within threshold percent of (or
+    over), or for the file being unreadable.
+
+    """
+    for filename in filenames:
+        try:
+            with BspFile(filename) as bsp_file:
+                stats = bsp_file.stats(limits)
+        except (OSError, BspError) as e:
+            yield filename, [str(e)]
+            continue
+        yield filename, ['%s: %d of %d (%.0f%%)' % (name, s['count'],
+            s['limit'], s['percent']) for name, s in sorted(stats.items())
+            if s['percent'] >= threshold]
+
+
+def read_entities(data):
+    """Returns the entities in a BSP's entity lump, as keyvalues Blocks."""
+    offset, length, version, fourcc = read_lumps(data)[ENTITIES]
+    if fourcc != b'\0\0\0\0':
+        raise BspError("Compressed entity lumps aren't supported")
+    text = bytes(data[offset:offset + length]).rstrip(b'\0')
+    return keyvalues.parse(text.decode('utf-8', 'replace'))
+
+
+def format_entities(entities):
+    """Returns the contents of an entity lump holding the given entities.
+
+    entities is a list of keyvalues Blocks, or of lists of (key, value).
+
+    """
+    lines = []
+    for entity in entities:
+        lines.append('{')
+        for key, value in getattr(entity, 'pairs', entity):
+            lines.append('"%s" "%s"' % (key, value))
+        lines.append('}')
+    return ('\n'.join(lines) + '\n').encode('utf-8') + b'\0'
+
+
+def _move_game_lump(content, shift):
+    """Returns a game lump with its entries' offsets moved by shift."""
+    content = bytearray(content)
+    count, = struct.unpack_from('<i', content, 0)
+    for k in range(count):
+        at = 4 + k * GAME_LUMP_ENTRY.size
+        entry = list(GAME_LUMP_ENTRY.unpack_from(content, at))
+        if entry[3]:
+            entry[3] += shift
+        GAME_LUMP_ENTRY.pack_into(content, at, *entry)
+    return content
+
+
+def _relayout(lumps, index, length):
+    """Works out where the lumps of a BSP go once one changes length.
+
+    Returns (lump index, new offset, new length) for each lump written, in
+    file order. Lumps keep their order and are aligned to four bytes, and
+    empty ones (other than the changed one) are left where they were.
+
+    """
+    layout = []
+    position = HEADER_SIZE
+    for i in sorted(range(LUMP_COUNT), key=lambda i: lumps[i][0]):
+        size = length if i == index else lumps[i][1]
+        if not size and i != index:
+            continue
+        position += -position % 4
+        layout.append((i, position, size))
+        position += size
+    return layout
+
+
+def _rebuild(data, index, length, write, write_payload):
+    """Writes a BSP with one lump's contents replaced, a piece at a time.
+
+    data is the old file; write(bytes) is called with each piece of the
+    new one in turn, except the new contents of the lump, which
+    write_payload() is called to write (length bytes of it). The header and
+    the game lump's offsets are updated to match.
+
+    """
+    lumps = read_lumps(data)
+    layout = _relayout(lumps, index, length)
+    header = bytearray(data[:HEADER_SIZE])
+    for i, offset, size in layout:
+        version, fourcc = lumps[i][2:]
+        if i == index:
+            fourcc = b'\0\0\0\0'
+        LUMP.pack_into(header, HEADER.size + i * LUMP.size, offset, size,
+            version, fourcc)
+    write(header)
+
+    position = HEADER_SIZE
+    for i, offset, size in layout:
+        write(b'\0' * (offset - position))
+        if i == index:
+            write_payload()
+        else:
+            old_offset = lumps[i][0]
+            content = data[old_offset:old_offset + size]
+            # Game lump entries hold offsets from the start of the file
+            if i == GAME_LUMP and offset != old_offset:
+                content = _move_game_lump(content, offset - old_offset)
+            write(content)
+        position = offset + size
+
+
+def replace_lump(data, index, payload):
+    """Returns a copy of a BSP file with the contents of one lump replaced.
+
+    The lumps after it are moved to make room (keeping them aligned to four
+    bytes), and the header and the game lump's offsets are updated to
+    match.
+
+    """
+    pieces = []
+    _rebuild(data, index, len(payload), pieces.append,
+        lambda: pieces.append(payload))
+    return b''.join(bytes(piece) for piece in pieces)
+
+
+class _LumpReader(io.RawIOBase):
+
+    """A read-only, seekable file reading from a memoryview."""
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+
+def list_files(directory):
+    """Returns (name in the pakfile, path) for every file in a directory.
+
+    Names are the files' paths within directory, so it should hold the
+    game's materials/, models/ (and so on) directories.
+
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append((os.path.relpath(path, directory).replace(os.sep,
+                '/'), path))
+    return files
+
+
+def read_file_list(filename):
+    """Reads a list of files to pack in the format of bspzip's -addlist.
+
+    The list has two lines for each file: its name in the pakfile, then
+    its path on disk. Returns (name in the pakfile, path) pairs.
+
+    """
+    with open(filename) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if len(lines) % 2:
+        raise ValueError("%s has a pakfile name without a path" % filename)
+    return [(lines[i].replace('\\', '/'), lines[i + 1])
+        for i in range(0, len(lines), 2)]
+
+
+def _write_pakfile(archive, pakfile, files):
+    """Writes a pakfile holding files and the entries of an older one.
+
+    Everything is stored uncompressed, which every Source game can read.
+
+    """
+    names = set(name.lower() for name, path in files)
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as out:
+        if len(pakfile):
+            with zipfile.ZipFile(_LumpReader(pakfile)) as old:
+                for info in old.infolist():
+                    if info.filename.lower() in names:
+                        continue
+                    copy = zipfile.ZipInfo(info.filename, info.date_time)
+                    copy.file_size = info.file_size
+                    with old.open(info) as src, out.open(copy, 'w') as dst:
+                        shutil.copyfileobj(src, dst)
+        for name, path in files:
+            out.write(path, name)
+
+
+def _replace_file(filename, target, write):
+    """Writes a new version of a BSP, then moves it over target.
+
+    write(file) is called to write the new BSP, into a temporary file next
+    to target, which takes filename's permissions before being moved into
+    place. If anything goes wrong, target is left as it was.
+
+    """
+    fd, temp = tempfile.mkstemp('.bsp', dir=os.path.dirname(
+        os.path.abspath(target)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write(out)
+        shutil.copymode(filename, temp)
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def pack_files(filename, files, output=None):
+    """Embeds files in the pakfile lump of a compiled map, as bspzip does.
+
+    files is a directory (see list_files()) or a list of (name in the
+    pakfile, path on disk) pairs, like read_file_list() returns. Files
+    already in the pakfile are kept, unless one of the same name replaces
+    them.
+
+    The files are copied into the pakfile, and the pakfile into the new BSP,
+    a piece at a time, so none of them needs to fit in memory. The new BSP
+    is written to a temporary file next to output (or filename), and then
+    moved over it.
+
+    """
+    if isinstance(files, str):
+        files = list_files(files)
+
+    def write(out):
+        with BspFile(filename) as bsp_file, \
+                tempfile.TemporaryFile() as archive:
+            pakfile = bsp_file.lump(PAKFILE)
+            _write_pakfile(archive, pakfile, files)
+            pakfile.release()
+            length = archive.tell()
+            archive.seek(0)
+            _rebuild(bsp_file.data, PAKFILE, length, out.write,
+                lambda: shutil.copyfileobj(archive, out))
+    _replace_file(filename, output or filename, write)
+
+
+def pack_maps(filenames, files, jobs=None):
+    """Runs pack_files() on many maps at once, in up to jobs threads.
+
+    Yields (filename, error) for each map in turn, where error is the
+    exception packing it raised, or None.
+
+    """
+    if isinstance(files, str):
+        files = list_files(files)
+
+    def pack(filename):
+        try:
+            pack_files(filename, files)
+        except (OSError, BspError, zipfile.BadZipFile) as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for filename, error in zip(filenames, pool.map(pack, filenames)):
+            yield filename, error
+
+
+def _entity_pairs(entity):
+    """Returns the entity lump keyvalues VBSP would write for a vmf.Entity.
+
+    The entity's id becomes its hammerid, and its outputs are written as
+    ordinary keys. Brushes are left out.
+
+    """
+    pairs = []
+    for name in entity.auto_properties:
+        value = getattr(entity, name)
+        if value is not None:
+            pairs.append((name, str(value)))
+    for key, value in entity.properties.items():
+        pairs.append(('hammerid' if key == 'id' else key, str(value)))
+    for child in entity.children:
+        if isinstance(child, vmf.Connections):
+            for output in child.children:
+                pairs.append((output.event, '%s,%s,%s,%s,%s' % (output.target,
+                    output.input, output.parameter, output.delay,
+                    output.times_to_fire)))
+    return pairs
+
+
+def _brush_keys(pairs):
+    """Returns the keys of a brush entity that compiling leaves alone."""
+    return sorted((key, value) for key, value in pairs
+        if key not in COMPILER_KEYS)
+
+
+def merge_entities(entities, valve_map):
+    """Returns the entities of a compiled map, with a ValveMap's swapped in.
+
+    entities is the compiled map's entity lump, as keyvalues Blocks. The
+    result holds its worldspawn (with keys updated from the map's world)
+    and brush entities, and the map's point entities, in the map's order.
+
+    Brush entities refer to models compiled into the BSP, so they can't be
+    changed this way: a BspError is raised if the map's brush entities
+    differ from the compiled ones in anything but the keys VBSP writes
+    itself, or if any have been added or removed.
+
+    """
+    world = None
+    compiled = {}
+    for entity in entities:
+        if entity.get('classname') == 'worldspawn':
+            world = entity
+        elif entity.get('model', '').startswith('*'):
+            compiled[entity.get('hammerid')] = entity
+    if world is None:
+        raise BspError("Map has no worldspawn entity")
+
+    keys = dict((key, value) for key, value in
+        _entity_pairs(valve_map.world) if key != 'hammerid')
+    pairs = [(key, keys.pop(key, value)) for key, value in world.pairs]
+    result = [keyvalues.Block(None, pairs + list(keys.items()))]
+
+    for child in valve_map.children:
+        if (isinstance(child, vmf.EntityTable) and
+                child.classname not in COMPILED_CLASSES):
+            for i in range(len(child)):
+                pairs = [(key, str(value)) for key, value in child.row(i)]
+                pairs.append(('hammerid', str(child.first_id + i)))
+                result.append(keyvalues.Block(None, pairs))
+            continue
+        if (not isinstance(child, vmf.Entity) or
+                isinstance(child, vmf.World) or
+                child.classname in COMPILED_CLASSES):
+            continue
+        pairs = _entity_pairs(child)
+        if not any(isinstance(vmf._node(c), brush.Solid)
+                for c in child.children):
+            result.append(keyvalues.Block(None, pairs))
+            continue
+        hammerid = str(child.properties['id'])
+        entity = compiled.pop(hammerid, None)
+        if entity is None:
+            raise BspError("Brush entity %s (%s) isn't in the compiled map" %
+                (hammerid, child.classname))
+        if _brush_keys(entity.pairs) != _brush_keys(pairs):
+            raise BspError("Brush entity %s (%s) has changed since the map "
+                "was compiled" % (hammerid, child.classname))
+        result.append(entity)
+    if compiled:
+        raise BspError("Brush entity %s is no longer in the map" %
+            min(compiled))
+    return result
+
+
+def patch_entities(filename, valve_map, output=None):
+    """Rewrites the entity lump of a compiled map from a ValveMap.
+
+    Edits that only touch point entities (timers, spawns, outputs and so on)
+    don't need the map to be compiled again. See merge_entities() for how
+    the BSP's entities and the map's are combined; changes to brushes, and
+    to the entities in COMPILED_CLASSES, can't be seen in the BSP and go
+    unnoticed.
+
+    The new lump is written over the old one if it fits in the old one's
+    place. Otherwise the lumps after it are moved along, in a new BSP
+    written to a temporary file and then moved into place, as in
+    pack_files(). The result goes to output, or back to filename.
+
+    """
+    target = output or filename
+    with BspFile(filename) as bsp_file:
+        payload = format_entities(merge_entities(bsp_file.entities(),
+            valve_map))
+        offset, length, version, fourcc = bsp_file.lumps[ENTITIES]
+        room = min([o for o, l, v, c in bsp_file.lumps if o > offset and l] +
+            [len(bsp_file.data)]) - offset
+
+    if len(payload) > room:
+        def write(out):
+            with BspFile(filename) as bsp_file:
+                _rebuild(bsp_file.data, ENTITIES, len(payload), out.write,
+                    lambda: out.write(payload))
+        _replace_file(filename, target, write)
+        return
+
+    if target != filename:
+        shutil.copyfile(filename, target)
+    with open(target, 'r+b') as f:
+        f.seek(offset)
+        f.write(payload + b'\0' * (length - len(payload)))
+        f.seek(HEADER.size + ENTITIES * LUMP.size)
+        f.write(LUMP.pack(offset, len(payload), version, fourcc))
@@ -0,0 +1,428 @@
+"""
+
+Constructive solid geometry (CSG) operations on convex brushes.
+
+These work like Hammer's Carve and Make Hollow tools: a brush has another
+brush subtracted from it by splitting it along each plane of the other
+brush, keeping the pieces outside. Only planes which actually cut the brush
+produce a piece, so carving a tunnel through a block leaves four brushes
+rather than one per plane. The carve() function applies many cutters to
+many brushes, using a grid so that only overlapping pairs are compared.
+
+"""
+
+import math
+
+from vmflib import brush, types, vmf
+
+EPSILON = 0.01          # Distance (in units) within which points coincide
+MAX_COORD = 65536       # Comfortably larger than any Source map
+
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2],
+        a[0] * b[1] - a[1] * b[0])
+
+
+def _side_plane(side):
+    """Returns the outward (normal, dist) of a Side, or None if degenerate."""
+    v0, v1, v2 = side.plane.v0, side.plane.v1, side.plane.v2
+    p1 = (v1.x, v1.y, v1.z)
+    normal = _cross((v0.x - p1[0], v0.y - p1[1], v0.z - p1[2]),
+        (v2.x - p1[0], v2.y - p1[1], v2.z - p1[2]))
+    length = _dot(normal, normal) ** 0.5
+    if length == 0:
+        return None
+    normal = (normal[0] / length, normal[1] / length, normal[2] / length)
+    return normal, _dot(normal, p1)
+
+
+def _base_winding(normal, dist):
+    """Returns a huge square lying on a plane, wound around its normal."""
+    if abs(normal[2]) > 0.9:
+        helper = (1, 0, 0)
+    else:
+        helper = (0, 0, 1)
+    u = _cross(normal, helper)
+    length = _dot(u, u) ** 0.5
+    u = (u[0] / length * MAX_COORD, u[1] / length * MAX_COORD,
+        u[2] / length * MAX_COORD)
+    v = _cross(normal, u)
+    c = (normal[0] * dist, normal[1] * dist, normal[2] * dist)
+    return [tuple(c[k] + su * u[k] + sv * v[k] for k in range(3))
+        for su, sv in ((1, 1), (-1, 1), (-1, -1), (1, -1))]
+
+
+def _wind(points, normal):
+    """Sorts points on a plane counter-clockwise around its normal."""
+    if abs(normal[2]) > 0.9:
+        u = _cross(normal, (1, 0, 0))
+    else:
+        u = _cross(normal, (0, 0, 1))
+    v = _cross(normal, u)
+    count = len(points)
+    centre = [sum(p[k] for p in points) / count for k in range(3)]
+    angles = [math.atan2(_dot(v, p) - _dot(v, centre),
+        _dot(u, p) - _dot(u, centre)) for p in points]
+    return [p for a, p in sorted(zip(angles, points))]
+
+
+def _distances(points, normal, dist):
+    """Returns the distance of each point in front of (normal, dist)."""
+    nx, ny, nz = normal
+    return [nx * x + ny * y + nz * z - dist for x, y, z in points]
+
+
+def _clip(points, normal, dist, dists=None):
+    """Clips a polygon, keeping the part behind (normal, dist).
+
+    dists may give the distance of each point from the plane, if known.
+
+    """
+    if dists is None:
+        dists = _distances(points, normal, dist)
+    if max(dists) <= EPSILON:
+        return points
+    if min(dists) >= -EPSILON:
+        return []
+    result = []
+    count = len(points)
+    for i in range(count):
+        p, d = points[i], dists[i]
+        if d <= EPSILON:
+            result.append(p)
+        e = dists[i - count + 1]
+        if (d < -EPSILON and e > EPSILON) or (d > EPSILON and e < -EPSILON):
+            q = points[i - count + 1]
+            t = d / (d - e)
+            result.append((p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1]),
+                p[2] + t * (q[2] - p[2])))
+    return result if len(result) >= 3 else []
+
+
+class _Face:
+
+    """A face of a Polyhedron: its plane, polygon and the Side it copies."""
+
+    __slots__ = ('normal', 'dist', 'side', 'points')
+
+    def __init__(self, normal, dist, side, points):
+        self.normal = normal
+        self.dist = dist
+        self.side = side
+        self.points = points
+
+
+class Polyhedron:
+
+    """A convex brush held as face polygons, for CSG operations.
+
+    Each face remembers the Side whose material and texture axes it will
+    get when it is turned back into a Solid with to_solid().
+
+    """
+
+    def __init__(self, faces):
+        self.faces = faces
+        self._bounds = None
+
+    @property
+    def mins(self):
+        return self.bounds()[0]
+
+    @property
+    def maxs(self):
+        return self.bounds()[1]
+
+    def bounds(self):
+        """Returns the (mins, maxs) corners of the bounding box."""
+        if self._bounds is None:
+            coords = list(zip(*[p for face in self.faces
+                for p in face.points]))
+            self._bounds = (tuple(min(c) for c in coords),
+                tuple(max(c) for c in coords))
+        return self._bounds
+
+    @classmethod
+    def from_planes(cls, planes):
+        """Builds a Polyhedron from a list of (normal, dist, side).
+
+        Returns None if the planes don't enclose any space.
+
+        """
+        faces = []
+        for i, (normal, dist, side) in enumerate(planes):
+            points = _base_winding(normal, dist)
+            for j, (other_normal, other_dist, other_side) in \
+                    enumerate(planes):
+                if j != i and points:
+                    points = _clip(points, other_normal, other_dist)
+            if points:
+                faces.append(_Face(normal, dist, side, points))
+        if len(faces) < 4:
+            return None
+        return cls(faces)
+
+    @classmethod
+    def from_solid(cls, solid):
+        """Builds a Polyhedron from a Solid (or None if it is empty)."""
+        planes = []
+        for side in solid.children:
+            plane = _side_plane(side)
+            if plane is not None:
+                planes.append(plane + (side,))
+        return cls.from_planes(planes)
+
+    def planes(self):
+        """Returns the (normal, dist, side) of each face."""
+        return [(face.normal, face.dist, face.side) for face in self.faces]
+
+    def overlaps(self, other):
+        """Returns True if the bounding boxes of two Polyhedra overlap."""
+        for k in range(3):
+            if self.mins[k] >= other.maxs[k] - EPSILON or \
+                    other.mins[k] >= self.maxs[k] - EPSILON:
+                return False
+        return True
+
+    def split(self, normal, dist, side):
+        """Splits along a plane, returning the (front, back) Polyhedra.
+
+        Either may be None if the polyhedron lies entirely on one side.
+        The new faces made by the cut copy side.
+
+        """
+        face_dists = [_distances(face.points, normal, dist)
+            for face in self.faces]
+        if max(max(d) for d in face_dists) <= EPSILON:
+            return None, self
+        if min(min(d) for d in face_dists) >= -EPSILON:
+            return self, None
+
+        flipped = (-normal[0], -normal[1], -normal[2])
+        front, back = [], []
+        cap = {}
+        for face, dists in zip(self.faces, face_dists):
+            if max(dists) <= EPSILON:
+                back.append(face)
+            elif min(dists) >= -EPSILON:
+                front.append(face)
+            else:
+                front.append(_Face(face.normal, face.dist, face.side,
+                    _clip(face.points, flipped, -dist, [-d for d in dists])))
+                points = _clip(face.points, normal, dist, dists)
+                back.append(_Face(face.normal, face.dist, face.side, points))
+                for p, d in zip(points, _distances(points, normal, dist)):
+                    if -EPSILON <= d <= EPSILON:
+                        cap[round(p[0], 3), round(p[1], 3),
+                            round(p[2], 3)] = p
+
+        # Cap each half with the polygon where the plane cut through it
+        cap = _wind(list(cap.values()), normal)
+        back.append(_Face(normal, dist, side, cap))
+        front.append(_Face(flipped, -dist, side, cap[::-1]))
+        return Polyhedron(front), Polyhedron(back)
+
+    def subtract(self, other):
+        """Returns the list of Polyhedra making up self minus other.
+
+        Returns [self] if the two don't overlap, and [] if self lies inside
+        other.
+
+        """
+        if not self.overlaps(other):
+            return [self]
+        pieces = []
+        remaining = self
+        for normal, dist, side in other.planes():
+            front, back = remaining.split(normal, dist, side)
+            if back is None:
+                return [self]
+            if front is not None:
+                pieces.append(front)
+            remaining = back
+        return pieces
+
+    def intersect(self, other):
+        """Returns the Polyhedron shared by self and other, or None."""
+        if not self.overlaps(other):
+            return None
+        remaining = self
+        for normal, dist, side in other.planes():
+            front, remaining = remaining.split(normal, dist, side)
+            if remaining is None:
+                return None
+        return remaining
+
+    def to_solid(self, material=None):
+        """Returns a new Solid with this shape.
+
+        Each Side copies the material and texture settings of the Side its
+        face came from, unless material is given for all of them.
+
+        """
+        solid = brush.Solid()
+        sides = []
+        for face in self.faces:
+            points = face.points
+            count = len(points)
+            # Hammer lists plane points clockwise as seen from outside
+            plane = types.Plane(*[types.Vertex(*[_clean(c) for c in p])
+                for p in (points[2 * count // 3], points[count // 3],
+                    points[0])])
+            sides.append(_copy_side(face.side, plane, material))
+        solid.children.extend(sides)
+        return solid
+
+
+def _clean(c):
+    """Rounds a coordinate, turning whole numbers into ints for the VMF."""
+    if c == int(c):
+        return int(c)
+    c = round(c, 3)
+    if c == int(c):
+        return int(c)
+    return c
+
+
+def _copy_side(template, plane, material=None):
+    side = brush.Side(plane, material or template.material)
+    u, v = template.uaxis, template.vaxis
+    side.uaxis = types.Axis(u.x, u.y, u.z, u.translate, u.scale)
+    side.vaxis = types.Axis(v.x, v.y, v.z, v.translate, v.scale)
+    side.rotation = template.rotation
+    side.lightmapscale = template.lightmapscale
+    side.smoothing_groups = template.smoothing_groups
+    return side
+
+
+def subtract(solid, other, material=None):
+    """Returns a list of new Solids making up solid minus other.
+
+    New faces copy the Sides of other, unless material is given. Returns
+    [solid] itself if the two don't overlap.
+
+    """
+    polyhedron = Polyhedron.from_solid(solid)
+    cutter = Polyhedron.from_solid(other)
+    if polyhedron is None or cutter is None:
+        return [solid]
+    pieces = polyhedron.subtract(cutter)
+    if pieces == [polyhedron]:
+        return [solid]
+    return [piece.to_solid(material) for piece in pieces]
+
+
+def intersect(solid, other, material=None):
+    """Returns a new Solid filling the space shared by two, or None."""
+    polyhedron = Polyhedron.from_solid(solid)
+    cutter = Polyhedron.from_solid(other)
+    if polyhedron is None or cutter is None:
+        return None
+    shared = polyhedron.intersect(cutter)
+    if shared is None:
+        return None
+    return shared.to_solid(material)
+
+
+def hollow(solid, thickness, material=None):
+    """Returns a list of new Solids forming walls of a hollowed-out solid.
+
+    Like Hammer's Make Hollow, each face of the solid becomes a wall
+    thickness units thick. The inside faces copy the outside ones, unless
+    material is given. Raises ValueError if the solid is too thin.
+
+    """
+    polyhedron = Polyhedron.from_solid(solid)
+    if polyhedron is None:
+        raise ValueError("Can't hollow an empty brush")
+    inner = Polyhedron.from_planes([(normal, dist - thickness, side)
+        for normal, dist, side in polyhedron.planes()])
+    if inner is None:
+        raise ValueError("Brush is too thin to hollow by %s units" %
+            thickness)
+    return [piece.to_solid(material)
+        for piece in polyhedron.subtract(inner)]
+
+
+def carve(parent, cutters, material=None, cell_size=256):
+    """Subtracts every cutter from every brush among parent's children.
+
+    parent is any class holding brushes (usually a map's World, or a brush
+    entity), and cutters a list of Solids or Blocks. Brushes are bucketed
+    into a grid of cell_size cubes, so each cutter is only tested against
+    brushes near it. Carved brushes (or Blocks) are replaced in place by
+    their pieces; brushes that weren't touched are left as they were.
+    Returns the number of brushes that were carved.
+
+    """
+    children = list(parent.children)
+    shapes = {}         # Index of brush -> Polyhedron of the brush
+    origins = {}        # Index of brush -> index of the child it came from
+    cells = {}
+
+    def cell_range(mins, maxs):
+        lo = [int(mins[k] // cell_size) for k in range(3)]
+        hi = [int(maxs[k] // cell_size) for k in range(3)]
+        for x in range(lo[0], hi[0] + 1):
+            for y in range(lo[1], hi[1] + 1):
+                for z in range(lo[2], hi[2] + 1):
+                    yield x, y, z
+
+    def insert(index, shape, origin):
+        shapes[index] = shape
+        origins[index] = origin
+        for cell in cell_range(shape.mins, shape.maxs):
+            cells.setdefault(cell, set()).add(index)
+
+    for i, child in enumerate(children):
+        node = vmf._node(child)
+        if isinstance(node, brush.Solid):
+            shape = Polyhedron.from_solid(node)
+            if shape is not None:
+                insert(i, shape, i)
+
+    carved = set()
+    next_index = len(children)
+    for cutter in cutters:
+        cutter = Polyhedron.from_solid(vmf._node(cutter))
+        if cutter is None:
+            continue
+        nearby = set()
+        for cell in cell_range(cutter.mins, cutter.maxs):
+            nearby.update(cells.get(cell, ()))
+        for index in sorted(nearby):
+            shape = shapes[index]
+            pieces = shape.subtract(cutter)
+            if pieces == [shape]:
+                continue
+            for cell in cell_range(shape.mins, shape.maxs):
+                cells[cell].discard(index)
+            del shapes[index]
+            origin = origins.pop(index)
+            carved.add(origin)
+            for piece in pieces:
+                insert(next_index, piece, origin)
+                next_index += 1
+
+    if not carved:
+        return 0
+
+    # Put the pieces where the brush they came from used to be
+    pieces = {}
+    for index in sorted(shapes):
+        if origins[index] in carved:
+            pieces.setdefault(origins[index], []).append(
+                shapes[index].to_solid(material))
+    result = []
+    for i, child in enumerate(children):
+        if i in carved:
+            result.extend(pieces.get(i, []))
+        else:
+            result.append(child)
+    parent.children[:] = result
+    return len(carved)
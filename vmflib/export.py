@@ -0,0 +1,269 @@
+"""
+
+Exporting previews of a map's geometry to common 3D formats.
+
+Brushes are written as triangle meshes grouped by material, and point
+entities as small markers, so a generated layout can be checked in any 3D
+viewer without compiling it. This module needs NumPy (see geometry).
+
+Source's Z-up coordinates are turned into the Y-up ones most viewers
+expect, and scaled from Hammer units (about an inch) to metres.
+
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("vmflib.export needs NumPy; install it with "
+        "'pip install vmflib[numpy]'") from None
+
+from vmflib import brush, geometry, vmf
+
+UNIT_SCALE = 0.0254         # Metres per Hammer unit
+MARKER_SIZE = 16            # Size of entity markers, in Hammer units
+
+# An octahedron, used to mark each point entity
+_MARKER_POINTS = numpy.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0),
+    (0, 0, 1), (0, 0, -1)], dtype=float)
+_MARKER_TRIANGLES = numpy.array([(0, 2, 4), (2, 1, 4), (1, 3, 4), (3, 0, 4),
+    (2, 0, 5), (1, 2, 5), (3, 1, 5), (0, 3, 5)])
+
+
+def _to_y_up(points, scale):
+    """Converts (n, 3) Source coordinates to Y-up coordinates."""
+    return numpy.stack([points[:, 0], points[:, 2], -points[:, 1]],
+        axis=1) * scale
+
+
+def _colour(name):
+    """Returns a stable (r, g, b) colour for a material or class name."""
+    digest = hashlib.md5(name.lower().encode('utf-8')).digest()
+    return tuple(0.25 + 0.75 * c / 255 for c in digest[:3])
+
+
+def _brush_mesh(valve_map, skip_tools):
+    """Triangulates the faces of every brush in the map.
+
+    Returns (points, normals, groups), where groups is a list of
+    (material, triangles) with triangles an (n, 3) array of point indices.
+
+    """
+    windings = geometry.compute_windings(geometry.map_solids(valve_map))
+    if not len(windings):
+        return numpy.zeros((0, 3)), numpy.zeros((0, 3)), []
+    names, material_ids = numpy.unique(
+        [side.material for side in windings.sides], return_inverse=True)
+
+    # Fan out each face from its first point
+    face_ids = windings.face_ids()
+    position = numpy.arange(len(face_ids)) - windings.offsets[face_ids]
+    middle = (position >= 1) & (position <= windings.counts[face_ids] - 2)
+    if skip_tools:
+        tools = numpy.array([m.lower().startswith('tools/') for m in names])
+        middle &= ~tools[material_ids[face_ids]]
+    corners = numpy.flatnonzero(middle)
+    triangles = numpy.stack([windings.offsets[face_ids[corners]], corners,
+        corners + 1], axis=1)
+
+    # Group the triangles by material
+    triangle_materials = material_ids[face_ids[corners]]
+    order = numpy.argsort(triangle_materials, kind='stable')
+    bounds = numpy.searchsorted(triangle_materials[order],
+        numpy.arange(len(names) + 1))
+    groups = [(str(names[i]), triangles[order[bounds[i]:bounds[i + 1]]])
+        for i in range(len(names)) if bounds[i + 1] > bounds[i]]
+    return windings.points, windings.normals[face_ids], groups
+
+
+def _point_entities(valve_map):
+    """Returns (name, origin) for each point entity in the map."""
+    markers = []
+    for child in valve_map.children:
+        if isinstance(child, vmf.EntityTable):
+            for i in range(len(child)):
+                row = dict(child.row(i))
+                name = child.classname
+                if row.get('targetname'):
+                    name += ' ' + row['targetname']
+                origin = tuple(float(c) for c in str(row['origin']).split())
+                markers.append((name, origin))
+            continue
+        if not isinstance(child, vmf.Entity) or isinstance(child, vmf.World):
+            continue
+        if child.origin is None or any(isinstance(vmf._node(c), brush.Solid)
+                for c in child.children):
+            continue
+        origin = tuple(float(c) for c in str(child.origin).split())
+        name = child.classname
+        if child.targetname:
+            name += ' ' + child.targetname
+        markers.append((name, origin))
+    return markers
+
+
+def _unique_rows(rows):
+    """Returns (unique, ids) such that unique[ids] equals rows."""
+    if not len(rows):
+        return rows, numpy.zeros(0, dtype=int)
+    order = numpy.lexsort(rows.T[::-1])
+    ordered = rows[order]
+    new = numpy.ones(len(rows), dtype=bool)
+    new[1:] = numpy.any(ordered[1:] != ordered[:-1], axis=1)
+    ids = numpy.empty(len(rows), dtype=int)
+    ids[order] = numpy.cumsum(new) - 1
+    return ordered[new], ids
+
+
+def _write_rows(f, template, rows):
+    """Writes each row of a 2D array to f using a format template."""
+    for start in range(0, len(rows), 100000):
+        chunk = rows[start:start + 100000]
+        f.write((template * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def write_obj(valve_map, filename, scale=UNIT_SCALE, skip_tools=True):
+    """Writes a preview of the map as a Wavefront OBJ file.
+
+    A matching .mtl file, giving each material its own colour, is written
+    alongside it. Faces with tools/ materials (nodraw, sky, triggers...)
+    are left out unless skip_tools is False.
+
+    """
+    points, normals, groups = _brush_mesh(valve_map, skip_tools)
+    markers = _point_entities(valve_map)
+    mtl_filename = os.path.splitext(filename)[0] + '.mtl'
+
+    # Corners and normals are shared by many faces; write each only once
+    points, point_ids = _unique_rows(points)
+    normals, normal_ids = _unique_rows(normals)
+
+    print('Writing to: ' + filename)
+    with open(filename, 'w') as f:
+        f.write('mtllib %s\n' % os.path.basename(mtl_filename))
+        _write_rows(f, 'v %.6g %.6g %.6g\n', _to_y_up(points, scale))
+        _write_rows(f, 'vn %.4g %.4g %.4g\n', _to_y_up(normals, 1))
+        for material, triangles in groups:
+            f.write('g %s\nusemtl %s\n' % (material, material))
+            corners = numpy.stack([point_ids[triangles],
+                normal_ids[triangles]], axis=2) + 1
+            _write_rows(f, 'f %d//%d %d//%d %d//%d\n',
+                corners.reshape(len(triangles), 6))
+
+        # Point entity markers follow the brush points
+        base = len(points) + 1
+        for name, origin in markers:
+            f.write('g %s\nusemtl entity\n' % name.replace(' ', '_'))
+            marker = _MARKER_POINTS * MARKER_SIZE / 2 + origin
+            _write_rows(f, 'v %.6g %.6g %.6g\n', _to_y_up(marker, scale))
+            _write_rows(f, 'f %d %d %d\n', _MARKER_TRIANGLES + base)
+            base += len(_MARKER_POINTS)
+
+    with open(mtl_filename, 'w') as f:
+        for material in [m for m, t in groups] + ['entity']:
+            f.write('newmtl %s\nKd %.3f %.3f %.3f\n' % ((material,) +
+                _colour(material)))
+
+
+def write_gltf(valve_map, filename, scale=UNIT_SCALE, skip_tools=True):
+    """Writes a preview of the map as a binary glTF (.glb) file.
+
+    Each material becomes one primitive of a single mesh, and each point
+    entity a node named after it, holding a small marker mesh. Faces with
+    tools/ materials are left out unless skip_tools is False.
+
+    """
+    points, normals, groups = _brush_mesh(valve_map, skip_tools)
+    markers = _point_entities(valve_map)
+    points = _to_y_up(points, scale).astype(numpy.float32)
+    normals = _to_y_up(normals, 1).astype(numpy.float32)
+    marker_points = _to_y_up(_MARKER_POINTS * MARKER_SIZE / 2,
+        scale).astype(numpy.float32)
+    marker_normals = marker_points / numpy.linalg.norm(marker_points,
+        axis=1)[:, None]
+
+    # Lay out all the binary data in one buffer
+    blobs = []
+    views = []
+    accessors = []
+    size = [0]
+
+    def add(array, component, kind, target, bounds=False):
+        data = numpy.ascontiguousarray(array)
+        views.append({'buffer': 0, 'byteOffset': size[0],
+            'byteLength': data.nbytes, 'target': target})
+        accessor = {'bufferView': len(views) - 1, 'componentType': component,
+            'count': len(data), 'type': kind}
+        if bounds:
+            accessor['min'] = data.min(axis=0).tolist() if len(data) else \
+                [0, 0, 0]
+            accessor['max'] = data.max(axis=0).tolist() if len(data) else \
+                [0, 0, 0]
+        accessors.append(accessor)
+        blobs.append(data)
+        size[0] += data.nbytes
+        return len(accessors) - 1
+
+    float_type, index_type = 5126, 5125
+    vertex_target, index_target = 34962, 34963
+    materials = [{'name': m, 'pbrMetallicRoughness': {
+        'baseColorFactor': list(_colour(m)) + [1.0]}}
+        for m in [m for m, t in groups] + ['entity']]
+
+    meshes = []
+    nodes = []
+    if groups:
+        position = add(points, float_type, 'VEC3', vertex_target, True)
+        normal = add(normals, float_type, 'VEC3', vertex_target)
+        primitives = []
+        for i, (material, triangles) in enumerate(groups):
+            indices = add(triangles.astype(numpy.uint32).ravel(), index_type,
+                'SCALAR', index_target)
+            primitives.append({'attributes': {'POSITION': position,
+                'NORMAL': normal}, 'indices': indices, 'material': i})
+        meshes.append({'name': 'brushes', 'primitives': primitives})
+        nodes.append({'name': 'brushes', 'mesh': len(meshes) - 1})
+
+    if markers:
+        meshes.append({'name': 'marker', 'primitives': [{'attributes': {
+            'POSITION': add(marker_points, float_type, 'VEC3',
+                vertex_target, True),
+            'NORMAL': add(marker_normals, float_type, 'VEC3',
+                vertex_target)},
+            'indices': add(_MARKER_TRIANGLES.astype(numpy.uint32).ravel(),
+                index_type, 'SCALAR', index_target),
+            'material': len(materials) - 1}]})
+        origins = _to_y_up(numpy.array([o for n, o in markers]), scale)
+        for (name, origin), translation in zip(markers, origins.tolist()):
+            nodes.append({'name': name, 'mesh': len(meshes) - 1,
+                'translation': translation})
+
+    document = {'asset': {'version': '2.0', 'generator': 'vmflib'},
+        'scene': 0, 'scenes': [{}], 'materials': materials}
+    # glTF doesn't allow empty lists, so a map with nothing to show has no
+    # nodes, meshes or binary data at all
+    if nodes:
+        document['scenes'][0]['nodes'] = list(range(len(nodes)))
+        document.update(nodes=nodes, meshes=meshes, accessors=accessors,
+            bufferViews=views, buffers=[{'byteLength': size[0]}])
+
+    # Chunks must be padded to 4 bytes; every blob already is
+    header = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 4)
+    total = 12 + 8 + len(header)
+    if blobs:
+        total += 8 + size[0]
+
+    print('Writing to: ' + filename)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<4sII', b'glTF', 2, total))
+        f.write(struct.pack('<I4s', len(header), b'JSON'))
+        f.write(header)
+        if blobs:
+            f.write(struct.pack('<I4s', size[0], b'BIN\0'))
+        for blob in blobs:
+            f.write(blob.tobytes())
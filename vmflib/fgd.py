@@ -0,0 +1,627 @@
+"""
+
+Reading entity definitions from a game's FGD files, and checking maps
+against them.
+
+An FGD (Forge Game Data) file is what Hammer uses to know each entity
+class's keys, their types, defaults and allowed values, and the inputs and
+outputs the class has. With one loaded, entities can be checked as they are
+made, or a whole map can be checked at once, instead of typos only turning
+up in Hammer or in the game.
+
+"""
+
+import collections
+import os
+import pickle
+import re
+import tempfile
+
+from vmflib import vmf
+
+CACHE_VERSION = 1
+
+_TOKEN = re.compile(r'//[^\n]*|"([^"]*)"|([@()\[\]:=,+])|([^\s"@()\[\]:=,+]+)')
+
+# Keys every entity may have, whether its class lists them or not
+COMMON_KEYS = ('id', 'classname', 'origin', 'spawnflags', 'hammerid',
+    'mapversion')
+
+_INTEGER = re.compile(r'\s*-?\d+\s*$')
+_FLOAT = re.compile(r'\s*-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+
+class FgdError(Exception):
+
+    """Raised when an FGD file can't be parsed."""
+
+
+class KeySchema:
+
+    """One key of an entity class.
+
+    choices maps each allowed value (as a string) to its label, for keys of
+    type choices; for flags, it maps each flag's bit (as a string) instead.
+    default is None if the FGD gives none.
+
+    """
+
+    __slots__ = ('name', 'type', 'display', 'default', 'description',
+        'choices')
+
+    def __init__(self, name, type, display=None, default=None,
+            description=None, choices=None):
+        self.name = name
+        self.type = type
+        self.display = display
+        self.default = default
+        self.description = description
+        self.choices = choices
+
+    def check(self, values):
+        """Returns the indices of the values (strings) this key can't take."""
+        checker = _CHECKS.get(self.type)
+        if self.choices is not None and self.type == 'choices':
+            checker = _check_choices
+        if checker is None:
+            return []
+        return [i for i, value in enumerate(values)
+            if not checker(self, value)]
+
+    def __repr__(self):
+        return 'KeySchema(%r, %r)' % (self.name, self.type)
+
+
+class EntitySchema:
+
+    """The definition of an entity class, with its base classes merged in.
+
+    kind is the FGD class type ('PointClass', 'SolidClass'...). keys maps
+    each key's name, in lower case, to its KeySchema, in FGD order. inputs
+    and outputs map lower case names to the names as the FGD spells them.
+
+    """
+
+    __slots__ = ('kind', 'classname', 'description', 'bases', 'keys',
+        'inputs', 'outputs')
+
+    def __init__(self, kind, classname, description=None, bases=()):
+        self.kind = kind
+        self.classname = classname
+        self.description = description
+        self.bases = list(bases)
+        self.keys = collections.OrderedDict()
+        self.inputs = {}
+        self.outputs = {}
+
+    def key(self, name):
+        """Returns the KeySchema for a key (in any case), or None."""
+        return self.keys.get(name.lower())
+
+    def __repr__(self):
+        return 'EntitySchema(%r, %d keys)' % (self.classname, len(self.keys))
+
+
+def _check_integer(key, value):
+    return _INTEGER.match(value) is not None
+
+
+def _check_float(key, value):
+    return _FLOAT.match(value) is not None
+
+
+def _check_numbers(count, maximum=None):
+    def check(key, value):
+        parts = value.split()
+        if len(parts) not in count:
+            return False
+        for part in parts:
+            if not _FLOAT.match(part):
+                return False
+            if maximum is not None and not 0 <= float(part) <= maximum:
+                return False
+        return True
+    return check
+
+
+def _check_choices(key, value):
+    if value in key.choices:
+        return True
+    try:            # "1.0" is as good as "1"
+        return '%g' % float(value) in key.choices
+    except ValueError:
+        return False
+
+
+def _check_flags(key, value):
+    if not _INTEGER.match(value):
+        return False
+    known = 0
+    for bit in (key.choices or {}):
+        known |= int(bit)
+    return not int(value) & ~known
+
+
+def _check_boolean(key, value):
+    return value.strip() in ('0', '1')
+
+
+_CHECKS = {
+    'integer': _check_integer,
+    'float': _check_float,
+    'flags': _check_flags,
+    'boolean': _check_boolean,
+    'color255': _check_numbers((3, 4), 255),
+    'color1': _check_numbers((3, 4)),
+    'origin': _check_numbers((3,)),
+    'vector': _check_numbers((3,)),
+    'angle': _check_numbers((3,)),
+}
+
+
+class _Parser:
+
+    """Reads the definitions in the text of one FGD file."""
+
+    def __init__(self, text, filename):
+        self.tokens = []
+        for match in _TOKEN.finditer(text):
+            quoted, punct, word = match.groups()
+            if quoted is not None:
+                self.tokens.append(('string', quoted))
+            elif punct:
+                self.tokens.append(('punct', punct))
+            elif word:
+                self.tokens.append(('word', word))
+        self.position = 0
+        self.filename = filename
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        if index < len(self.tokens):
+            return self.tokens[index]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FgdError("%s ends unexpectedly" % self.filename)
+        self.position += 1
+        return token
+
+    def at(self, punct):
+        return self.peek() == ('punct', punct)
+
+    def expect(self, punct):
+        kind, token = self.next()
+        if (kind, token) != ('punct', punct):
+            raise FgdError("%s: expected '%s' but found %r" % (self.filename,
+                punct, token))
+
+    def text(self):
+        """Reads a value, joining strings added together with +."""
+        value = self.next()[1]
+        while self.at('+'):
+            self.next()
+            value += self.next()[1]
+        return value
+
+    def skip_brackets(self):
+        """Skips a [ ... ] block, and any blocks nested in it."""
+        self.expect('[')
+        depth = 1
+        while depth:
+            token = self.next()
+            if token == ('punct', '['):
+                depth += 1
+            elif token == ('punct', ']'):
+                depth -= 1
+
+    def arguments(self):
+        """Reads the (...) arguments of a helper as a list of words."""
+        self.expect('(')
+        args = []
+        while not self.at(')'):
+            kind, token = self.next()
+            if kind != 'punct':
+                args.append(token)
+        self.next()
+        return args
+
+    def parse(self):
+        """Returns the (includes, classes) defined in the file.
+
+        Each class is (kind, classname, description, bases, keys, inputs,
+        outputs), where keys is a list of KeySchemas and inputs and outputs
+        lists of names.
+
+        """
+        includes = []
+        classes = []
+        while self.peek()[0] is not None:
+            self.expect('@')
+            kind = self.next()[1]
+            lowered = kind.lower()
+            if lowered == 'include':
+                includes.append(self.text())
+            elif lowered == 'mapsize':
+                self.arguments()
+            elif lowered in ('materialexclusion', 'autovisgroup'):
+                while not self.at('['):
+                    self.next()
+                self.skip_brackets()
+            elif lowered.endswith('class'):
+                classes.append(self.parse_class(kind))
+            else:
+                raise FgdError("%s: unknown definition @%s" % (self.filename,
+                    kind))
+        return includes, classes
+
+    def parse_class(self, kind):
+        # Helpers such as base(...), studio(...) or halfgridsnap come first
+        bases = []
+        while not self.at('='):
+            helper = self.next()[1]
+            if self.at('('):
+                args = self.arguments()
+                if helper.lower() == 'base':
+                    bases.extend(args)
+        self.next()
+        classname = self.next()[1]
+        description = None
+        if self.at(':'):
+            self.next()
+            description = self.text()
+        keys, inputs, outputs = [], [], []
+        self.expect('[')
+        while not self.at(']'):
+            self.parse_entry(keys, inputs, outputs)
+        self.next()
+        return kind, classname, description, bases, keys, inputs, outputs
+
+    def value_follows(self):
+        """Whether a field value comes next, rather than the next entry."""
+        kind, token = self.peek()
+        if kind == 'string':
+            return True
+        if kind != 'word' or self.peek(1) == ('punct', '('):
+            return False
+        return not (token in ('input', 'output') and self.peek(1)[0] == 'word')
+
+    def fields(self):
+        """Reads the ": a : b : c" fields after an entry's name and type."""
+        fields = []
+        while self.at(':'):
+            self.next()
+            fields.append(self.text() if self.value_follows() else None)
+        return fields
+
+    def parse_entry(self, keys, inputs, outputs):
+        name = self.next()[1]
+        if name in ('input', 'output') and self.peek()[0] == 'word':
+            (inputs if name == 'input' else outputs).append(self.next()[1])
+            self.arguments()
+            self.fields()
+            return
+
+        args = self.arguments()
+        type = args[0].lower() if args else 'string'
+        while self.peek()[0] == 'word' and self.peek()[1].lower() in (
+                'readonly', 'report'):
+            self.next()
+        fields = self.fields() + [None] * 3
+        display, default, description = fields[:3]
+
+        choices = None
+        if self.at('='):
+            self.next()
+            self.expect('[')
+            choices = collections.OrderedDict()
+            flag_default = 0
+            while not self.at(']'):
+                value = self.text()
+                item = self.fields() + [None]
+                choices[value] = item[0]
+                if type == 'flags' and item[1] is not None and \
+                        item[1].strip() not in ('', '0'):
+                    flag_default |= int(value)
+            self.next()
+            if type == 'flags' and default is None:
+                default = str(flag_default)
+        if default is not None and type in ('integer', 'float', 'choices',
+                'flags', 'boolean') and not default.strip():
+            default = None
+        keys.append(KeySchema(name, type, display, default, description,
+            choices))
+
+
+def parse(text, filename='<fgd>'):
+    """Parses the text of an FGD file.
+
+    Returns (includes, classes): the files it includes, and the classes it
+    defines as (kind, classname, description, bases, keys, inputs, outputs)
+    tuples. Base classes aren't merged in; see Fgd for that.
+
+    """
+    return _Parser(text, filename).parse()
+
+
+def _stamps(filenames):
+    return [(filename, os.path.getmtime(filename)) for filename in filenames]
+
+
+class Fgd:
+
+    """The entity classes defined by one or more FGD files.
+
+    Files included with @include are read too, and classes defined again in
+    a later file replace the earlier definition. Look classes up with
+    fgd[classname].
+
+    If cache_file is given, the compiled classes are saved there (with
+    pickle), and loaded from it next time unless one of the FGD files has
+    been modified since.
+
+    """
+
+    def __init__(self, filenames, cache_file=None):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        self._classes = {}      # Classname -> generated Entity subclass
+        self.schemas = None
+        if cache_file:
+            self._load_cache(cache_file)
+        if self.schemas is None:
+            sources = self._compile()
+            if cache_file:
+                self._save_cache(cache_file, sources)
+
+    def _load_cache(self, cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if (cached['version'] == CACHE_VERSION and
+                    cached['filenames'] == self.filenames and
+                    cached['sources'] == _stamps(
+                        [name for name, mtime in cached['sources']])):
+                self.schemas = cached['schemas']
+        except (OSError, EOFError, KeyError, TypeError,
+                pickle.UnpicklingError):
+            pass
+
+    def _save_cache(self, cache_file, sources):
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(
+                os.path.abspath(cache_file)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({
+                    'version': CACHE_VERSION,
+                    'filenames': self.filenames,
+                    'sources': _stamps(sources),
+                    'schemas': self.schemas,
+                }, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, cache_file)
+        except OSError:
+            pass            # Just slower next time
+
+    def _compile(self):
+        """Reads the FGD files, returning every file read."""
+        definitions = collections.OrderedDict()
+        sources = []
+
+        def read(filename):
+            if filename in sources:
+                return
+            sources.append(filename)
+            with open(filename, encoding='utf-8', errors='replace') as f:
+                includes, classes = parse(f.read(), filename)
+            for include in includes:
+                read(os.path.join(os.path.dirname(filename), include))
+            for definition in classes:
+                definitions[definition[1].lower()] = definition
+
+        for filename in self.filenames:
+            read(filename)
+
+        self.schemas = {}
+        for name in definitions:
+            self._merge(name, definitions, [])
+        self.schemas = dict((name, schema) for name, schema in
+            self.schemas.items()
+            if definitions[name][0].lower() != 'baseclass')
+        return sources
+
+    def _merge(self, name, definitions, seen):
+        """Builds the EntitySchema of a class and all of its bases."""
+        if name in self.schemas:
+            return self.schemas[name]
+        if name in seen:
+            raise FgdError("Class %s is its own base" % name)
+        kind, classname, description, bases, keys, inputs, outputs = \
+            definitions[name]
+        schema = EntitySchema(kind, classname, description, bases)
+        for base in bases:
+            if base.lower() not in definitions:
+                raise FgdError("Class %s has unknown base %s" % (classname,
+                    base))
+            parent = self._merge(base.lower(), definitions, seen + [name])
+            for key, value in parent.keys.items():
+                if key == 'spawnflags' and key in schema.keys:
+                    value = _merge_flags(schema.keys[key], value)
+                schema.keys[key] = value
+            schema.inputs.update(parent.inputs)
+            schema.outputs.update(parent.outputs)
+        for key in keys:
+            if (key.name.lower() == 'spawnflags' and
+                    'spawnflags' in schema.keys):
+                key = _merge_flags(schema.keys['spawnflags'], key)
+            schema.keys[key.name.lower()] = key
+        schema.inputs.update((n.lower(), n) for n in inputs)
+        schema.outputs.update((n.lower(), n) for n in outputs)
+        self.schemas[name] = schema
+        return schema
+
+    def __contains__(self, classname):
+        return classname.lower() in self.schemas
+
+    def __getitem__(self, classname):
+        return self.schemas[classname.lower()]
+
+    def get(self, classname, default=None):
+        return self.schemas.get(classname.lower(), default)
+
+    def entity_class(self, classname):
+        """Returns an Entity subclass for a class, made when first asked for.
+
+        Its instances start out with the FGD's defaults, take keyvalues as
+        keyword arguments, and raise AttributeError for a key the class
+        doesn't have or ValueError for a value the key can't take.
+
+        """
+        schema = self[classname]
+        cls = self._classes.get(schema.classname)
+        if cls is None:
+            name = ''.join(part.capitalize()
+                for part in schema.classname.split('_'))
+            cls = self._classes[schema.classname] = type(name, (FgdEntity,),
+                {'schema': schema, '__doc__': schema.description})
+        return cls
+
+    def validate(self, valve_map):
+        """Checks every entity in a map against its class's definition.
+
+        Returns a list of (entity id, classname, problem) for unknown
+        classes, unknown keys or outputs, and values their keys can't take.
+        Entities are grouped by class and each distinct value of a key is
+        checked once, so many similar entities cost little more than one.
+
+        """
+        # Classname -> key -> value -> ids of entities with that value
+        values = collections.OrderedDict()
+        outputs = collections.OrderedDict()
+        for node in vmf._walk(valve_map):
+            if isinstance(node, vmf.EntityTable):
+                keys = values.setdefault(node.classname, {})
+                ids = range(node.first_id, node.first_id + len(node))
+                for key, column in node.columns.items():
+                    found = keys.setdefault(key, collections.OrderedDict())
+                    if isinstance(column, list):
+                        for i, value in enumerate(column):
+                            found.setdefault(str(value), []).append(ids[i])
+                    else:
+                        found.setdefault(str(column), []).extend(ids)
+            elif isinstance(node, vmf.Entity):
+                keys = values.setdefault(node.classname, {})
+                entity_id = node.properties.get('id')
+                pairs = [(name, getattr(node, name))
+                    for name in node.auto_properties]
+                pairs.extend(node.properties.items())
+                for key, value in pairs:
+                    if value is not None:
+                        keys.setdefault(key, collections.OrderedDict()) \
+                            .setdefault(str(value), []).append(entity_id)
+                for child in node.children:
+                    if isinstance(child, vmf.Connections):
+                        for output in child.children:
+                            outputs.setdefault(node.classname, {}).setdefault(
+                                output.event, []).append(entity_id)
+
+        problems = []
+        for classname, keys in values.items():
+            schema = self.get(classname)
+            if schema is None:
+                for entity_id in keys.get('classname', {}).get(classname, []):
+                    problems.append((entity_id, classname,
+                        "Unknown entity class"))
+                continue
+            for key, found in keys.items():
+                key_schema = schema.key(key)
+                if key_schema is None:
+                    if key.lower() not in COMMON_KEYS:
+                        for ids in found.values():
+                            for entity_id in ids:
+                                problems.append((entity_id, classname,
+                                    "Unknown key %s" % key))
+                    continue
+                distinct = list(found)
+                for i in key_schema.check(distinct):
+                    for entity_id in found[distinct[i]]:
+                        problems.append((entity_id, classname,
+                            "Bad %s value for %s: %r" % (key_schema.type,
+                            key, distinct[i])))
+            for event, ids in outputs.get(classname, {}).items():
+                if event.lower() not in schema.outputs:
+                    for entity_id in ids:
+                        problems.append((entity_id, classname,
+                            "Unknown output %s" % event))
+        problems.sort(key=lambda problem: (problem[0] is None, problem[0]))
+        return problems
+
+
+def _merge_flags(old, new):
+    """Returns a spawnflags KeySchema with the flags of both."""
+    choices = collections.OrderedDict(old.choices or {})
+    choices.update(new.choices or {})
+    default = int(old.default or 0) | int(new.default or 0)
+    return KeySchema(new.name, 'flags', new.display or old.display,
+        str(default), new.description or old.description, choices)
+
+
+# Attributes of an Entity that aren't keyvalues
+_ENTITY_ATTRIBUTES = ('classname', 'spawnflags', 'origin', 'targetname',
+    'properties', 'auto_properties', 'children')
+
+
+class FgdEntity(vmf.Entity):
+
+    """An entity whose keys are checked against an FGD class as they're set.
+
+    Subclasses are made by Fgd.entity_class(), which sets schema.
+
+    """
+
+    schema = None
+
+    def __init__(self, **keyvalues):
+        # Check the keyvalues before Entity.__init__() adds us to the map,
+        # so a bad one doesn't leave half an entity behind in it
+        for name, value in keyvalues.items():
+            self._checked(name, value)
+        vmf.Entity.__init__(self, self.schema.classname)
+        for key in self.schema.keys.values():
+            if key.default is not None and key.name not in _ENTITY_ATTRIBUTES:
+                self._set_key(key, key.default)
+        spawnflags = self.schema.key('spawnflags')
+        if spawnflags is not None and spawnflags.default is not None:
+            self.spawnflags = spawnflags.default
+        for name, value in keyvalues.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def _checked(cls, name, value):
+        """Returns the KeySchema for setting name to value (None if it's
+        an attribute of every Entity), or raises if it can't be set."""
+        key = cls.schema.key(name) if cls.schema else None
+        if key is None:
+            if name not in _ENTITY_ATTRIBUTES and not name.startswith('_'):
+                raise AttributeError("%s has no key %s" % (
+                    cls.schema.classname, name))
+            return None
+        if value is not None and key.check([str(value)]):
+            raise ValueError("Bad %s value for %s.%s: %r" % (key.type,
+                cls.schema.classname, key.name, value))
+        return key
+
+    def _set_key(self, key, value):
+        vmf.Entity.__setattr__(self, key.name, value)
+        if key.name not in self.auto_properties and \
+                key.name not in _ENTITY_ATTRIBUTES:
+            self.auto_properties.append(key.name)
+
+    def __setattr__(self, name, value):
+        key = self._checked(name, value)
+        if key is None:
+            vmf.Entity.__setattr__(self, name, value)
+        else:
+            self._set_key(key, value)
@@ -0,0 +1,314 @@
+"""
+
+Batched geometry calculations for brushes.
+
+The VMF format only stores three points on each brush face's plane; the
+actual polygon (winding) of each face has to be worked out by intersecting
+the planes of the brush. The functions here do that for many brushes at once
+using NumPy, which must be installed to use this module.
+
+"""
+
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("vmflib.geometry needs NumPy; install it with "
+        "'pip install vmflib[numpy]'") from None
+
+from vmflib import brush, vmf
+
+EPSILON = 0.01          # Distance (in units) within which points coincide
+
+# Upper bound on the number of elements in the largest temporary array, so
+# big maps are processed in chunks of brushes instead of all at once
+CHUNK_ELEMENTS = 2000000
+
+
+def map_solids(valve_map):
+    """Returns every Solid in the map, in the world and in brush entities."""
+    solids = []
+    stack = [valve_map]
+    while stack:
+        node = vmf._node(stack.pop())
+        if isinstance(node, brush.Solid):
+            solids.append(node)
+        elif isinstance(node, vmf.VmfClass):
+            stack.extend(reversed(node.children))
+    return solids
+
+
+class Windings:
+
+    """The face polygons of a list of brushes.
+
+    Faces are numbered in the order of the brushes and then of each brush's
+    Sides. The polygon of face i is points[offsets[i]:offsets[i + 1]], wound
+    counter-clockwise when seen from outside the brush. Faces whose plane
+    does not touch the brush (or is degenerate) have no points.
+
+    Per-face arrays: sides, normals, dists, counts, areas, face_mins,
+    face_maxs.
+    Per-brush arrays: solids, face_offsets (faces of brush j are
+    face_offsets[j] to face_offsets[j + 1]), mins, maxs.
+
+    Bounding boxes of faces or brushes without any points are NaN.
+
+    """
+
+    def __init__(self, solids, sides, face_offsets, normals, dists, points,
+            offsets):
+        self.solids = solids
+        self.sides = sides
+        self.face_offsets = face_offsets
+        self.normals = normals
+        self.dists = dists
+        self.points = points
+        self.offsets = offsets
+        self.counts = numpy.diff(offsets)
+        self.areas = self._areas()
+        self.face_mins = self._reduce(numpy.minimum, offsets)
+        self.face_maxs = self._reduce(numpy.maximum, offsets)
+        self.mins = self._reduce(numpy.minimum, offsets[face_offsets])
+        self.maxs = self._reduce(numpy.maximum, offsets[face_offsets])
+
+    def __len__(self):
+        return len(self.sides)
+
+    def face(self, i):
+        """Returns the points of face i as an (n, 3) array."""
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def brush(self, j):
+        """Returns the list of face polygons of brush j."""
+        return [self.face(i)
+            for i in range(self.face_offsets[j], self.face_offsets[j + 1])]
+
+    def face_ids(self):
+        """Returns the face number of each row of points."""
+        return numpy.repeat(numpy.arange(len(self.sides)), self.counts)
+
+    def next_points(self):
+        """Returns the index of the point following each point in its face."""
+        index = numpy.arange(len(self.points)) + 1
+        ends = self.offsets[1:][self.counts > 0]
+        index[ends - 1] = self.offsets[:-1][self.counts > 0]
+        return index
+
+    def extents(self, axes):
+        """Returns the (mins, maxs) of each face along its own axis.
+
+        axes is an (n, 3) array with one direction per face.
+
+        """
+        along = numpy.einsum('ij,ij->i', self.points, axes[self.face_ids()])
+        return (self._reduce(numpy.minimum, self.offsets, along),
+            self._reduce(numpy.maximum, self.offsets, along))
+
+    def _reduce(self, ufunc, offsets, values=None):
+        """Applies ufunc over the points in each range given by offsets."""
+        if values is None:
+            values = self.points
+        result = numpy.full((len(offsets) - 1,) + values.shape[1:], numpy.nan)
+        nonempty = numpy.diff(offsets) > 0
+        if numpy.any(nonempty):
+            result[nonempty] = ufunc.reduceat(values, offsets[:-1][nonempty])
+        return result
+
+    def _areas(self):
+        face_ids = self.face_ids()
+        if not len(face_ids):
+            return numpy.zeros(len(self.sides))
+        cross = numpy.cross(self.points, self.points[self.next_points()])
+        twice = numpy.einsum('ij,ij->i', cross, self.normals[face_ids])
+        return 0.5 * numpy.abs(numpy.bincount(face_ids, twice,
+            minlength=len(self.sides)))
+
+    def _store(self):
+        """Saves each brush's share of the results in the brush's cache."""
+        f, p = self.face_offsets, self.offsets[self.face_offsets]
+        for j, solid in enumerate(self.solids):
+            solid._winding = (self.normals[f[j]:f[j + 1]],
+                self.dists[f[j]:f[j + 1]], self.counts[f[j]:f[j + 1]],
+                self.points[p[j]:p[j + 1]])
+
+
+def _plane_points(sides):
+    """Returns an (n, 3, 3) array of the points defining each side's plane."""
+    coords = []
+    for side in sides:
+        v0, v1, v2 = side.plane.v0, side.plane.v1, side.plane.v2
+        coords.append((v0.x, v0.y, v0.z, v1.x, v1.y, v1.z, v2.x, v2.y, v2.z))
+    return numpy.array(coords, dtype=float).reshape(-1, 3, 3)
+
+
+def planes(sides):
+    """Returns the (normals, dists) of the planes of a list of Sides.
+
+    Normals point out of the brush, following the winding of the three
+    points that Hammer uses. Degenerate planes get a zero normal.
+
+    """
+    points = _plane_points(sides)
+    if not len(points):
+        return numpy.zeros((0, 3)), numpy.zeros(0)
+    normals = numpy.cross(points[:, 0] - points[:, 1],
+        points[:, 2] - points[:, 1])
+    lengths = numpy.linalg.norm(normals, axis=1)
+    normals[lengths > 0] /= lengths[lengths > 0, None]
+    normals[lengths == 0] = 0
+    dists = numpy.einsum('ij,ij->i', normals, points[:, 1])
+    return normals, dists
+
+
+def _face_axes(normals):
+    """Returns unit (u, v) axes spanning each plane, with u x v = normal."""
+    helper = numpy.zeros_like(normals)
+    mostly_z = numpy.abs(normals[..., 2]) > 0.9
+    helper[..., 2] = ~mostly_z
+    helper[..., 0] = mostly_z
+    u = numpy.cross(normals, helper)
+    lengths = numpy.linalg.norm(u, axis=-1)
+    u[lengths > 0] /= lengths[lengths > 0, None]
+    v = numpy.cross(normals, u)
+    return u, v
+
+
+def _brush_polygons(normals, dists):
+    """Computes the face polygons of a batch of brushes with n planes each.
+
+    normals is (b, n, 3) and dists is (b, n). Returns (points, counts),
+    where points is (b, n, t, 3) with the counts[b, n] points of each face
+    first, in winding order.
+
+    """
+    b, n = dists.shape
+    triples = numpy.array(list(itertools.combinations(range(n), 3)))
+
+    # Every corner of a convex brush is where three of its planes meet
+    n0 = normals[:, triples[:, 0]]
+    n1 = normals[:, triples[:, 1]]
+    n2 = normals[:, triples[:, 2]]
+    c12 = numpy.cross(n1, n2)
+    c20 = numpy.cross(n2, n0)
+    c01 = numpy.cross(n0, n1)
+    det = numpy.einsum('btk,btk->bt', n0, c12)
+    solvable = numpy.abs(det) > 1e-6
+    det[~solvable] = 1
+    corners = (dists[:, triples[:, 0], None] * c12 +
+        dists[:, triples[:, 1], None] * c20 +
+        dists[:, triples[:, 2], None] * c01) / det[..., None]
+
+    # ...as long as it isn't outside any of the other planes
+    dist = numpy.einsum('btk,bnk->bnt', corners, normals) - dists[..., None]
+    degenerate = ~numpy.any(normals, axis=-1)
+    dist[degenerate] = 0
+    valid = solvable & numpy.all(dist <= EPSILON, axis=1)
+    on_face = (numpy.abs(dist) <= EPSILON) & valid[:, None, :]
+    on_face &= ~degenerate[..., None]
+
+    # Sort each face's corners by angle around the face's centre
+    counts = on_face.sum(axis=-1)
+    centres = numpy.einsum('bnt,btk->bnk', on_face, corners)
+    centres /= numpy.maximum(counts, 1)[..., None]
+    u, v = _face_axes(normals)
+    offset = corners[:, None, :, :] - centres[:, :, None, :]
+    angles = numpy.arctan2(numpy.einsum('bntk,bnk->bnt', offset, v),
+        numpy.einsum('bntk,bnk->bnt', offset, u))
+    angles[~on_face] = numpy.inf
+    order = numpy.argsort(angles, axis=-1)
+    points = numpy.take_along_axis(corners[:, None, :, :],
+        order[..., None], axis=2)
+    keep = numpy.take_along_axis(on_face, order, axis=-1)
+
+    # Corners where more than three planes meet are found more than once
+    gap = numpy.linalg.norm(points - numpy.roll(points, 1, axis=2), axis=-1)
+    gap_first = numpy.linalg.norm(points - points[:, :, :1], axis=-1)
+    duplicate = (gap <= EPSILON) | (gap_first <= EPSILON)
+    duplicate[..., 0] = False
+    keep &= ~duplicate
+
+    order = numpy.argsort(~keep, axis=-1, kind='stable')
+    points = numpy.take_along_axis(points, order[..., None], axis=2)
+    return points, keep.sum(axis=-1)
+
+
+def compute_windings(solids):
+    """Computes the face polygons of every brush in a list of Solids.
+
+    Each brush keeps its results until its Sides or their planes are
+    replaced, so only brushes which are new or have changed since the last
+    call are computed again. (Changing the coordinates of a Side's existing
+    Plane in place is not noticed; assign a new Plane instead.) Returns a
+    Windings.
+
+    """
+    solids = list(solids)
+    stale = [solid for solid in solids if solid._winding is None]
+    if stale:
+        windings = _compute_windings(stale)
+        windings._store()
+        if len(stale) == len(solids):
+            return windings
+
+    # Put the cached results of each brush together
+    sides = [side for solid in solids for side in solid.children]
+    cached = [solid._winding for solid in solids]
+    sizes = numpy.array([len(c[0]) for c in cached], dtype=int)
+    face_offsets = numpy.zeros(len(solids) + 1, dtype=int)
+    numpy.cumsum(sizes, out=face_offsets[1:])
+    if not cached:
+        return Windings(solids, sides, face_offsets, numpy.zeros((0, 3)),
+            numpy.zeros(0), numpy.zeros((0, 3)), numpy.zeros(1, dtype=int))
+    counts = numpy.concatenate([c[2] for c in cached])
+    offsets = numpy.zeros(len(counts) + 1, dtype=int)
+    numpy.cumsum(counts, out=offsets[1:])
+    return Windings(solids, sides, face_offsets,
+        numpy.concatenate([c[0] for c in cached]),
+        numpy.concatenate([c[1] for c in cached]),
+        numpy.concatenate([c[3] for c in cached]), offsets)
+
+
+def _compute_windings(solids):
+    """Computes the face polygons of every brush in a list of Solids.
+
+    Brushes are batched by their number of Sides, so the work for all
+    brushes of the same shape is done together. Returns a Windings.
+
+    """
+    sides = [side for solid in solids for side in solid.children]
+    sizes = numpy.array([len(solid.children) for solid in solids], dtype=int)
+    face_offsets = numpy.zeros(len(solids) + 1, dtype=int)
+    numpy.cumsum(sizes, out=face_offsets[1:])
+    normals, dists = planes(sides)
+
+    counts = numpy.zeros(len(sides), dtype=int)
+    pieces = []
+    for n in numpy.unique(sizes):
+        if n < 4:
+            continue    # Not a closed brush; its faces have no polygons
+        brushes = numpy.flatnonzero(sizes == n)
+        triples = n * (n - 1) * (n - 2) // 6
+        chunk = max(1, CHUNK_ELEMENTS // (n * triples * 3))
+        for start in range(0, len(brushes), chunk):
+            faces = (face_offsets[brushes[start:start + chunk], None] +
+                numpy.arange(n))
+            points, face_counts = _brush_polygons(normals[faces],
+                dists[faces])
+            keep = numpy.arange(points.shape[2]) < face_counts[..., None]
+            counts[faces.ravel()] = face_counts.ravel()
+            pieces.append((faces.ravel(), face_counts.ravel(), points[keep]))
+
+    # Gather each batch's points into face order
+    offsets = numpy.zeros(len(sides) + 1, dtype=int)
+    numpy.cumsum(counts, out=offsets[1:])
+    all_points = numpy.zeros((offsets[-1], 3))
+    for faces, face_counts, points in pieces:
+        starts = numpy.repeat(offsets[faces], face_counts)
+        firsts = numpy.repeat(numpy.cumsum(face_counts) - face_counts,
+            face_counts)
+        all_points[starts + numpy.arange(len(points)) - firsts] = points
+
+    return Windings(solids, sides, face_offsets, normals, dists, all_points,
+        offsets)
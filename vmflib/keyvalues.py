@@ -0,0 +1,84 @@
+"""
+
+Reading Valve's KeyValues text format.
+
+VMF files are written in KeyValues: a list of named blocks, each holding
+"key" "value" pairs and further blocks. The entity lump of a compiled BSP
+uses the same syntax, with unnamed blocks. Other KeyValues files (such as a
+game's gameinfo.txt) may also hold // comments and [$PLATFORM] conditions,
+which are skipped.
+
+"""
+
+import re
+
+_TOKEN = re.compile(r'"([^"]*)"|([{}])|(//[^\n]*|\[[^\]\n]*\])|([^\s{}"]+)')
+
+
+class Block:
+
+    """A block read from a KeyValues file.
+
+    Keys may repeat (entity outputs often do), so pairs is a list of
+    (key, value) tuples rather than a dictionary. Blocks compare equal when
+    their names, pairs and children are all the same.
+
+    """
+
+    __slots__ = ('name', 'pairs', 'children')
+
+    def __init__(self, name=None, pairs=None, children=None):
+        self.name = name
+        self.pairs = pairs if pairs is not None else []
+        self.children = children if children is not None else []
+
+    def get(self, key, default=None):
+        """Returns the value of the first pair with the given key."""
+        for k, value in self.pairs:
+            if k == key:
+                return value
+        return default
+
+    def __eq__(self, other):
+        return (isinstance(other, Block) and self.name == other.name and
+            self.pairs == other.pairs and self.children == other.children)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Block(%r, %d pairs, %d children)' % (self.name,
+            len(self.pairs), len(self.children))
+
+
+def parse(text):
+    """Parses KeyValues text, returning its list of top-level Blocks.
+
+    Raises ValueError if the braces don't match up.
+
+    """
+    root = Block()
+    stack = [root]
+    pending = None      # A key (or block name) still waiting for its value
+    for quoted, brace, skipped, word in _TOKEN.findall(text):
+        if skipped:
+            continue
+        elif brace == '{':
+            block = Block(pending)
+            stack[-1].children.append(block)
+            stack.append(block)
+            pending = None
+        elif brace == '}':
+            if pending is not None or len(stack) == 1:
+                raise ValueError("Unexpected '}' in KeyValues text")
+            stack.pop()
+        else:
+            token = word or quoted
+            if pending is None:
+                pending = token
+            else:
+                stack[-1].pairs.append((pending, token))
+                pending = None
+    if pending is not None or len(stack) > 1:
+        raise ValueError("KeyValues text ends inside a block")
+    return root.children
@@ -0,0 +1,359 @@
+"""
+
+Passes which rework a map so that it is cheaper to compile.
+
+The lightmap passes work on face polygons from the geometry module, so they
+need NumPy. classify_detail() uses them too where NumPy is installed, and
+otherwise makes do with the corners of each brush's planes.
+
+"""
+
+import math
+
+from vmflib import brush, vmf
+
+# Brushes using these materials must stay in the world: VBSP only honours
+# hints and areaportals on world brushes, and the sky is part of the seal.
+STRUCTURAL_MATERIALS = ('tools/toolshint', 'tools/toolsskip',
+    'tools/toolsareaportal', 'tools/toolsskybox', 'tools/toolsinvisible')
+
+# Rough time VRAD spends per luxel on one machine with default settings.
+# This varies a lot with hardware and light count, so calibrate it against
+# your own build times for more meaningful estimates.
+VRAD_SECONDS_PER_LUXEL = 1e-4
+
+
+class DetailReport:
+
+    """The outcome of a classify_detail() pass.
+
+    structural and detail are the world children (Solids or Blocks) placed
+    in each group, and entity is the func_detail entity the detail brushes
+    were moved into (None if nothing was moved). portal_change estimates the
+    relative change in the map's portal count, e.g. -0.25 for a quarter fewer
+    portals, based on how many distinct planes the world is left with.
+
+    """
+
+    def __init__(self, structural, detail, entity, planes_before,
+            planes_after):
+        self.structural = structural
+        self.detail = detail
+        self.entity = entity
+        self.planes_before = planes_before
+        self.planes_after = planes_after
+        self.portal_change = 0.0
+        if planes_before:
+            self.portal_change = planes_after / planes_before - 1
+
+    def __repr__(self):
+        return '<DetailReport: %d structural, %d detail, portals %+.0f%%>' % (
+            len(self.structural), len(self.detail), 100 * self.portal_change)
+
+
+def _is_structural_material(solid):
+    for side in solid.children:
+        if side.material.lower().startswith(STRUCTURAL_MATERIALS):
+            return True
+    return False
+
+
+def _touching(a, b, epsilon):
+    """Returns True if the (mins, maxs) boxes a and b touch or overlap."""
+    (amins, amaxs), (bmins, bmaxs) = a, b
+    for i in range(3):
+        if amins[i] > bmaxs[i] + epsilon or bmins[i] > amaxs[i] + epsilon:
+            return False
+    return True
+
+
+def _touching_groups(indices, bounds, cell_size, epsilon):
+    """Groups the boxes at indices into sets of mutually touching boxes.
+
+    Boxes are bucketed into a grid of cell_size cubes so that only boxes
+    sharing a cell are compared with each other.
+
+    """
+    parent = dict((i, i) for i in indices)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    cells = {}
+    for i in indices:
+        mins, maxs = bounds[i]
+        lo = [int((mins[k] - epsilon) // cell_size) for k in range(3)]
+        hi = [int((maxs[k] + epsilon) // cell_size) for k in range(3)]
+        for x in range(lo[0], hi[0] + 1):
+            for y in range(lo[1], hi[1] + 1):
+                for z in range(lo[2], hi[2] + 1):
+                    cells.setdefault((x, y, z), []).append(i)
+
+    for members in cells.values():
+        for n, i in enumerate(members):
+            for j in members[n + 1:]:
+                if find(i) != find(j) and \
+                        _touching(bounds[i], bounds[j], epsilon):
+                    parent[find(i)] = find(j)
+
+    groups = {}
+    for i in indices:
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def _count_planes(solids):
+    keys = set()
+    for solid in solids:
+        for side in solid.children:
+            if side.plane_key is not None:
+                keys.add(side.plane_key)
+    return len(keys)
+
+
+def classify_detail(valve_map, max_size=128, max_volume=None, wall_size=1024,
+        epsilon=0.01, apply=True):
+    """Moves small world brushes into a func_detail entity.
+
+    Brushes in valve_map's world are split into structural and detail
+    groups. A brush is made detail only if all of these hold:
+
+    * none of its dimensions exceed max_size, and its volume does not
+      exceed max_volume (if given)
+    * it does not reach the outer bounds of the world, so it cannot be part
+      of the map's outer hull
+    * it uses none of the STRUCTURAL_MATERIALS
+    * it is not part of a run of touching small brushes spanning wall_size
+      units or more (such runs act as walls, and keep sealing and blocking
+      visibility). Pass wall_size=None to skip this check.
+
+    Unless apply is False, the detail brushes are then moved out of the
+    world into a new func_detail entity. Returns a DetailReport.
+
+    """
+    world = valve_map.world
+    children = [c for c in world.children
+        if isinstance(vmf._node(c), brush.Solid)]
+    solids = [vmf._node(c) for c in children]
+    if not solids:
+        return DetailReport([], [], None, 0, 0)
+
+    # Use the exact bounds of each brush where its polygons could be found
+    try:
+        from vmflib import geometry
+    except ImportError:
+        bounds = [solid.bounds() for solid in solids]
+    else:
+        windings = geometry.compute_windings(solids)
+        bounds = [solid.bounds() if math.isnan(mins[0]) else (mins, maxs)
+            for solid, mins, maxs in zip(solids, windings.mins.tolist(),
+                windings.maxs.tolist())]
+
+    world_mins = [min(b[0][k] for b in bounds) for k in range(3)]
+    world_maxs = [max(b[1][k] for b in bounds) for k in range(3)]
+
+    candidates = []
+    for i, (mins, maxs) in enumerate(bounds):
+        size = [maxs[k] - mins[k] for k in range(3)]
+        if max(size) > max_size:
+            continue
+        if max_volume is not None and size[0] * size[1] * size[2] > max_volume:
+            continue
+        if any(mins[k] <= world_mins[k] + epsilon or
+                maxs[k] >= world_maxs[k] - epsilon for k in range(3)):
+            continue
+        if _is_structural_material(solids[i]):
+            continue
+        candidates.append(i)
+
+    detail = set(candidates)
+    if wall_size is not None:
+        for group in _touching_groups(candidates, bounds, max_size, epsilon):
+            for k in range(3):
+                extent = max(bounds[i][1][k] for i in group) - \
+                    min(bounds[i][0][k] for i in group)
+                if extent >= wall_size:
+                    detail.difference_update(group)
+                    break
+
+    structural_children = [c for i, c in enumerate(children)
+        if i not in detail]
+    detail_children = [c for i, c in enumerate(children) if i in detail]
+    planes_before = _count_planes(solids)
+    planes_after = _count_planes(
+        [s for i, s in enumerate(solids) if i not in detail])
+
+    entity = None
+    if apply and detail_children:
+        detail_ids = set(id(c) for c in detail_children)
+        world.children[:] = [c for c in world.children
+            if id(c) not in detail_ids]
+
+        entity = vmf.Entity('func_detail', valve_map)
+        entity.children.extend(detail_children)
+
+    return DetailReport(structural_children, detail_children, entity,
+        planes_before, planes_after)
+
+
+class LightmapReport:
+
+    """The outcome of an optimize_lightmaps() pass.
+
+    luxels_before and luxels_after are the map's total luxel counts, and
+    seconds_before and seconds_after the matching VRAD time estimates (see
+    VRAD_SECONDS_PER_LUXEL). changed lists the Sides given a new
+    lightmapscale.
+
+    """
+
+    def __init__(self, luxels_before, luxels_after, changed):
+        self.luxels_before = luxels_before
+        self.luxels_after = luxels_after
+        self.seconds_before = luxels_before * VRAD_SECONDS_PER_LUXEL
+        self.seconds_after = luxels_after * VRAD_SECONDS_PER_LUXEL
+        self.changed = changed
+
+    def __repr__(self):
+        return '<LightmapReport: %d -> %d luxels, %d faces changed>' % (
+            self.luxels_before, self.luxels_after, len(self.changed))
+
+
+def _is_lit(side):
+    """Returns False for faces VRAD doesn't light (nodraw, sky, etc.)."""
+    return not side.material.lower().startswith('tools/')
+
+
+def _origin(entity):
+    """Returns an entity's origin as an (x, y, z) tuple, or None."""
+    if entity.origin is None:
+        return None
+    return tuple(float(c) for c in str(entity.origin).split())
+
+
+def _lightmap_axes(windings):
+    """Returns each face's lightmap (s, t) axes, taken from its uaxis/vaxis."""
+    from vmflib import geometry
+    import numpy
+    u = numpy.array([(s.uaxis.x, s.uaxis.y, s.uaxis.z)
+        for s in windings.sides], dtype=float).reshape(-1, 3)
+    v = numpy.array([(s.vaxis.x, s.vaxis.y, s.vaxis.z)
+        for s in windings.sides], dtype=float).reshape(-1, 3)
+    fallback_u, fallback_v = geometry._face_axes(windings.normals)
+    for axes, fallback in ((u, fallback_u), (v, fallback_v)):
+        lengths = numpy.linalg.norm(axes, axis=1)
+        axes[lengths > 0] /= lengths[lengths > 0, None]
+        axes[lengths == 0] = fallback[lengths == 0]
+    return u, v
+
+
+def _luxels(s_extents, t_extents, scales, lit):
+    """Returns the number of luxels in each face's lightmap."""
+    import numpy
+    s = numpy.ceil(s_extents[1] / scales) - numpy.floor(s_extents[0] / scales)
+    t = numpy.ceil(t_extents[1] / scales) - numpy.floor(t_extents[0] / scales)
+    return numpy.where(lit, (s + 1) * (t + 1), 0)
+
+
+def _lightmap_inputs(valve_map):
+    from vmflib import geometry
+    import numpy
+    windings = geometry.compute_windings(geometry.map_solids(valve_map))
+    s_axis, t_axis = _lightmap_axes(windings)
+    lit = numpy.array([_is_lit(side) for side in windings.sides], dtype=bool)
+    lit &= windings.counts > 0
+    scales = numpy.array([side.lightmapscale for side in windings.sides],
+        dtype=float)
+    return (windings, windings.extents(s_axis), windings.extents(t_axis), lit,
+        scales)
+
+
+def estimate_vrad_cost(valve_map):
+    """Returns (luxels, seconds): the map's luxel count and VRAD estimate."""
+    windings, s_extents, t_extents, lit, scales = _lightmap_inputs(valve_map)
+    luxels = int(_luxels(s_extents, t_extents, scales, lit).sum())
+    return luxels, luxels * VRAD_SECONDS_PER_LUXEL
+
+
+def optimize_lightmaps(valve_map, luxel_budget=None, max_scale=128,
+        large_area=512 * 512, far_distance=4096, apply=True):
+    """Raises lightmapscale on faces where detail in lighting is wasted.
+
+    Every brush face in the map is measured, then:
+
+    * faces VRAD doesn't light (tools/ materials such as nodraw and sky)
+      are set to max_scale, since they cost nothing either way
+    * faces with an area of large_area or more get a scale of at least 32
+    * faces at least far_distance units from every player spawn get a
+      scale of at least 64 (skipped if the map has no info_player_* spawns)
+    * if luxel_budget is given, scales are then doubled, preferring the
+      faces where that saves the most luxels (weighted towards faces far
+      from spawns), until the map fits the budget or no face can go higher
+
+    Scales are never lowered, or raised above max_scale. Pass None for
+    large_area or far_distance to skip those steps. Unless apply is False,
+    the new scales are stored on the Sides. Returns a LightmapReport.
+
+    """
+    import numpy
+    windings, s_extents, t_extents, lit, old_scales = \
+        _lightmap_inputs(valve_map)
+    scales = old_scales.copy()
+    has_polygon = windings.counts > 0
+
+    def raise_to(mask, scale):
+        scale = min(scale, max_scale)
+        scales[mask] = numpy.maximum(scales[mask], scale)
+
+    raise_to(has_polygon & ~lit, max_scale)
+    if large_area is not None:
+        raise_to(lit & (windings.areas >= large_area), 32)
+
+    # Work out how far each face is from the nearest spawn
+    distance = numpy.zeros(len(windings))
+    spawns = [_origin(child) for child in valve_map.children
+        if isinstance(child, vmf.Entity) and
+        child.classname.startswith('info_player')]
+    spawns = numpy.array([o for o in spawns if o is not None], dtype=float)
+    if far_distance is not None and len(spawns):
+        face_ids = windings.face_ids()
+        centres = numpy.stack([numpy.bincount(face_ids,
+            windings.points[:, k], minlength=len(windings))
+            for k in range(3)], axis=1)
+        centres /= numpy.maximum(windings.counts, 1)[:, None]
+        distance = numpy.full(len(windings), numpy.inf)
+        for spawn in spawns:
+            distance = numpy.minimum(distance,
+                numpy.linalg.norm(centres - spawn, axis=1))
+        raise_to(lit & (distance >= far_distance), 64)
+        weight = 1 + distance / far_distance
+    else:
+        weight = numpy.ones(len(windings))
+
+    luxels = _luxels(s_extents, t_extents, scales, lit)
+    while luxel_budget is not None and luxels.sum() > luxel_budget:
+        candidates = numpy.flatnonzero(lit & (scales * 2 <= max_scale))
+        if not len(candidates):
+            break
+        saving = luxels[candidates] - _luxels(
+            (s_extents[0][candidates], s_extents[1][candidates]),
+            (t_extents[0][candidates], t_extents[1][candidates]),
+            scales[candidates] * 2, True)
+        order = numpy.argsort(-saving * weight[candidates], kind='stable')
+        needed = luxels.sum() - luxel_budget
+        count = numpy.searchsorted(numpy.cumsum(saving[order]), needed) + 1
+        chosen = candidates[order[:count]]
+        scales[chosen] *= 2
+        luxels = _luxels(s_extents, t_extents, scales, lit)
+
+    changed = [windings.sides[i]
+        for i in numpy.flatnonzero(scales != old_scales)]
+    if apply:
+        for i in numpy.flatnonzero(scales != old_scales):
+            windings.sides[i].lightmapscale = int(scales[i])
+
+    luxels_before = int(_luxels(s_extents, t_extents, old_scales, lit).sum())
+    return LightmapReport(luxels_before, int(luxels.sum()), changed)
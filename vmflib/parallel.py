@@ -0,0 +1,160 @@
+"""
+
+Generating a map in parallel, a region at a time.
+
+generate() splits the map's area into a grid of regions and runs a
+generator function on each of them in a pool of processes. Every region
+gets its own random seed and numbers its ids from zero, so what a region
+produces doesn't depend on which process made it, or when. The pieces
+are then renumbered and added to one ValveMap in a fixed order, which
+makes the written VMF the same whatever the number of processes.
+
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import random
+
+from vmflib import brush, vmf
+
+
+class Region:
+
+    """One part of a map being made by generate().
+
+    index is the region's (column, row) in the grid, and mins and maxs its
+    (x, y, z) corners. seed is derived from the seed given to generate()
+    and the index, and random is a random.Random seeded with it, so a
+    generator using it makes the same region every time.
+
+    """
+
+    def __init__(self, index, mins, maxs, seed):
+        self.index = index
+        self.mins = mins
+        self.maxs = maxs
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def __repr__(self):
+        return 'Region(%r, %r - %r)' % (self.index, self.mins, self.maxs)
+
+
+def regions(mins, maxs, size, seed=0):
+    """Splits the box from mins to maxs into a grid of Regions.
+
+    size is the width of a region, or its (width, depth); regions at the
+    far edges are cut short to fit. The whole height of the box goes in
+    every region. Regions are listed row by row.
+
+    """
+    if not isinstance(size, (tuple, list)):
+        size = (size, size)
+    if size[0] <= 0 or size[1] <= 0:
+        raise ValueError("Region size must be positive")
+    result = []
+    y, row = mins[1], 0
+    while y < maxs[1]:
+        x, column = mins[0], 0
+        while x < maxs[0]:
+            key = ('%s:%d:%d' % (seed, column, row)).encode('utf-8')
+            region_seed = int.from_bytes(hashlib.sha256(key).digest()[:8],
+                'big')
+            result.append(Region((column, row),
+                (x, y, mins[2]),
+                (min(x + size[0], maxs[0]), min(y + size[1], maxs[1]),
+                    maxs[2]),
+                region_seed))
+            x, column = x + size[0], column + 1
+        y, row = y + size[1], row + 1
+    return result
+
+
+def _counters():
+    return (vmf.Entity.entitycount, brush.Solid.solid_count,
+        brush.Group.group_count)
+
+
+def _set_counters(entities, solids, groups):
+    vmf.Entity.entitycount = entities
+    brush.Solid.solid_count = solids
+    brush.Group.group_count = groups
+
+
+def _run(generator, region):
+    """Runs generator on one region, in a map of its own.
+
+    Returns the region's world children and entities, detached from that
+    map so that only they are sent back to the parent process, and how
+    many entity, brush and group ids it used (counting from zero).
+
+    """
+    saved = (vmf.ValveMap.instance, vmf.World.worldcount, _counters())
+    try:
+        valve_map = vmf.ValveMap()
+        _set_counters(0, 0, 0)
+        generator(valve_map, region)
+        used = _counters()
+    finally:
+        vmf.ValveMap.instance, vmf.World.worldcount = saved[:2]
+        _set_counters(*saved[2])
+
+    world = list(valve_map.world.children)
+    entities = [child for child in valve_map.children
+        if child not in (valve_map.world, valve_map.cameras,
+            valve_map.cordon)]
+    for child in world + entities:
+        node = vmf._node(child)
+        if isinstance(node, vmf.VmfClass):
+            node._parent = None
+    return world, entities, used
+
+
+def _merge(valve_map, results):
+    """Adds what each region made to the map, in region order.
+
+    Each region's ids are moved up to follow on from those handed out
+    before it, so however many regions there are, ids are only used once.
+
+    """
+    for world, entities, used in results:
+        bases = dict(zip(('entity', 'solid', 'group'), _counters()),
+            visgroupid=0)
+        highest = collections.Counter()
+        for child in world + entities:
+            for node in vmf._walk(vmf._node(child)):
+                vmf._relocate(node, bases, highest, None, None, ())
+        _set_counters(*(base + count
+            for base, count in zip(_counters(), used)))
+        valve_map.world.children.extend(world)
+        valve_map.children.extend(entities)
+
+
+def generate(generator, mins, maxs, size, valve_map=None, seed=0, jobs=None):
+    """Makes a map by running generator on each region of a grid in parallel.
+
+    The area from mins to maxs is split into regions as regions() does,
+    and generator(valve_map, region) is called for each Region. It should
+    add brushes to valve_map.world and entities to the map as usual. Up to
+    jobs processes are used (as many as there are CPUs by default, and none
+    besides this one if jobs is 1), so generator must be a function defined
+    at the top level of a module, for the processes to find it.
+
+    What each region made is added to valve_map (or a new ValveMap) in
+    region order, and the map is returned. Each region's ids are then
+    renumbered to follow on from the ids handed out before it, so the map's
+    VMF is the same however many processes are used. The ids a generator
+    sees are only provisional, so it shouldn't copy them into keyvalues.
+
+    """
+    if valve_map is None:
+        valve_map = vmf.ValveMap()
+    grid = regions(mins, maxs, size, seed)
+
+    if jobs == 1 or len(grid) <= 1:
+        _merge(valve_map, (_run(generator, region) for region in grid))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            _merge(valve_map, pool.map(_run, [generator] * len(grid), grid))
+    return valve_map
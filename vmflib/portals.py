@@ -0,0 +1,191 @@
+"""
+
+Reading VBSP's portal files, to see where VVIS spends its time.
+
+Alongside a map's BSP, VBSP writes a .prt file listing the map's
+visibility clusters (groups of leaves VVIS treats as one) and the portals
+joining them. VVIS works out what can be seen through each portal, so its
+time grows quickly with the number of portals, and most of it goes on the
+parts of the map where portals are packed most densely. Hint brushes, or
+moving small world brushes into func_detail, thin them out.
+
+This module needs NumPy.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("vmflib.portals needs NumPy; install it with "
+        "'pip install vmflib[numpy]'") from None
+
+from vmflib import brush, vmf
+
+
+class Portals:
+
+    """The clusters and portals of a compiled map, as read by read_prt().
+
+    The polygon of portal i is points[offsets[i]:offsets[i + 1]], and it
+    joins clusters[i, 0] and clusters[i, 1].
+
+    Per-portal arrays: clusters, counts, centers, areas, mins, maxs.
+
+    """
+
+    def __init__(self, cluster_count, clusters, points, offsets):
+        self.cluster_count = cluster_count
+        self.clusters = clusters
+        self.points = points
+        self.offsets = offsets
+        self.counts = numpy.diff(offsets)
+
+        portal_ids = numpy.repeat(numpy.arange(len(self)), self.counts)
+        following = numpy.arange(len(points)) + 1
+        following[offsets[1:] - 1] = offsets[:-1]
+        cross = numpy.cross(points, points[following])
+        self.areas = 0.5 * numpy.linalg.norm(self._sum(portal_ids, cross),
+            axis=1)
+        self.centers = self._sum(portal_ids, points) / numpy.maximum(
+            self.counts, 1)[:, None]
+        self.mins = numpy.minimum.reduceat(points, offsets[:-1]) \
+            if len(self) else numpy.zeros((0, 3))
+        self.maxs = numpy.maximum.reduceat(points, offsets[:-1]) \
+            if len(self) else numpy.zeros((0, 3))
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def _sum(self, portal_ids, values):
+        """Adds up rows of values for each portal."""
+        return numpy.stack([numpy.bincount(portal_ids, values[:, k],
+            minlength=len(self)) for k in range(3)], axis=1)
+
+    def cluster_portals(self):
+        """Returns the number of portals leading out of each cluster."""
+        return numpy.bincount(self.clusters.ravel(),
+            minlength=self.cluster_count)
+
+    def density(self, cell_size=512):
+        """Counts the portals in each cell of a grid laid over the map.
+
+        Portals are counted in the cell their centre falls in. Returns
+        (mins, counts) for each cell holding any portals, busiest first,
+        where mins is the cell's lowest corner.
+
+        """
+        cells = numpy.floor(self.centers / cell_size).astype(int)
+        if not len(cells):
+            return numpy.zeros((0, 3)), numpy.zeros(0, dtype=int)
+        cells, counts = numpy.unique(cells, axis=0, return_counts=True)
+        order = numpy.argsort(-counts, kind='stable')
+        return cells[order] * float(cell_size), counts[order]
+
+    def summary(self):
+        """Returns the headline figures, as a dict of plain numbers."""
+        per_cluster = self.cluster_portals()
+        return {
+            'clusters': self.cluster_count,
+            'portals': len(self),
+            'portals_per_cluster': (float(per_cluster.mean())
+                if self.cluster_count else 0.0),
+            'most_portals_in_a_cluster': int(per_cluster.max())
+                if self.cluster_count else 0,
+            'portal_area': float(self.areas.sum()),
+        }
+
+
+def read_prt(filename):
+    """Reads the portal file (PRT1 format) that VBSP writes for a map."""
+    with open(filename) as f:
+        if f.readline().strip() != 'PRT1':
+            raise ValueError("%s isn't a PRT1 portal file" % filename)
+        try:
+            cluster_count = int(f.readline())
+            portal_count = int(f.readline())
+        except ValueError:
+            raise ValueError("%s has a bad header" % filename)
+        # Each portal is "points cluster cluster (x y z ) (x y z ) ..."
+        heads = []
+        coords = []
+        for i in range(portal_count):
+            line = f.readline()
+            split = line.find('(')
+            if split < 0:
+                raise ValueError("%s ends before its last portal" % filename)
+            heads.append(line[:split])
+            coords.append(line[split:])
+
+    heads = numpy.array(' '.join(heads).split(), dtype=int).reshape(-1, 3)
+    coords = ' '.join(coords).translate(str.maketrans('()', '  '))
+    points = numpy.array(coords.split(), dtype=float)
+    counts = heads[:, 0]
+    if len(points) != 3 * counts.sum():
+        raise ValueError("%s has portals with the wrong number of points" %
+            filename)
+    offsets = numpy.zeros(portal_count + 1, dtype=int)
+    numpy.cumsum(counts, out=offsets[1:])
+    return Portals(cluster_count, heads[:, 1:], points.reshape(-1, 3),
+        offsets)
+
+
+class Hotspot:
+
+    """A part of the map crowded with portals; see hotspots().
+
+    mins and maxs are the corners of the region, portals is how many
+    portals are centred in it, and clusters how many clusters they lead
+    into. brushes lists the world brushes touching the region, as they
+    appear in the world's children (so as tools.Blocks where they are).
+
+    """
+
+    def __init__(self, mins, maxs, portals, clusters, brushes=None):
+        self.mins = mins
+        self.maxs = maxs
+        self.portals = portals
+        self.clusters = clusters
+        self.brushes = brushes or []
+
+    def __repr__(self):
+        return 'Hotspot(%s - %s, %d portals, %d clusters, %d brushes)' % (
+            tuple(self.mins), tuple(self.maxs), self.portals, self.clusters,
+            len(self.brushes))
+
+
+def hotspots(portals, valve_map=None, cell_size=512, count=10):
+    """Finds the parts of a map where portals are packed most densely.
+
+    Returns a Hotspot for each of the count busiest cells of a grid of
+    cell_size units, busiest first. If the map is given, each one lists
+    the world brushes touching it. Only world brushes make portals, so
+    these are the ones worth moving into func_detail, or cutting across
+    with hint brushes.
+
+    """
+    mins, counts = portals.density(cell_size)
+    cells = numpy.floor(portals.centers / cell_size).astype(int)
+
+    children = []
+    if valve_map is not None:
+        children = [child for child in valve_map.world.children
+            if isinstance(vmf._node(child), brush.Solid)]
+    if children:
+        bounds = numpy.array([vmf._node(child).bounds()
+            for child in children], dtype=float)
+
+    result = []
+    for cell_mins, portal_count in zip(mins[:count], counts[:count]):
+        cell_maxs = cell_mins + cell_size
+        inside = numpy.all(cells == numpy.floor(cell_mins / cell_size)
+            .astype(int), axis=1)
+        clusters = len(numpy.unique(portals.clusters[inside]))
+        near = []
+        if children:
+            touching = numpy.all((bounds[:, 0] <= cell_maxs) &
+                (bounds[:, 1] >= cell_mins), axis=1)
+            near = [children[i] for i in numpy.nonzero(touching)[0]]
+        result.append(Hotspot(tuple(float(c) for c in cell_mins),
+            tuple(float(c) for c in cell_maxs),
+            int(portal_count), clusters, near))
+    return result
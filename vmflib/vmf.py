@@ -4,9 +4,318 @@ Main classes for working with VMF maps.
 
 """
 
+import bisect
+import collections
+import os
+
 from vmflib import types
 
 
+# Known limits of the Source Engine map compilers (see bspfile.h). These are
+# the defaults used by ValveMap.stats() and strict mode; pass your own limits
+# to ValveMap() if your game's branch differs.
+ENGINE_LIMITS = {
+    'brushes': 8192,            # MAX_MAP_BRUSHES
+    'brushsides': 65536,        # MAX_MAP_BRUSHSIDES
+    'entities': 8192,           # MAX_MAP_ENTITIES
+    'planes': 65536,            # MAX_MAP_PLANES
+    'displacements': 2048,      # MAX_MAP_DISPINFO
+}
+
+# The entity keys ValveMap indexes, to find entities by them quickly.
+ENTITY_INDEXES = ('targetname', 'classname')
+
+# Entity keys whose values are the targetname of another entity, which
+# ValveMap.merge() renames along with the entities they refer to.
+NAME_KEYS = ('target', 'parentname', 'filtername', 'damagefilter',
+    'lightingorigin')
+
+# Every statistic reported by ValveMap.stats(), in display order.
+STAT_NAMES = ['brushes', 'brushsides', 'entities', 'planes', 'displacements',
+    'connections']
+
+
+class MapLimitError(Exception):
+
+    """Raised by a strict ValveMap when a change would exceed a limit."""
+
+
+def _node(child):
+    """Returns the VmfClass that a child stands for (e.g. a Block's brush)."""
+    if isinstance(child, VmfClass):
+        return child
+    return getattr(child, 'brush', child)
+
+
+def _root(node):
+    """Returns the top-most ancestor of node."""
+    while node._parent is not None:
+        node = node._parent
+    return node
+
+
+def _walk(node):
+    """Yields node and all VmfClass objects beneath it."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, VmfClass):
+            yield node
+            stack.extend(_node(child) for child in node.children)
+
+
+def _delay(output):
+    """Returns an Output's delay in seconds (0 if it isn't a number)."""
+    try:
+        return float(output.delay)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _cycles(edges):
+    """Yields the groups of nodes in a directed graph that form cycles.
+
+    edges maps each node to the nodes it leads to. These are the strongly
+    connected components with more than one node, or with a node leading
+    to itself, found with Tarjan's algorithm (without recursion, so long
+    chains don't hit Python's recursion limit).
+
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    for start in edges:
+        if start in index:
+            continue
+        index[start] = low[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(edges[start]))]
+        while work:
+            node, following = work[-1]
+            for child in following:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(edges.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in edges.get(node, ()):
+                        yield component
+
+
+def _tidy(number):
+    """Returns a float that is a whole number as an int, for writing."""
+    if isinstance(number, float) and number.is_integer():
+        return int(number)
+    return number
+
+
+def _moved(point, offset):
+    """Returns a position moved by offset, in the same form it was given.
+
+    The position can be a Vertex, an Origin, a tuple, or a string (like an
+    entity's origin) of three numbers, optionally in brackets.
+
+    """
+    if isinstance(point, (types.Vertex, types.Origin)):
+        return type(point)(_tidy(point.x + offset.x),
+            _tidy(point.y + offset.y), _tidy(point.z + offset.z))
+    if isinstance(point, (tuple, list)):
+        return type(point)(_tidy(value + delta) for value, delta in
+            zip(point, (offset.x, offset.y, offset.z)))
+    text = str(point)
+    inner = text.strip('()[] ')
+    values = [float(value) for value in inner.split()]
+    moved = ' '.join(str(_tidy(value + delta)) for value, delta in
+        zip(values, (offset.x, offset.y, offset.z)))
+    return text[:text.index(inner[0])] + moved + text[text.rindex(
+        inner[-1]) + 1:]
+
+
+def _relocate(node, bases, highest, offset, prefix, names):
+    """Renumbers, moves and renames one node for ValveMap.merge()."""
+    name = node.vmf_class_name
+    p = node.properties
+    if 'visgroupid' in p:
+        p['visgroupid'] = int(p['visgroupid']) + bases['visgroupid']
+
+    if name in ('solid', 'side', 'group'):
+        kind = 'group' if name == 'group' else 'solid'
+        p['id'] += bases[kind]
+        highest[kind] = max(highest[kind], p['id'] + 1)
+        if name == 'side' and offset is not None:
+            plane = node.plane
+            node.plane = types.Plane(_moved(plane.v0, offset),
+                _moved(plane.v1, offset), _moved(plane.v2, offset))
+            # Keep the texture where it was on the brush
+            for attr in ('uaxis', 'vaxis'):
+                axis = getattr(node, attr)
+                shift = axis.x * offset.x + axis.y * offset.y + \
+                    axis.z * offset.z
+                setattr(node, attr, types.Axis(axis.x, axis.y, axis.z,
+                    _tidy(axis.translate - shift / axis.scale)
+                    if axis.scale else axis.translate, axis.scale))
+    elif name == 'dispinfo' and offset is not None:
+        node.startposition = _moved(node.startposition, offset)
+
+    elif isinstance(node, EntityTable):
+        node.first_id += bases['entity']
+        highest['entity'] = max(highest['entity'],
+            node.first_id + len(node))
+        columns = node.columns
+        if offset is not None:
+            columns['origin'] = [_moved(origin, offset)
+                for origin in columns['origin']]
+        if prefix:
+            for key in ('targetname',) + NAME_KEYS:
+                values = columns.get(key)
+                if isinstance(values, list):
+                    columns[key] = [_prefixed(value, prefix, names)
+                        for value in values]
+                elif values is not None:
+                    columns[key] = _prefixed(values, prefix, names)
+
+    elif isinstance(node, Entity):
+        p['id'] += bases['entity']
+        highest['entity'] = max(highest['entity'], p['id'] + 1)
+        if offset is not None and node.origin is not None:
+            node.origin = _moved(node.origin, offset)
+        if prefix:
+            node.targetname = _prefixed(node.targetname, prefix, names)
+            for key in NAME_KEYS:
+                if key in p:
+                    p[key] = _prefixed(p[key], prefix, names)
+                elif getattr(node, key, None) is not None:
+                    setattr(node, key, _prefixed(getattr(node, key), prefix,
+                        names))
+
+    elif isinstance(node, Connections) and prefix:
+        for output in node.children:
+            output.target = _prefixed(output.target, prefix, names)
+
+
+def _prefixed(name, prefix, names):
+    """Adds prefix to a name (or wildcard) if it refers to one of names."""
+    if name is None or name == '':
+        return name
+    lowered = str(name).lower()
+    star = lowered.find('*')
+    if star < 0:
+        found = lowered in names
+    else:
+        found = any(other.startswith(lowered[:star]) for other in names)
+    return prefix + str(name) if found else name
+
+
+def _keyvalue(entity, key):
+    """Returns the value of one of an entity's keys, or None."""
+    if key in entity.properties:
+        return entity.properties[key]
+    return getattr(entity, key, None)
+
+
+class ChildList(list):
+
+    """The list of children of a VmfClass.
+
+    This behaves exactly like a normal list, but tells its owner whenever
+    children are added or removed, so that map statistics can be kept up to
+    date without walking the whole map.
+
+    """
+
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, iterable=()):
+        self.owner = owner
+        if iterable:
+            self.extend(iterable)
+
+    def append(self, child):
+        list.append(self, child)
+        try:
+            self.owner._child_added(child)
+        except MapLimitError:
+            list.pop(self)
+            raise
+
+    def extend(self, iterable):
+        owner = self.owner
+        for child in iterable:
+            list.append(self, child)
+            try:
+                owner._child_added(child)
+            except MapLimitError:
+                list.pop(self)
+                raise
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def __imul__(self, n):
+        if n <= 0:
+            self.clear()
+        else:
+            self.extend(list(self) * (n - 1))
+        return self
+
+    def insert(self, index, child):
+        list.insert(self, index, child)
+        try:
+            self.owner._child_added(child)
+        except MapLimitError:
+            list.remove(self, child)
+            raise
+
+    def remove(self, child):
+        list.remove(self, child)
+        self.owner._child_removed(child)
+
+    def pop(self, index=-1):
+        child = list.pop(self, index)
+        self.owner._child_removed(child)
+        return child
+
+    def clear(self):
+        while self:
+            self.pop()
+
+    def __delitem__(self, key):
+        removed = self[key] if isinstance(key, slice) else [self[key]]
+        list.__delitem__(self, key)
+        for child in removed:
+            self.owner._child_removed(child)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            removed, added = self[key], list(value)
+        else:
+            removed, added = [self[key]], [value]
+        list.__setitem__(self, key, value)
+        for child in removed:
+            self.owner._child_removed(child)
+        for child in added:
+            self.owner._child_added(child)
+
+
 ###############################################################################
 ### This is a base class for the VMF "Classes" we will define further down. ###
 ###############################################################################
@@ -16,21 +325,118 @@ class VmfClass:
     """A class representing a KeyValue group in the VMF KeyValues structure."""
 
     vmf_class_name = 'UntitledClass'
+    own_stats = {}          # What one instance adds to the map's statistics
+
+    _parent = None
+    _sources = ()           # Children made as the map is written
 
     def __init__(self):
         self.properties = {}
         self.auto_properties = []
-        self.children = []
+        self._stats = None      # Worked out by _tally() once in a map
+        self._children = ChildList(self)
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        if '_children' in self.__dict__:
+            self._children.clear()
+        self._children = ChildList(self, value)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_children'] = list(self._children)
+        return state
+
+    def __setstate__(self, state):
+        # The children's stats are already in ours, so don't add them again
+        children = state.pop('_children')
+        self.__dict__.update(state)
+        self._children = ChildList(self)
+        list.extend(self._children, children)
+
+    def _child_stats(self, child):
+        """Returns what child (and everything beneath it) adds to our stats."""
+        node = _node(child)
+        if isinstance(node, VmfClass):
+            return node._tally()
+        return {}
+
+    def _tally(self):
+        """Works out our stats, and those of everything beneath us.
+
+        Stats are only kept up to date within a map, so a subtree built
+        before being added to one is counted in a single pass instead.
+
+        """
+        stats = dict(self.own_stats)
+        for child in self.children:
+            for name, value in self._child_stats(child).items():
+                stats[name] = stats.get(name, 0) + value
+        self._stats = stats
+        return stats
+
+    def _child_added(self, child):
+        node = _node(child)
+        if not isinstance(node, VmfClass):
+            return
+        node._parent = self
+        if self._parent is None and not isinstance(self, ValveMap):
+            return          # Not in a map; counted when it's added to one
+        root = _root(self)
+        if isinstance(root, ValveMap):
+            root._register(node, 1)
+            try:
+                root._check_limits(self)
+            except MapLimitError:
+                root._register(node, -1)
+                node._parent = None
+                raise
+
+    def _child_removed(self, child):
+        node = _node(child)
+        if not isinstance(node, VmfClass):
+            return
+        root = _root(self)
+        if isinstance(root, ValveMap):
+            root._register(node, -1)
+        if node._parent is self:
+            node._parent = None
+
+    def _propagate(self, stats, sign):
+        """Adds (or subtracts) stats to ourself and all of our ancestors."""
+        if not stats:
+            return
+        node = self
+        while node is not None:
+            counts = node._stats
+            for name, value in stats.items():
+                counts[name] = counts.get(name, 0) + sign * value
+            node = node._parent
 
     # Render this class as a string
     def __repr__(self, tab_level=-1):
-        string = ''
+        pieces = []
+        self._write(pieces.append, tab_level)
+        return ''.join(pieces)
+
+    def _write(self, write, tab_level=-1, sources=False):
+        """Renders this class as __repr__ does, passing the text to write()
+        a piece at a time instead of building one big string.
+
+        Children from add_source() sources are only made and written if
+        sources is True; __repr__ leaves them alone, so looking at a map
+        doesn't use up its generators.
+
+        """
 
         # Generate line prefixes (tab characters) for later
-        tab_prefix = ''
-        for i in range(tab_level):
-            tab_prefix += '\t'
+        tab_prefix = '\t' * tab_level
         tab_prefix_inner = tab_prefix + '\t'
+        string = ''
 
         # Generate class declaration and opening brace
         if (self.vmf_class_name):
@@ -46,16 +452,83 @@ class VmfClass:
         # Print properties
         for item in self.properties.items():
             string += '%s"%s" "%s"\n' % (tab_prefix_inner, item[0], item[1])
+        write(string)
 
-        # Print child groups
+        # Print child groups, then any made by sources as we go
         for child in self.children:
-            string += child.__repr__(tab_level + 1)
+            _write_child(write, child, tab_level + 1, sources)
+        if sources:
+            for source in self._sources:
+                source.write(self, write, tab_level + 1)
 
         # Print close brace
         if (self.vmf_class_name):
-            string += tab_prefix + '}\n'
+            write(tab_prefix + '}\n')
 
-        return string
+
+def _write_child(write, child, tab_level, sources=False):
+    """Writes a child, streaming it too unless it renders itself."""
+    if isinstance(child, VmfClass) and \
+            type(child).__repr__ is VmfClass.__repr__:
+        child._write(write, tab_level, sources)
+    else:
+        write(child.__repr__(tab_level))
+
+
+class _ChildSource:
+
+    """An iterable of children that are only made as the map is written.
+
+    Entity.add_source() makes these. stats and planes hold what the
+    children added to the map the last time they were written, so that
+    writing the map again doesn't count them twice.
+
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.stats = collections.Counter()
+        self.planes = collections.Counter()
+
+    def write(self, owner, write, tab_level):
+        root = _root(owner)
+        counted = isinstance(root, ValveMap)
+        if counted:
+            root._flush()           # So that owner's stats are current
+            owner._propagate(self.stats, -1)
+            for key, count in self.planes.items():
+                for i in range(count):
+                    root._add_plane(key, -1)
+        self.stats.clear()
+        self.planes.clear()
+
+        for child in self.iterable:
+            node = _node(child)
+            if isinstance(node, VmfClass):
+                node._parent = owner
+            if counted:
+                stats = owner._child_stats(child)
+                owner._propagate(stats, 1)
+                self.stats.update(stats)
+                keys = [item.plane_key for item in _walk(node)
+                    if getattr(item, 'plane_key', None) is not None]
+                for key in keys:
+                    root._add_plane(key, 1)
+                try:
+                    root._check_limits(owner)
+                except MapLimitError:
+                    # Take the child back out, as ChildList.append() does
+                    for key in keys:
+                        root._add_plane(key, -1)
+                    owner._propagate(stats, -1)
+                    self.stats.subtract(stats)
+                    if isinstance(node, VmfClass):
+                        node._parent = None
+                    raise
+                self.planes.update(keys)
+            _write_child(write, child, tab_level, True)
+            if isinstance(node, VmfClass):
+                node._parent = None
 
 
 ###############################################################
@@ -111,12 +584,18 @@ class Cordon(VmfClass):
 
 class Entity(VmfClass):
 
-    """A class representing an entity class in a Valve Map."""
+    """A class representing an entity class in a Valve Map.
+
+    The entity adds itself to valve_map, or if that isn't given, to the
+    ValveMap created most recently.
+
+    """
 
     vmf_class_name = 'entity'
+    own_stats = {'entities': 1}
     entitycount = 0
 
-    def __init__(self, class_name):
+    def __init__(self, class_name, valve_map=None):
         VmfClass.__init__(self)
         self.classname = class_name
         self.spawnflags = 0
@@ -130,9 +609,71 @@ class Entity(VmfClass):
         p['id'] = Entity.entitycount
         Entity.entitycount += 1            # Increment entity counter
         
-        # Add ourself to the active map
-        if ValveMap.instance:
-            ValveMap.instance.children.append(self)
+        # Add ourself to the given map, or else the active one
+        if valve_map is None:
+            valve_map = ValveMap.instance
+        if valve_map:
+            _add_to_map(valve_map, self, p['id'], 1)
+
+    def add_source(self, source):
+        """Adds children that are only made when the map is written.
+
+        source is an iterable of children, such as a generator of Blocks.
+        As the map is written, each child is made, written out and let go
+        of before the next, so a huge map never needs to be in memory all
+        at once. Children are counted in stats() (and checked against
+        strict limits) as they are written, and get their ids as they are
+        made. Nothing else that looks through the map, such as query() or
+        export_obj(), sees them.
+
+        A generator can only be written once. To write the map more than
+        once, pass something that can be iterated over again, like a list
+        or an object with an __iter__() method.
+
+        """
+        if not self._sources:
+            self._sources = []
+        self._sources.append(_ChildSource(source))
+
+    _targetname = None
+    _classname = None
+
+    @property
+    def targetname(self):
+        return self._targetname
+
+    @targetname.setter
+    def targetname(self, name):
+        root = _root(self) if self._parent is not None else None
+        if isinstance(root, ValveMap) and root._tracks(self):
+            root._rename(self, 'targetname', self._targetname, name)
+        self._targetname = name
+
+    @property
+    def classname(self):
+        return self._classname
+
+    @classname.setter
+    def classname(self, name):
+        root = _root(self) if self._parent is not None else None
+        if isinstance(root, ValveMap) and root._tracks(self):
+            root._rename(self, 'classname', self._classname, name)
+        self._classname = name
+
+
+def _add_to_map(valve_map, entity, first_id, count):
+    """Adds a new entity (or table) to a map.
+
+    If a strict map turns it away, the ids it took are given back, so the
+    next entity doesn't leave a gap.
+
+    """
+    try:
+        valve_map.children.append(entity)
+    except MapLimitError:
+        if Entity.entitycount == first_id + count:
+            Entity.entitycount = first_id
+        raise
 
 
 class Connections(VmfClass):
@@ -148,6 +689,27 @@ class Connections(VmfClass):
 
     vmf_class_name = "connections"
 
+    def _child_stats(self, output):
+        return {'connections': 1}
+
+    def _child_added(self, output):
+        root = _root(self)
+        if isinstance(root, ValveMap) and root._tracks(self):
+            self._propagate(self._child_stats(output), 1)
+            root._index_output(self._parent, output, 1)
+            try:
+                root._check_limits(self)
+            except MapLimitError:
+                root._index_output(self._parent, output, -1)
+                self._propagate(self._child_stats(output), -1)
+                raise
+
+    def _child_removed(self, output):
+        root = _root(self)
+        if isinstance(root, ValveMap) and root._tracks(self):
+            root._index_output(self._parent, output, -1)
+            self._propagate(self._child_stats(output), -1)
+
     # Render this class as a string
     def __repr__(self, tab_level=-1):
         string = ''
@@ -198,6 +760,110 @@ class World(Entity):
         p['mapversion'] = 0
 
 
+def _column(values):
+    """Returns a column of values (a list, NumPy array...) as a list."""
+    tolist = getattr(values, 'tolist', None)
+    return tolist() if tolist else list(values)
+
+
+class EntityTable(VmfClass):
+
+    """Many point entities of one class, stored as columns of values.
+
+    Creating an Entity for each of tens of thousands of pickups, props or
+    spawns is slow. A table keeps their keyvalues in lists instead, hands
+    out their ids in one block, and writes them straight out as entity
+    classes. entity(i) makes a full Entity for one row when it's needed.
+
+    origins holds an (x, y, z) for each entity, and angles (if given) a
+    (pitch, yaw, roll); either can be an (n, 3) NumPy array. properties
+    maps any other keys to a sequence with a value for each entity, or to
+    one value that they all share.
+
+    Like an Entity, a table adds itself to the active map.
+
+    """
+
+    vmf_class_name = 'entity'
+
+    def __init__(self, classname, origins, angles=None, properties=None):
+        VmfClass.__init__(self)
+        self.classname = classname
+        origins = _column(origins)
+        self.count = len(origins)
+
+        # Key -> list of values, or a single value shared by every row
+        self.columns = collections.OrderedDict()
+        self.columns['classname'] = classname
+        self.columns['spawnflags'] = 0
+        self.columns['origin'] = ['%s %s %s' % tuple(o) for o in origins]
+        if angles is not None:
+            self.columns['angles'] = ['%s %s %s' % tuple(a)
+                for a in _column(angles)]
+        for key, values in (properties or {}).items():
+            if isinstance(values, str) or not hasattr(values, '__len__'):
+                self.columns[key] = values
+            else:
+                self.columns[key] = _column(values)
+        for key, values in self.columns.items():
+            if isinstance(values, list) and len(values) != self.count:
+                raise ValueError("Column %s has %d values for %d entities" %
+                    (key, len(values), self.count))
+
+        self.first_id = Entity.entitycount
+        Entity.entitycount += self.count
+        self.own_stats = {'entities': self.count}
+
+        # Add ourself to the active map
+        if ValveMap.instance:
+            _add_to_map(ValveMap.instance, self, self.first_id, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def row(self, i):
+        """Returns the (key, value) pairs of entity i, apart from its id."""
+        return [(key, values[i] if isinstance(values, list) else values)
+            for key, values in self.columns.items()]
+
+    def entity(self, i):
+        """Returns a new Entity with the keyvalues (and id) of row i.
+
+        The Entity isn't added to the map, and changing it doesn't change
+        the table.
+
+        """
+        entity = Entity.__new__(Entity)
+        VmfClass.__init__(entity)
+        entity.targetname = None
+        entity.auto_properties = []
+        for key, value in self.row(i):
+            setattr(entity, key, value)
+            entity.auto_properties.append(key)
+        if 'targetname' not in entity.auto_properties:
+            entity.auto_properties.append('targetname')
+        entity.properties['id'] = self.first_id + i
+        return entity
+
+    # Render the table as one entity class per row
+    def __repr__(self, tab_level=-1):
+        tab_prefix = '\t' * tab_level
+        tab_prefix_inner = tab_prefix + '\t'
+        lines = []
+        for key, values in self.columns.items():
+            if isinstance(values, list):
+                lines.append(['%s"%s" "%s"\n' % (tab_prefix_inner, key, value)
+                    for value in values])
+            else:
+                lines.append(['%s"%s" "%s"\n' % (tab_prefix_inner, key,
+                    values)] * self.count)
+        lines.append(['%s"id" "%d"\n' % (tab_prefix_inner, self.first_id + i)
+            for i in range(self.count)])
+        head = '%s%s\n%s{\n' % (tab_prefix, self.vmf_class_name, tab_prefix)
+        tail = tab_prefix + '}\n'
+        return ''.join(head + ''.join(row) + tail for row in zip(*lines))
+
+
 ########################################################################
 ### The class you'll want to use no matter what is ValveMap.         ###
 ### This represents the top-level map itself.                        ###
@@ -207,13 +873,56 @@ class World(Entity):
 # of Entities into its children list
 class ValveMap(VmfClass):
 
-    """A class encapsulating the Valve Map Format (VMF)."""
+    """A class encapsulating the Valve Map Format (VMF).
+
+    The map keeps running counts of the things the Source Engine compilers
+    place limits on (see stats()). If strict is True, any change which would
+    push one of those counts past its limit raises a MapLimitError instead.
+    Limits default to ENGINE_LIMITS; any given in limits override them, and
+    a 'connections_per_entity' limit may also be given. Unless the map is
+    strict, what is added to it is only counted when the counts are next
+    needed, so building a large map stays cheap.
+
+    The map also keeps its entities indexed by id, targetname and
+    classname, and its brushes by id and material, so they can be found
+    without walking the map (see query(), find_by_id(), query_brushes()
+    and find_brush()). The outputs between entities are indexed too, so
+    entity I/O can be checked without scanning every entity (see
+    targets(), fired_into(), missing_targets() and zero_delay_cycles()).
+    Outputs are indexed as they are added to a Connections, so replace an
+    Output rather than changing its target in place. Ids are indexed as
+    entities and brushes are added, too, so don't change properties['id']
+    by hand while one is in the map: take it out, change its id and put it
+    back.
+
+    """
 
     vmf_class_name = False                 # Document-level, has no class name
     instance = None                        # Singleton instance
 
-    def __init__(self):
+    def __init__(self, strict=False, limits=None):
+        self.strict = strict
+        self.limits = dict(ENGINE_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self._planes = collections.Counter()   # Unique plane keys in use
+        # Lower case name -> {id: count}, for each key that is indexed (ids
+        # of entities, except for material, which holds brush ids)
+        self._indexes = {'targetname': {}, 'classname': {}, 'material': {}}
+        self._sorted = {}       # Key -> sorted names, until they change
+        self._entities = {}     # Entity id -> Entity
+        self._tables = {}       # First id -> EntityTable
+        self._table_ids = []    # First ids of _tables, sorted
+        self._brushes = {}      # Brush id -> Solid
+        self._outputs = {}      # Entity id -> [(lower case target, Output)]
+        self._inbound = {}      # Lower case target -> [(entity id, Output)]
+        self._wildcards = set()     # Targets in _inbound containing a *
+        # id() -> subtree added since the indexes were last used; these are
+        # only indexed when needed, so building a big map stays cheap
+        self._pending = {}
+
         VmfClass.__init__(self)            # Superclass initializer
+        self._stats = {}                   # A map is always counted
         ValveMap.instance = self
 
         # These properties are objects that represent the basic structure
@@ -235,9 +944,572 @@ class ValveMap(VmfClass):
         c.append(self.cameras)
         c.append(self.cordon)
 
+    def __getstate__(self):
+        self._flush()               # _pending is keyed by id()
+        return VmfClass.__getstate__(self)
+
+    def _register(self, node, sign):
+        """Adds (or removes) the planes, entities, brushes and outputs
+        beneath node.
+
+        Unless the map is strict, and needs its counts up to date to check
+        them, a subtree being added is only put aside, to be indexed by
+        _flush() when the indexes are next used.
+
+        """
+        if not isinstance(node, VmfClass):
+            return
+        if sign > 0 and not self.strict:
+            self._pending[id(node)] = node
+            return
+        if self._pending:
+            if self._is_pending(node):
+                # Never indexed, so there is nothing to take out
+                self._pending.pop(id(node), None)
+                return
+            self._flush()
+        self._index(node, sign)
+
+    def _is_pending(self, node):
+        """Returns whether node is in a subtree not yet indexed."""
+        pending = self._pending
+        while node is not None:
+            if id(node) in pending:
+                return True
+            node = node._parent
+        return False
+
+    def _tracks(self, node):
+        """Returns whether changes to node must be indexed as they happen
+        (rather than when its subtree is)."""
+        return not (self._pending and self._is_pending(node))
+
+    def _flush(self):
+        """Indexes the subtrees put aside by _register()."""
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = {}
+        for node in pending.values():
+            # Skip subtrees inside another one, or since taken out
+            ancestor = node._parent
+            while (ancestor is not None and ancestor is not self and
+                    id(ancestor) not in pending):
+                ancestor = ancestor._parent
+            if ancestor is self:
+                self._index(node, 1)
+
+    def _index(self, node, sign):
+        """Adds (or removes) node and everything beneath it to our stats
+        and indexes."""
+        if sign > 0:
+            stats = self._index_tree(node)
+        else:
+            stats = node._stats
+            for item in _walk(node):
+                self._index_item(item, sign)
+        node._parent._propagate(stats, sign)
+
+    def _index_tree(self, node):
+        """Indexes node and everything beneath it, working out their stats
+        as it goes (as _tally() does), and returns node's stats."""
+        self._index_item(node, 1)
+        stats = dict(node.own_stats)
+        for child in node.children:
+            child_node = _node(child)
+            if isinstance(child_node, VmfClass):
+                child_stats = self._index_tree(child_node)
+            else:
+                child_stats = node._child_stats(child)
+            for name, value in child_stats.items():
+                stats[name] = stats.get(name, 0) + value
+        node._stats = stats
+        return stats
+
+    def _index_item(self, item, sign):
+        name = item.vmf_class_name
+        if name == 'side':
+            key = item.plane_key
+            if key is not None:
+                self._add_plane(key, sign)
+            if item._parent is not None:
+                self._index_name('material', item.material,
+                    item._parent.properties['id'], sign)
+        elif name == 'solid':
+            if sign > 0:
+                self._brushes[item.properties['id']] = item
+            else:
+                self._brushes.pop(item.properties['id'], None)
+        elif isinstance(item, EntityTable):
+            self._index_table(item, sign)
+        elif isinstance(item, Entity) and not isinstance(item, World):
+            entity_id = item.properties['id']
+            if sign > 0:
+                self._entities[entity_id] = item
+            else:
+                self._entities.pop(entity_id, None)
+            for key in ENTITY_INDEXES:
+                self._index_name(key, getattr(item, key), entity_id, sign)
+        elif isinstance(item, Connections):
+            for output in item.children:
+                self._index_output(item._parent, output, sign)
+
+    def _index_table(self, table, sign):
+        if sign > 0:
+            self._tables[table.first_id] = table
+            bisect.insort(self._table_ids, table.first_id)
+        elif self._tables.pop(table.first_id, None) is not None:
+            self._table_ids.remove(table.first_id)
+        ids = range(table.first_id, table.first_id + len(table))
+        for key in ENTITY_INDEXES:
+            values = table.columns.get(key)
+            if not isinstance(values, list):
+                values = [values] * len(ids)
+            for name, entity_id in zip(values, ids):
+                self._index_name(key, name, entity_id, sign)
+
+    def _add_plane(self, key, sign):
+        if sign > 0:
+            self._planes[key] = self._planes.get(key, 0) + 1
+        else:
+            self._planes[key] -= 1
+            if self._planes[key] <= 0:
+                del self._planes[key]
+
+    def _index_name(self, key, name, entity_id, sign):
+        """Adds (or removes) one use of a name by an entity (or brush)."""
+        if name is None or name == '':
+            return
+        index = self._indexes[key]
+        name = str(name).lower()
+        ids = index.get(name)
+        if sign > 0:
+            if ids is None:
+                ids = index[name] = {}
+                self._sorted.pop(key, None)
+            ids[entity_id] = ids.get(entity_id, 0) + 1
+        elif ids is not None and entity_id in ids:
+            ids[entity_id] -= 1
+            if not ids[entity_id]:
+                del ids[entity_id]
+            if not ids:
+                del index[name]
+                self._sorted.pop(key, None)
+
+    def _rename(self, entity, key, old, new):
+        """Moves an entity in the index when its targetname or classname
+        changes."""
+        if not isinstance(entity, World):
+            self._index_name(key, old, entity.properties['id'], -1)
+            self._index_name(key, new, entity.properties['id'], 1)
+
+    def _index_output(self, entity, output, sign):
+        if not isinstance(entity, Entity) or isinstance(entity, World):
+            return
+        source = entity.properties['id']
+        if sign > 0:
+            target = str(output.target).lower()
+            self._outputs.setdefault(source, []).append((target, output))
+            self._inbound.setdefault(target, []).append((source, output))
+            if '*' in target:
+                self._wildcards.add(target)
+            return
+
+        # Outputs are compared by identity; look up the target it was
+        # indexed under, in case it has been changed since
+        outputs = self._outputs.get(source, [])
+        for i, (target, other) in enumerate(outputs):
+            if other is output:
+                del outputs[i]
+                break
+        else:
+            return
+        inbound = self._inbound[target]
+        inbound.remove((source, output))
+        if not inbound:
+            del self._inbound[target]
+            self._wildcards.discard(target)
+        if not outputs:
+            del self._outputs[source]
+
+    def _match(self, key, target):
+        """Returns the ids of entities whose key matches a lower case
+        target, where a * matches anything from there on."""
+        index = self._indexes[key]
+        star = target.find('*')
+        if star < 0:
+            return list(index.get(target, ()))
+        prefix = target[:star]
+        names = self._sorted.get(key)
+        if names is None:
+            names = self._sorted[key] = sorted(index)
+        ids = []
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            ids.extend(index[names[i]])
+        return ids
+
+    def _check_limits(self, node):
+        """Raises MapLimitError if strict and a count is over its limit.
+
+        node is the class that was just changed; it is used to find the
+        entity whose connections need checking.
+
+        """
+        if not self.strict:
+            return
+        self._flush()               # In case strict was only just set
+        for name in STAT_NAMES:
+            limit = self.limits.get(name)
+            if limit is not None and self.count(name) > limit:
+                raise MapLimitError("Map has %d %s (limit is %d)" %
+                    (self.count(name), name, limit))
+        limit = self.limits.get('connections_per_entity')
+        if limit is not None:
+            while node is not None and not isinstance(node, Entity):
+                node = node._parent
+            connections = node._stats.get('connections', 0) \
+                if node is not None else 0
+            if connections > limit:
+                raise MapLimitError("Entity %s has %d connections (limit "
+                    "is %d)" % (node.properties['id'], connections, limit))
+
+    def count(self, name):
+        """Returns the current count of one of the STAT_NAMES."""
+        self._flush()
+        if name == 'planes':
+            # VBSP stores each unique plane along with its opposite
+            return 2 * len(self._planes)
+        return self._stats.get(name, 0)
+
+    def stats(self):
+        """Returns usage of each engine limit, without walking the map.
+
+        The result maps each of the STAT_NAMES to a dict holding the current
+        'count', the 'limit' (or None if there isn't one) and the 'percent'
+        of the limit in use (or None).
+
+        Counts are kept as the map changes, except that what has been added
+        to a map that isn't strict is only counted (in one pass over the new
+        brushes and entities) by the next call to this, count() or one of
+        the queries. So the first call after a large map is built takes
+        time in proportion to what was added; later calls are quick. A
+        strict map counts everything as it is added, to check the limits.
+
+        """
+        result = {}
+        for name in STAT_NAMES:
+            count = self.count(name)
+            limit = self.limits.get(name)
+            percent = None
+            if limit:
+                percent = 100.0 * count / limit
+            result[name] = {'count': count, 'limit': limit, 'percent': percent}
+        return result
+
+    def find_by_id(self, entity_id):
+        """Returns the entity with the given id, or None.
+
+        A row of an EntityTable is returned as a new Entity made with its
+        entity() method, so changing it doesn't change the table.
+
+        """
+        self._flush()
+        entity = self._entities.get(entity_id)
+        if entity is None and self._table_ids:
+            i = bisect.bisect_right(self._table_ids, entity_id) - 1
+            if i >= 0:
+                table = self._tables[self._table_ids[i]]
+                if entity_id < table.first_id + len(table):
+                    return table.entity(entity_id - table.first_id)
+        return entity
+
+    def find_brush(self, brush_id):
+        """Returns the brush (Solid) with the given id, or None.
+
+        Brushes are found by the id they had when they were added to the
+        map (see the class docstring).
+
+        """
+        self._flush()
+        return self._brushes.get(brush_id)
+
+    def query(self, classname=None, targetname=None, where=None,
+            **keyvalues):
+        """Returns the entities matching every condition given, by id.
+
+        classname and targetname are looked up in the map's indexes, and
+        matched as targets() does: ignoring case, with a * matching anything
+        from there on. Any other keyvalues must match exactly (as strings),
+        and where, if given, is called with each entity and returns whether
+        to include it. Rows of EntityTables are returned as find_by_id()
+        does. The world isn't included.
+
+        """
+        self._flush()
+        ids = None
+        for key, value in (('classname', classname),
+                ('targetname', targetname)):
+            if value is not None:
+                found = set(self._match(key, str(value).lower()))
+                ids = found if ids is None else ids & found
+        if ids is None:
+            ids = list(self._entities)
+            for table in self._tables.values():
+                ids.extend(range(table.first_id, table.first_id + len(table)))
+
+        result = []
+        for entity_id in sorted(ids):
+            entity = self.find_by_id(entity_id)
+            if entity is None:
+                continue
+            if keyvalues and not all(
+                    str(_keyvalue(entity, key)) == str(value)
+                    for key, value in keyvalues.items()):
+                continue
+            if where is not None and not where(entity):
+                continue
+            result.append(entity)
+        return result
+
+    def query_brushes(self, material=None, where=None):
+        """Returns the brushes (Solids) matching every condition given, by id.
+
+        material selects brushes with a side using that material, matched
+        ignoring case, with a * matching anything from there on (so
+        'tools/*' finds every brush with a tool texture). where, if given,
+        is called with each brush and returns whether to include it.
+
+        """
+        self._flush()
+        if material is not None:
+            ids = set(self._match('material', str(material).lower()))
+        else:
+            ids = self._brushes
+        return [self._brushes[brush_id] for brush_id in sorted(ids)
+            if where is None or where(self._brushes[brush_id])]
+
+    def targets(self, target):
+        """Returns the ids of the entities an output's target refers to.
+
+        As in the engine, names are matched ignoring case, a * matches
+        anything from there on, and a target matching no targetname is
+        looked for among classnames instead. Targets such as !self or
+        !activator are only known as the map runs, so match nothing.
+
+        """
+        self._flush()
+        target = str(target).lower()
+        if not target or target.startswith('!'):
+            return []
+        return (self._match('targetname', target) or
+            self._match('classname', target))
+
+    def fired_into(self, target):
+        """Returns the outputs that fire into an entity.
+
+        target is an Entity, or a targetname. The result lists an
+        (entity id, Output) pair for each output whose target matches it.
+
+        """
+        names = []
+        if isinstance(target, Entity):
+            if target.targetname:
+                names.append(('targetname', str(target.targetname).lower()))
+            names.append(('classname', str(target.classname).lower()))
+        else:
+            names.append(('targetname', str(target).lower()))
+
+        self._flush()
+        found = []
+        for key, name in names:
+            patterns = [name] + sorted(pattern for pattern in self._wildcards
+                if name.startswith(pattern[:pattern.index('*')]))
+            for pattern in patterns:
+                # Outputs only reach classnames when no targetname matches
+                if key == 'classname' and self._match('targetname', pattern):
+                    continue
+                found.extend(self._inbound.get(pattern, ()))
+        return found
+
+    def missing_targets(self):
+        """Returns the outputs whose target matches no entity in the map.
+
+        The result lists an (entity id, Output) pair for each of them.
+        Outputs to targets such as !activator aren't included.
+
+        """
+        self._flush()
+        missing = []
+        for target, outputs in self._inbound.items():
+            if not target.startswith('!') and not self.targets(target):
+                missing.extend(outputs)
+        return missing
+
+    def zero_delay_cycles(self):
+        """Returns the groups of entities whose outputs form a loop with no
+        delay anywhere in it.
+
+        Such a loop can keep firing within a single tick, hanging the game
+        or overflowing its event queue. Each group is a sorted list of
+        entity ids, which fire into each other with zero-delay outputs
+        (which inputs then fire which outputs isn't known, so a group is a
+        loop that can happen, not one that must).
+
+        """
+        self._flush()
+        edges = {}
+        resolved = {}
+        for source, outputs in self._outputs.items():
+            for target, output in outputs:
+                if _delay(output) != 0:
+                    continue
+                if target not in resolved:
+                    resolved[target] = self.targets(target)
+                edges.setdefault(source, set()).update(resolved[target])
+        return sorted(sorted(group) for group in _cycles(edges))
+
+    def merge(self, other, offset=None, prefix=None):
+        """Moves everything in another ValveMap into this one.
+
+        other's brushes join our world, and its entities, visgroups and
+        cordon join ours; nothing is copied, so other is left empty. Their
+        ids are renumbered in a single pass to follow on from the ids
+        already handed out, so nothing collides.
+
+        If offset (an (x, y, z) or Vertex) is given, brushes and entity
+        origins are moved by it, with their textures locked in place. If
+        prefix is given, it is added to each of other's targetnames, and to
+        the output targets and NAME_KEYS that refer to them. Targets which
+        name something outside other (or a classname, or !activator and
+        the like) are left alone.
+
+        Children from add_source() sources aren't made until the map is
+        written, so they can't be renumbered or moved; a ValueError is
+        raised, before anything is moved, if other has any.
+
+        """
+        from vmflib import brush
+        if offset is not None and not isinstance(offset, types.Vertex):
+            offset = types.Vertex(*offset)
+        if any(node._sources for node in _walk(other)):
+            raise ValueError("Can't merge a map with children from "
+                "add_source()")
+        other._flush()
+        names = set(other._indexes['targetname']) if prefix else ()
+        bases = {
+            'entity': Entity.entitycount,
+            'solid': brush.Solid.solid_count,
+            'group': brush.Group.group_count,
+            'visgroupid': 1 + max([0] + [int(node.properties['visgroupid'])
+                for child in self.children if isinstance(child, VisGroups)
+                for node in _walk(child) if 'visgroupid' in node.properties]),
+        }
+
+        # Take everything out of the other map first, so it stays valid
+        kept = (other.world, other.cameras, other.cordon)
+        world = list(other.world.children)
+        entities = [child for child in other.children
+            if child not in kept and not isinstance(child, VisGroups)]
+        visgroups = [group for child in other.children
+            if isinstance(child, VisGroups) for group in child.children]
+        del other.world.children[:]
+        del other.children[:]
+        other.children.extend(kept)
+
+        highest = collections.Counter()
+        for child in world + entities + visgroups:
+            if offset is not None and isinstance(getattr(child, 'origin',
+                    None), types.Vertex) and not isinstance(child, VmfClass):
+                child.origin = _moved(child.origin, offset)     # A Block
+            for node in _walk(_node(child)):
+                _relocate(node, bases, highest, offset, prefix, names)
+        Entity.entitycount = max(Entity.entitycount, highest['entity'])
+        brush.Solid.solid_count = max(brush.Solid.solid_count,
+            highest['solid'])
+        brush.Group.group_count = max(brush.Group.group_count,
+            highest['group'])
+
+        self.world.children.extend(world)
+        self.children.extend(entities)
+        if visgroups:
+            ours = [child for child in self.children
+                if isinstance(child, VisGroups)]
+            if not ours:
+                ours = [VisGroups()]
+                self.children.insert(0, ours[0])
+            ours[0].children.extend(visgroups)
+        # The cordon becomes a box around both
+        mins, maxs = other.cordon.mins, other.cordon.maxs
+        if mins.x <= maxs.x and mins.y <= maxs.y and mins.z <= maxs.z:
+            if offset is not None:
+                mins, maxs = _moved(mins, offset), _moved(maxs, offset)
+            ours = self.cordon
+            ours.mins = types.Vertex(min(ours.mins.x, mins.x),
+                min(ours.mins.y, mins.y), min(ours.mins.z, mins.z))
+            ours.maxs = types.Vertex(max(ours.maxs.x, maxs.x),
+                max(ours.maxs.y, maxs.y), max(ours.maxs.z, maxs.z))
+            ours.active = types.Bool(ours.active.state or
+                other.cordon.active.state)
+
     def write_vmf(self, filename):
         """Write the map to a file in VMF format."""
         print('Writing to: ' + filename)
-        f = open(filename, 'w')
-        f.write(repr(self))
-        f.close()
+        # Write to a temporary file first, so that if making a source's
+        # children fails partway, the file isn't left half written
+        temp = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                self._write(f.write, sources=True)
+            os.replace(temp, filename)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def export_obj(self, filename, **options):
+        """Write a preview of the map's geometry as a Wavefront OBJ file.
+
+        See export.write_obj() for the options. This needs NumPy.
+
+        """
+        from vmflib import export
+        export.write_obj(self, filename, **options)
+
+    def export_gltf(self, filename, **options):
+        """Write a preview of the map's geometry as a binary glTF file.
+
+        See export.write_gltf() for the options. This needs NumPy.
+
+        """
+        from vmflib import export
+        export.write_gltf(self, filename, **options)
+
+    def patch_bsp(self, filename, output=None):
+        """Write the map's point entities into an already compiled BSP.
+
+        See bsp.patch_entities(); a BspError is raised if the map's brush
+        entities no longer match the compiled ones.
+
+        """
+        from vmflib import bsp
+        bsp.patch_entities(filename, self, output)
+
+
+def reset_ids():
+    """Restarts the numbering of entities, brushes and so on from zero.
+
+    Ids are handed out in the order things are created, across every map
+    made by the process. Calling this before generating a map numbers it
+    as if it were the first, so running the same generator twice in one
+    process writes the same VMF. ValveMap.instance is forgotten too.
+
+    """
+    from vmflib import brush
+    Entity.entitycount = 0
+    World.worldcount = 0
+    brush.Solid.solid_count = 0
+    brush.Side.side_count = 0
+    brush.Group.group_count = 0
+    ValveMap.instance = None
@@ -0,0 +1,326 @@
+"""
+
+Reading the directories of VPK packages, and checking a map's materials.
+
+Most of a Source game's content ships in VPKs. Each one has a directory
+file (named like tf2_textures_dir.vpk) listing every file in it, with the
+data itself kept in numbered archives alongside. Only the directory is
+needed to know whether a file exists, so checking that a map's materials
+can be found doesn't need to run VBSP.
+
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from vmflib import brush, keyvalues, vmf
+
+HEADER = struct.Struct('<III')          # Signature, version, tree size
+SIGNATURE = 0x55aa1234
+HEADER_SIZES = {1: HEADER.size, 2: HEADER.size + 16}   # By version
+ENTRY = struct.Struct('<IHHIIH')        # CRC, preload bytes, archive index,
+                                        # offset, length, terminator
+
+# Entity keys (in lower case) whose values are material names
+MATERIAL_KEYS = ('material', 'texture', 'detailmaterial', 'ropematerial',
+    'smokematerial', 'spritename')
+
+
+class VpkError(Exception):
+
+    """Raised when a file isn't a VPK directory that vmflib can read."""
+
+
+def _string(data, position):
+    """Reads a null-terminated string, returning it and the position after."""
+    end = data.find(b'\0', position)
+    if end < 0:
+        raise VpkError("Unterminated string in VPK directory")
+    return data[position:end].decode('utf-8', 'replace'), end + 1
+
+
+def read_directory(filename, extension=None):
+    """Returns the paths of the files listed in a VPK directory file.
+
+    Only files with the given extension (such as 'vmt') are returned, if
+    one is given. The file is memory-mapped, so only the directory tree at
+    its start is ever read.
+
+    """
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:          # Empty files can't be mapped
+            raise VpkError("%s is too short to be a VPK" % filename)
+    with data:
+        if len(data) < HEADER.size:
+            raise VpkError("%s is too short to be a VPK" % filename)
+        signature, version, tree_size = HEADER.unpack_from(data, 0)
+        if signature != SIGNATURE:
+            raise VpkError("%s is not a VPK file" % filename)
+        if version not in HEADER_SIZES:
+            raise VpkError("VPK version %d isn't supported" % version)
+        position = HEADER_SIZES[version]
+        end = position + tree_size
+
+        # The tree lists extensions, then directories holding files with
+        # that extension, then file names; an empty string ends each list
+        paths = []
+        while True:
+            ext, position = _string(data, position)
+            if not ext:
+                break
+            while True:
+                directory, position = _string(data, position)
+                if not directory:
+                    break
+                while True:
+                    name, position = _string(data, position)
+                    if not name:
+                        break
+                    if position + ENTRY.size > len(data):
+                        raise VpkError("%s's directory tree is truncated" %
+                            filename)
+                    preload, = struct.unpack_from('<H', data, position + 4)
+                    position += ENTRY.size + preload
+                    if extension is None or ext == extension:
+                        if directory == ' ':    # The root directory
+                            paths.append('%s.%s' % (name, ext))
+                        else:
+                            paths.append('%s/%s.%s' % (directory, name, ext))
+            if position > end:
+                raise VpkError("%s's directory tree is truncated" % filename)
+    return paths
+
+
+def search_paths(gamedir):
+    """Returns the (directories, VPK directory files) a game loads from.
+
+    These come from the game search paths in gamedir's gameinfo.txt, in
+    the order they are listed.
+
+    """
+    gamedir = os.path.abspath(gamedir)
+    with open(os.path.join(gamedir, 'gameinfo.txt')) as f:
+        blocks = keyvalues.parse(f.read())
+    base = os.path.dirname(gamedir)
+    directories = []
+    vpks = []
+    for block in _blocks(blocks, 'searchpaths'):
+        for key, value in block.pairs:
+            if 'game' not in key.lower().split('+'):
+                continue
+            value = value.replace('|gameinfo_path|', gamedir + '/')
+            value = value.replace('|all_source_engine_paths|', base + '/')
+            path = os.path.normpath(os.path.join(base, value))
+            if path.endswith('*'):
+                parent = os.path.dirname(path)
+                try:
+                    names = sorted(os.listdir(parent))
+                except OSError:
+                    continue
+                paths = [os.path.join(parent, name) for name in names]
+            else:
+                paths = [path]
+            for path in paths:
+                if path.lower().endswith('.vpk'):
+                    path = path[:-4] + '_dir.vpk'
+                    if os.path.isfile(path) and path not in vpks:
+                        vpks.append(path)
+                elif os.path.isdir(path) and path not in directories:
+                    directories.append(path)
+    return directories, vpks
+
+
+def _blocks(blocks, name):
+    """Yields every block with the given name (in any case) in a tree."""
+    for block in blocks:
+        if block.name and block.name.lower() == name:
+            yield block
+        for child in _blocks(block.children, name):
+            yield child
+
+
+def _material_name(material):
+    """Returns the form materials are compared in: lower case, no .vmt."""
+    name = material.lower().replace('\\', '/').strip('/')
+    if name.startswith('materials/'):
+        name = name[len('materials/'):]
+    if name.endswith('.vmt') or name.endswith('.spr'):
+        name = name[:-4]
+    return name
+
+
+class MaterialIndex:
+
+    """The materials a game can load, for checking maps before compiling.
+
+    gamedir is the game's directory, holding gameinfo.txt. The VPKs on its
+    search paths are read when the index is made, and the materials in
+    them kept in a set. If cache_file is given, that set is saved there,
+    and a VPK is only read again once its modification time changes.
+
+    Materials not in any VPK are looked for as loose files under each
+    search path's materials directory.
+
+    """
+
+    def __init__(self, gamedir, cache_file=None):
+        self.gamedir = gamedir
+        self.directories, self.vpks = search_paths(gamedir)
+        self.materials = self._load(cache_file)
+        self._loose = {}        # Material -> whether it's a loose file
+        self._listings = {}     # Directory -> {lower case name: name}
+
+    def _load(self, cache_file):
+        cached = {}
+        if cache_file:
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        entries = {}
+        for path in self.vpks:
+            mtime = os.path.getmtime(path)
+            entry = cached.get(path)
+            if entry is None or entry[0] != mtime:
+                entry = [mtime, [_material_name(name) for name in
+                    read_directory(path, 'vmt')
+                    if name.startswith('materials/')]]
+            entries[path] = entry
+
+        if cache_file and entries != cached:
+            try:
+                fd, temp = tempfile.mkstemp(dir=os.path.dirname(
+                    os.path.abspath(cache_file)))
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(temp, cache_file)
+            except OSError:
+                pass            # The index still works, just without a cache
+        materials = set()
+        for mtime, names in entries.values():
+            materials.update(names)
+        return materials
+
+    def _listing(self, directory):
+        listing = self._listings.get(directory)
+        if listing is None:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                names = []
+            listing = self._listings[directory] = dict((name.lower(), name)
+                for name in names)
+        return listing
+
+    def _is_loose(self, name):
+        """Looks for a loose .vmt file, ignoring case as the game does."""
+        parts = (name + '.vmt').split('/')
+        for directory in self.directories:
+            path = os.path.join(directory, 'materials')
+            for part in parts:
+                part = self._listing(path).get(part)
+                if part is None:
+                    break
+                path = os.path.join(path, part)
+            else:
+                if os.path.isfile(path):
+                    return True
+        return False
+
+    def __contains__(self, material):
+        name = _material_name(material)
+        if name in self.materials:
+            return True
+        found = self._loose.get(name)
+        if found is None:
+            found = self._loose[name] = self._is_loose(name)
+        return found
+
+    def missing(self, uses):
+        """Returns the materials that can't be found, and where they're used.
+
+        uses is a list of (material, where) pairs, such as map_materials()
+        returns. The result maps each missing material to the places it is
+        used.
+
+        """
+        result = {}
+        for material, where in uses:
+            if material not in self:
+                result.setdefault(material, []).append(where)
+        return result
+
+    def check(self, valve_map):
+        """Returns the materials a ValveMap uses that can't be found.
+
+        See missing() for what is returned.
+
+        """
+        return self.missing(map_materials(valve_map))
+
+
+def _entity_materials(pairs):
+    """Returns the material-valued keys among an entity's keyvalues."""
+    materials = []
+    for key, value in pairs:
+        key = key.lower()
+        if not value:
+            continue
+        if key in MATERIAL_KEYS or (key == 'model' and
+                value.lower().endswith(('.vmt', '.spr'))):
+            materials.append((str(value), key))
+    return materials
+
+
+def map_materials(valve_map):
+    """Returns (material, where) for every material a ValveMap uses.
+
+    This covers the material of every brush side, and entity keys holding
+    a material (see MATERIAL_KEYS, and sprites given as a model).
+
+    """
+    uses = []
+    for node in vmf._walk(valve_map):
+        if isinstance(node, brush.Side):
+            uses.append((node.material, 'side %s' % node.properties['id']))
+        elif isinstance(node, vmf.Entity):
+            pairs = [(name, getattr(node, name))
+                for name in node.auto_properties]
+            pairs.extend(node.properties.items())
+            for material, key in _entity_materials(pairs):
+                uses.append((material, 'entity %s (%s) %s' % (
+                    node.properties['id'], node.classname, key)))
+        elif isinstance(node, vmf.EntityTable):
+            for i in range(len(node)):
+                for material, key in _entity_materials(node.row(i)):
+                    uses.append((material, 'entity %s (%s) %s' % (
+                        node.first_id + i, node.classname, key)))
+    return uses
+
+
+def vmf_materials(blocks):
+    """Returns (material, where) for every material used in a parsed VMF.
+
+    blocks is a VMF file read with keyvalues.parse(); see map_materials().
+
+    """
+    uses = []
+    stack = list(blocks)
+    while stack:
+        block = stack.pop()
+        if block.name == 'side' and block.get('material'):
+            uses.append((block.get('material'), 'side %s' % block.get('id')))
+        elif block.name in ('world', 'entity'):
+            classname = block.get('classname')
+            for material, key in _entity_materials(block.pairs):
+                uses.append((material, 'entity %s (%s) %s' % (
+                    block.get('id'), classname, key)))
+        stack.extend(block.children)
+    return uses